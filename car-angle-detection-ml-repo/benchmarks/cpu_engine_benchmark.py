@@ -0,0 +1,98 @@
+"""Compare the eager FP32 model with the int8 CPU artifact (`src/export_cpu.py`) on CPU
+
+Reports the latency of both models over a folder of images and how well their boxes agree:
+a box of the eager model counts as matched if the int8 model predicts a box of the same class
+with an IoU of at least `--iou-threshold`. The artifact is exported first if it is missing.
+
+    python benchmarks/cpu_engine_benchmark.py --model-dir model/ --images-dir images/ --output cpu.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from detectron2.config import get_cfg  # noqa: E402
+from detectron2.engine import DefaultPredictor  # noqa: E402
+from detectron2.structures import pairwise_iou  # noqa: E402
+
+from export_cpu import CPU_MODEL_FILE, configure_cpu_threads, export_cpu_model, load_cpu_predictor  # noqa: E402
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def _box_agreement(reference, candidate, iou_threshold):
+    """Number of reference boxes matched by a candidate box of the same class"""
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0
+    iou = pairwise_iou(reference.pred_boxes, candidate.pred_boxes)
+    same_class = reference.pred_classes[:, None] == candidate.pred_classes[None, :]
+    return int(((iou >= iou_threshold) & same_class).any(dim=1).sum())
+
+
+def _run(predictor, images):
+    durations, outputs = [], []
+    for image in images:
+        start = time.perf_counter()
+        outputs.append(predictor(image)["instances"])
+        durations.append(time.perf_counter() - start)
+    return durations, outputs
+
+
+def main(args):
+    num_threads = configure_cpu_threads(args.num_threads)
+    model_dir = Path(args.model_dir)
+    cfg = get_cfg()
+    cfg.merge_from_file(str(next(model_dir.glob("*.yaml"))))
+    cfg.MODEL.WEIGHTS = str(next(model_dir.glob("*.pth")))
+    cfg.MODEL.DEVICE = "cpu"
+
+    cpu_model_path = model_dir / CPU_MODEL_FILE
+    if not cpu_model_path.exists():
+        export_cpu_model(cfg, str(model_dir))
+
+    images = [cv2.imread(str(path)) for path in sorted(Path(args.images_dir).glob("*.jpg"))][:args.max_images]
+    predictors = {"eager_fp32": DefaultPredictor(cfg), "int8": load_cpu_predictor(cfg, cpu_model_path)}
+
+    results = {"num_threads": num_threads, "num_images": len(images)}
+    outputs = {}
+    with torch.no_grad():
+        for name, predictor in predictors.items():
+            predictor(images[0])  # warm up
+            durations, outputs[name] = _run(predictor, images)
+            results[name] = {
+                "latency_ms_p50": statistics.median(durations) * 1000,
+                "latency_ms_p95": _percentile(durations, 95) * 1000,
+                "num_boxes": sum(len(instances) for instances in outputs[name]),
+            }
+
+    matched = sum(
+        _box_agreement(reference, candidate, args.iou_threshold)
+        for reference, candidate in zip(outputs["eager_fp32"], outputs["int8"])
+    )
+    results["box_agreement"] = matched / max(results["eager_fp32"]["num_boxes"], 1)
+    results["speedup_p50"] = results["eager_fp32"]["latency_ms_p50"] / results["int8"]["latency_ms_p50"]
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", type=str, required=True)
+    parser.add_argument("--images-dir", type=str, required=True)
+    parser.add_argument("--max-images", type=int, default=50)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--iou-threshold", type=float, default=0.9)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
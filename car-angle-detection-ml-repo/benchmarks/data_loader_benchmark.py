@@ -0,0 +1,111 @@
+"""Benchmark the training data loading from image files vs. from the image cache (`src/image_cache.py`)
+
+For each loader, measures per iteration the time the training loop waits for the next batch
+(data time) and, with `--with-model`, the time of the forward and backward pass of a Mask R-CNN
+(compute time). When the data time is not small next to the compute time, the GPU is idle
+waiting for data.
+
+    python benchmarks/data_loader_benchmark.py --data-dir data/ --num-workers 4 --with-model --output loading.json
+
+The model is randomly initialized, which does not change its compute time. The image cache in
+`--cache-dir` is built if it does not exist yet or was built for other annotations or sizes.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import torch
+from detectron2 import model_zoo
+from detectron2.config import get_cfg
+from detectron2.data import build_detection_train_loader
+from detectron2.data.datasets import register_coco_instances
+from detectron2.modeling import build_model
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from data_loading import build_cached_train_loader  # noqa: E402
+from image_cache import build_image_cache, cache_matches  # noqa: E402
+# Sorted-index percentiles, statistics.quantiles is missing from the Python 3.6 training image
+from training_profiler import _summary  # noqa: E402
+
+
+def measure(loader, num_iters, warmup, model=None, optimizer=None):
+    """Data and compute time of `num_iters` iterations after `warmup` ones"""
+    data_times, compute_times = [], []
+    iterator = iter(loader)
+    for i in range(warmup + num_iters):
+        start = time.perf_counter()
+        batch = next(iterator)
+        loaded = time.perf_counter()
+        if model is not None:
+            losses = sum(model(batch).values())
+            optimizer.zero_grad()
+            losses.backward()
+            optimizer.step()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+        if i >= warmup:
+            data_times.append(loaded - start)
+            compute_times.append(time.perf_counter() - loaded)
+
+    images = num_iters * len(batch)
+    result = {"data": _summary(data_times), "images_per_s": images / sum(data_times + compute_times)}
+    if model is not None:
+        result["compute"] = _summary(compute_times)
+        result["data_share"] = sum(data_times) / sum(data_times + compute_times)
+    return result
+
+
+def main(args):
+    register_coco_instances("benchmark_dataset", {}, f"{args.data_dir}/annotations.json", args.data_dir)
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file(args.coco_config_file))
+    cfg.DATASETS.TRAIN = ("benchmark_dataset",)
+    cfg.DATALOADER.NUM_WORKERS = args.num_workers
+    cfg.SOLVER.IMS_PER_BATCH = args.imgs_per_batch
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = args.num_classes
+    cfg.MODEL.DEVICE = args.device
+    cfg.MODEL.WEIGHTS = ""
+
+    annotations_file = f"{args.data_dir}/annotations.json"
+    min_size, max_size = max(cfg.INPUT.MIN_SIZE_TRAIN), cfg.INPUT.MAX_SIZE_TRAIN
+    if not cache_matches(args.cache_dir, annotations_file, min_size, max_size):
+        build_stats = build_image_cache(annotations_file, args.data_dir, args.cache_dir, min_size=min_size, max_size=max_size)
+    else:
+        build_stats = None
+
+    model = optimizer = None
+    if args.with_model:
+        model = build_model(cfg)
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+
+    results = {
+        "num_workers": args.num_workers,
+        "imgs_per_batch": args.imgs_per_batch,
+        "device": args.device,
+        "cache_build": build_stats,
+        "files": measure(build_detection_train_loader(cfg), args.num_iters, args.warmup, model, optimizer),
+        "cache": measure(build_cached_train_loader(cfg, args.cache_dir), args.num_iters, args.warmup, model, optimizer),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, required=True, help="directory of annotations.json and the images")
+    parser.add_argument("--cache-dir", type=str, default="/tmp/image_cache")
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--imgs-per-batch", type=int, default=2)
+    parser.add_argument("--num-classes", type=int, default=19)
+    parser.add_argument("--num-iters", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--with-model", action="store_true", help="also run forward and backward passes")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--coco-config-file", type=str, default="COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml")
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
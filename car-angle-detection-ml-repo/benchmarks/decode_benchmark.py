@@ -0,0 +1,83 @@
+"""Benchmark full vs. reduced resolution decoding of the serving container (`src/image_decoding.py`)
+
+Encodes synthetic JPEG images of typical camera sizes and reports, for each size, the decode
+time and the size of the decoded array with and without a target size.
+
+    python benchmarks/decode_benchmark.py --target-size 800 --output decode.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+from image_decoding import decode_image  # noqa: E402
+
+
+IMAGE_SIZES = {
+    "VGA": (480, 640),
+    "HD": (720, 1280),
+    "FHD": (1080, 1920),
+    "8MP": (2448, 3264),
+    "12MP": (3024, 4032),
+}
+
+
+def _synthetic_jpeg(height, width, quality=90):
+    """Smooth gradients plus noise, which compresses like a photo rather than like a flat image"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    image = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    image = np.clip(image + rng.normal(0, 12, image.shape), 0, 255).astype(np.uint8)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    assert ok
+    return encoded.tobytes()
+
+
+def _time_decode(encoded, target_size, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        np_image, _ = decode_image(encoded, target_size)
+        durations.append(time.perf_counter() - start)
+    return durations, np_image
+
+
+def main(args):
+    results = []
+    for name, (height, width) in IMAGE_SIZES.items():
+        encoded = _synthetic_jpeg(height, width)
+        for target_size in (None, args.target_size):
+            durations, np_image = _time_decode(encoded, target_size, args.repeats)
+            results.append({
+                "image": name,
+                "original_size": [height, width],
+                "encoded_bytes": len(encoded),
+                "target_size": target_size,
+                "decoded_size": list(np_image.shape[:2]),
+                "decoded_bytes": int(np_image.nbytes),
+                "decode_ms_p50": statistics.median(durations) * 1000,
+                "decode_ms_min": min(durations) * 1000,
+            })
+
+    print(f"{'image':>6} {'target':>6} {'decoded':>11} {'MiB':>7} {'p50 ms':>8}")
+    for result in results:
+        print(f"{result['image']:>6} {str(result['target_size']):>6} "
+              f"{'x'.join(map(str, result['decoded_size'])):>11} "
+              f"{result['decoded_bytes'] / 2 ** 20:7.1f} {result['decode_ms_p50']:8.1f}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--target-size", type=int, default=800)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
@@ -0,0 +1,161 @@
+"""Per-stage latency benchmark of the SageMaker handler functions in `src/predict.py`
+
+Runs `model_fn` once, then replays a folder of images through `input_fn`, `predict_fn` and
+`output_fn` and reports p50/p95/p99 latency per stage, peak RSS and response sizes as JSON,
+so that results can be compared across commits.
+
+Without `--model-dir`, a small randomly initialized model (ResNet-18 backbone, 320 px test size)
+is created in a temporary directory, and the pretrained COCO model is randomly initialized too,
+so the benchmark runs on CPU without network access. Without `--images-dir`, synthetic JPEG
+images are used. Latencies of random models are only comparable with each other, not with the
+trained model.
+
+    python benchmarks/handler_benchmark.py --num-images 20 --output handler.json
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src"
+sys.path.insert(0, str(SRC_DIR))
+from detectron2 import model_zoo  # noqa: E402
+from detectron2.checkpoint import DetectionCheckpointer  # noqa: E402
+from detectron2.config import get_cfg  # noqa: E402
+from detectron2.modeling import build_model  # noqa: E402
+
+STAGES = ("input_fn", "predict_fn", "output_fn", "total")
+
+
+def _save_random_model(cfg, output_dir, name):
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    model = build_model(cfg)
+    DetectionCheckpointer(model, save_dir=str(output_dir)).save(name)
+    return Path(output_dir) / f"{name}.pth"
+
+
+def _create_random_models(work_dir, num_classes):
+    """Write a small random trained model to `work_dir/model` and random COCO weights to `work_dir/pretrained`"""
+    model_dir, pretrained_dir = Path(work_dir) / "model", Path(work_dir) / "pretrained"
+    model_dir.mkdir()
+    pretrained_dir.mkdir()
+
+    cfg = get_cfg()
+    cfg.merge_from_file(model_zoo.get_config_file("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"))
+    cfg.MODEL.WEIGHTS = ""
+    cfg.MODEL.DEVICE = "cpu"
+    pretrained_weights = _save_random_model(cfg, pretrained_dir, "model_final")
+
+    cfg.MODEL.RESNETS.DEPTH = 18
+    cfg.MODEL.RESNETS.RES2_OUT_CHANNELS = 64
+    cfg.MODEL.ROI_HEADS.NUM_CLASSES = num_classes
+    cfg.INPUT.MIN_SIZE_TEST = 320
+    cfg.INPUT.MAX_SIZE_TEST = 512
+    _save_random_model(cfg, model_dir, "model_final")
+    with open(model_dir / "config.yaml", "w") as file:
+        file.write(cfg.dump())
+    return model_dir, pretrained_weights
+
+
+def _synthetic_images(num_images, height=480, width=640):
+    rng = np.random.default_rng(0)
+    for _ in range(num_images):
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        yield cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def _load_images(images_dir, num_images):
+    paths = sorted(p for p in Path(images_dir).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+    for path in paths[:num_images]:
+        yield path.read_bytes()
+
+
+def _percentiles(durations):
+    durations = sorted(d * 1000 for d in durations)
+
+    def pick(q):
+        return durations[min(len(durations) - 1, int(round(q / 100 * (len(durations) - 1))))]
+    return {"p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99), "mean_ms": statistics.mean(durations)}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=str(SRC_DIR), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir, pretrained_weights = _create_random_models(work_dir, args.num_classes)
+            os.environ["PRETRAINED_MODEL_WEIGHTS"] = str(pretrained_weights)
+
+        import predict
+
+        start = time.perf_counter()
+        models = predict.model_fn(str(model_dir))
+        model_fn_duration = time.perf_counter() - start
+
+        if args.images_dir:
+            images = _load_images(args.images_dir, args.num_images)
+        else:
+            images = _synthetic_images(args.num_images)
+
+        durations = {stage: [] for stage in STAGES}
+        response_bytes = []
+        for encoded in images:
+            start = time.perf_counter()
+            request = predict.input_fn(encoded, args.content_type)
+            after_input = time.perf_counter()
+            predictions = predict.predict_fn(request, models)
+            after_predict = time.perf_counter()
+            response = predict.output_fn(predictions, args.accept)
+            end = time.perf_counter()
+
+            durations["input_fn"].append(after_input - start)
+            durations["predict_fn"].append(after_predict - after_input)
+            durations["output_fn"].append(end - after_predict)
+            durations["total"].append(end - start)
+            response_bytes.append(len(response.encode("utf-8") if isinstance(response, str) else response))
+
+    results = {
+        "commit": _git_commit(),
+        "content_type": args.content_type,
+        "accept": args.accept,
+        "random_model": args.model_dir is None,
+        "num_images": len(response_bytes),
+        "model_fn_s": model_fn_duration,
+        "model_timings_s": models["timings"],
+        "stages": {stage: _percentiles(values) for stage, values in durations.items() if values},
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "response_bytes": {"mean": statistics.mean(response_bytes), "max": max(response_bytes)} if response_bytes else None,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", type=str, default=None)
+    parser.add_argument("--images-dir", type=str, default=None)
+    parser.add_argument("--num-images", type=int, default=20)
+    parser.add_argument("--num-classes", type=int, default=19)
+    parser.add_argument("--content-type", type=str, default="application/x-image")
+    parser.add_argument("--accept", type=str, default="application/json")
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
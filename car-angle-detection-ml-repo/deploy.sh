@@ -59,4 +59,9 @@ aws s3 cp Car-Parts-Segmentation/testset s3://$S3_BUCKET/car_position/test --rec
 python3 -m venv .venv
 source .venv/bin/activate
 pip install -r requirements.txt
+# columnar annotations, registered by train.py instead of the JSON files
+python3 src/coco_columnar.py convert data/annotations-train.json --output annotations-train.npz
+python3 src/coco_columnar.py convert data/annotations-test.json --output annotations-test.npz
+aws s3 cp annotations-train.npz s3://$S3_BUCKET/car_position/train/annotations.npz
+aws s3 cp annotations-test.npz s3://$S3_BUCKET/car_position/test/annotations.npz
 python3 car_angle_train.py --s3-bucket $S3_BUCKET --ecr-image-training $train_ecr --ecr-image-serving $serve_ecr
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""Training data loading from the pre-decoded image cache of `image_cache.py`"""
+import copy
+
+import numpy as np
+import torch
+from detectron2.data import DatasetMapper, build_detection_train_loader
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+
+from image_cache import ImageCache
+
+
+class CachedDatasetMapper(DatasetMapper):
+    """
+    DatasetMapper reading images from an `ImageCache` instead of decoding the image files.
+
+    Cached images may be smaller than the originals the annotations refer to, a resize from the
+    original size to the cached size is put in front of the augmentations so that boxes and
+    polygons are transformed with the image. The cached pixels are not copied before the
+    augmentations, only once into the tensor.
+    """
+
+    def __init__(self, cfg, image_cache: ImageCache, is_train: bool = True):
+        super().__init__(cfg, is_train=is_train)
+        if self.image_format not in ("BGR", "RGB"):
+            raise ValueError(f"The image cache stores color images, INPUT.FORMAT {self.image_format} is not supported")
+        self.image_cache = image_cache
+
+    def __call__(self, dataset_dict):
+        dataset_dict = copy.deepcopy(dataset_dict)
+        image, (height, width) = self.image_cache.get(dataset_dict["image_id"])
+        if self.image_format != self.image_cache.image_format:
+            image = image[:, :, ::-1]
+
+        cached_height, cached_width = image.shape[:2]
+        image, transforms = T.apply_augmentations(self.augmentations, image)
+        if (cached_height, cached_width) != (height, width):
+            # The annotations are in pixels of the original image
+            transforms = T.TransformList([T.ResizeTransform(height, width, cached_height, cached_width)]) + transforms
+        image_shape = image.shape[:2]
+        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+        if not self.is_train:
+            dataset_dict.pop("annotations", None)
+            return dataset_dict
+
+        if "annotations" in dataset_dict:
+            for anno in dataset_dict["annotations"]:
+                if not self.use_instance_mask:
+                    anno.pop("segmentation", None)
+                if not self.use_keypoint:
+                    anno.pop("keypoints", None)
+            annos = [
+                utils.transform_instance_annotations(obj, transforms, image_shape,
+                                                     keypoint_hflip_indices=self.keypoint_hflip_indices)
+                for obj in dataset_dict.pop("annotations")
+                if obj.get("iscrowd", 0) == 0
+            ]
+            instances = utils.annotations_to_instances(annos, image_shape, mask_format=self.instance_mask_format)
+            if self.recompute_boxes:
+                instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+            dataset_dict["instances"] = utils.filter_empty_instances(instances)
+        return dataset_dict
+
+
+def build_cached_train_loader(cfg, cache_dir: str):
+    """`build_detection_train_loader` of `cfg` with the images of the cache in `cache_dir`"""
+    return build_detection_train_loader(cfg, mapper=CachedDatasetMapper(cfg, ImageCache(cache_dir), is_train=True))
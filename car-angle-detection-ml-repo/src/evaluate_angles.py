@@ -0,0 +1,217 @@
+"""Angle and view accuracy of a trained model on an annotated dataset (e.g. the validation channel)
+
+The reference angle and view of each image come from the post-processing of the Lambda
+(`position_detection`) applied to the annotated boxes, the predicted ones from the same
+post-processing applied to the boxes predicted by the model.
+
+Predictions are cached in `--cache-dir`, one file per image keyed by the hash of the model files
+and the hash of the encoded image, with every box above the low `--cache-score-threshold`. Only
+images missing from the cache go through the model (in batches), so scoring again after a change
+of the post-processing or of the score threshold costs no inference and does not load the model.
+Scoring is vectorized over all images, several score thresholds are evaluated in one run:
+
+    python src/evaluate_angles.py --data-dir Car-Parts-Segmentation/testset --model-dir /opt/ml/model \\
+        --score-thresholds 0.5,0.6,0.7,0.8 --output evaluation.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from coco_columnar import ColumnarCoco, convert_coco, matches_source
+
+# The post-processing of the Lambda, so that both are evaluated with the same code
+LAMBDA_DIR = Path(__file__).resolve().parents[2] / "lambda"
+sys.path[:0] = [str(LAMBDA_DIR / "common"), str(LAMBDA_DIR / "detectron_car_angle_detection")]
+from position_detection import CLASS_TO_NUMBER, View  # noqa: E402
+from wheel_geometry import wheel_angles, xyxy_box_points  # noqa: E402
+
+DEFAULT_SCORE_THRESHOLDS = "0.5,0.6,0.7,0.8"
+CACHE_SCORE_THRESHOLD = 0.05
+# Index of an image without consistent view in the confusion matrix, views follow in View order
+NO_VIEW = len(View)
+VIEW_LABELS = [view.name.lower() for view in View] + ["none"]
+ANGLE_TOLERANCES = (2.0, 5.0, 10.0)
+
+
+def file_hash(paths: Sequence[Path], extra: str = "") -> str:
+    digest = hashlib.sha256(extra.encode())
+    for path in sorted(paths):
+        digest.update(path.name.encode())
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(2**20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def model_hash(model_dir: str, device: str) -> str:
+    """Hash of the config and weights in `model_dir` and of the device, which selects the int8 CPU model"""
+    paths = [path for path in Path(model_dir).iterdir() if path.suffix in (".yaml", ".pth", ".pt", ".bin")]
+    return file_hash(paths, extra=device)
+
+
+def predict_images(model_dir: str, image_paths: List[Path], score_threshold: float) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Boxes, classes and scores of the trained model for each image, down to `score_threshold`.
+    Images are read, decoded and predicted `MAX_BATCH_SIZE` at a time, the predictions of a
+    batch are yielded as soon as it is done.
+    """
+    from predict import MAX_BATCH_SIZE, _get_trained_model, _load_from_bytearray, _run_batch
+
+    predictor = _get_trained_model(model_dir)
+    predictor.model.roi_heads.box_predictor.test_score_thresh = score_threshold
+    for start in range(0, len(image_paths), MAX_BATCH_SIZE):
+        images = [_load_from_bytearray(path.read_bytes())[0] for path in image_paths[start:start + MAX_BATCH_SIZE]]
+        for output in _run_batch(predictor, images):
+            instances = output["instances"].to("cpu")
+            yield {
+                "pred_boxes": instances.pred_boxes.tensor.numpy().astype(np.float32),
+                "pred_classes": instances.pred_classes.numpy().astype(np.int32),
+                "scores": instances.scores.numpy().astype(np.float32),
+            }
+
+
+def cached_predictions(image_paths: List[Path], model_dir: str, cache_dir: str, device: str,
+                       score_threshold: float = CACHE_SCORE_THRESHOLD) -> Tuple[List[Dict[str, np.ndarray]], Dict]:
+    """
+    Predictions of all images, from the cache where available. Also returns cache statistics.
+    Each new prediction is cached as soon as its batch is done, an interrupted run keeps them.
+    """
+    cache = Path(cache_dir) / f"{model_hash(model_dir, device)}_{score_threshold}"
+    cache.mkdir(parents=True, exist_ok=True)
+    cache_files = [cache / f"{hashlib.sha256(path.read_bytes()).hexdigest()[:16]}.npz" for path in image_paths]
+
+    missing = [i for i, cache_file in enumerate(cache_files) if not cache_file.exists()]
+    start = time.perf_counter()
+    for i, prediction in zip(missing, predict_images(model_dir, [image_paths[i] for i in missing], score_threshold)):
+        np.savez(cache_files[i], **prediction)
+    inference_s = time.perf_counter() - start
+
+    predictions = []
+    for cache_file in cache_files:
+        with np.load(cache_file) as prediction:
+            predictions.append({key: prediction[key] for key in prediction.files})
+    return predictions, {"cache": str(cache), "hits": len(cache_files) - len(missing), "misses": len(missing),
+                         "inference_s": inference_s}
+
+
+def angles_and_views(boxes: np.ndarray, classes: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Angle and view of each image like `position_detection.car_angle_from_bbs`, for all images at once.
+
+    `boxes[offsets[i]:offsets[i + 1]]` are the (x1, y1, x2, y2) boxes of image i. Returns the angles
+    (NaN where `car_angle_from_bbs` returns None) and the view indices (`NO_VIEW` where it returns None).
+    """
+    num_images = len(offsets) - 1
+    image_index = np.repeat(np.arange(num_images), np.diff(offsets))
+
+    def count(class_name):
+        return np.bincount(image_index[classes == CLASS_TO_NUMBER[class_name]], minlength=num_images)
+
+    front, back, wheels = count("front_bumper"), count("back_bumper"), count("wheel")
+    views = np.full(num_images, NO_VIEW)
+    views[(front == 1) & (back == 0)] = View.FRONT.value
+    views[(front == 0) & (back == 1)] = View.BACK.value
+    views[(front == 0) & (back == 0)] = View.SIDE.value
+
+    is_wheel = classes == CLASS_TO_NUMBER["wheel"]
+    wheel_offsets = np.concatenate([[0], np.cumsum(wheels)])
+    angles, _, _ = wheel_angles(xyxy_box_points(boxes[is_wheel]).astype(np.float64), wheel_offsets)
+    angles[wheels == 0] = 0.0
+    angles[(wheels == 1) | (wheels > 3)] = np.nan
+    # No angle either without view
+    angles[views == NO_VIEW] = np.nan
+    views[np.isnan(angles)] = NO_VIEW
+    return angles, views
+
+
+def _pack(predictions: List[Dict[str, np.ndarray]], score_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    boxes = np.concatenate([prediction["pred_boxes"].reshape(-1, 4) for prediction in predictions])
+    classes = np.concatenate([prediction["pred_classes"] for prediction in predictions])
+    scores = np.concatenate([prediction["scores"] for prediction in predictions])
+    counts = np.array([len(prediction["pred_classes"]) for prediction in predictions])
+    keep = scores >= score_threshold
+    image_index = np.repeat(np.arange(len(predictions)), counts)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(image_index[keep], minlength=len(predictions)))])
+    return boxes[keep], classes[keep], offsets
+
+
+def score(angles: np.ndarray, views: np.ndarray, true_angles: np.ndarray, true_views: np.ndarray) -> Dict:
+    """Angle errors on the images where both angles exist, view accuracy and confusion (rows: truth)"""
+    confusion = np.bincount(true_views * (NO_VIEW + 1) + views, minlength=(NO_VIEW + 1) ** 2).reshape(NO_VIEW + 1, NO_VIEW + 1)
+    has_truth = ~np.isnan(true_angles)
+    both = has_truth & ~np.isnan(angles)
+    errors = np.abs(angles[both] - true_angles[both])
+    result = {
+        "images": len(angles),
+        "images_with_reference": int(has_truth.sum()),
+        "coverage": float(both.sum() / has_truth.sum()) if has_truth.any() else None,
+        "view_accuracy": float((views[has_truth] == true_views[has_truth]).mean()) if has_truth.any() else None,
+        "view_confusion": {"labels": VIEW_LABELS, "matrix": confusion.tolist()},
+    }
+    if len(errors):
+        result["angle_error"] = {
+            "mean": float(errors.mean()),
+            "median": float(np.median(errors)),
+            "p90": float(np.percentile(errors, 90)),
+            **{f"within_{tolerance:g}": float((errors <= tolerance).mean()) for tolerance in ANGLE_TOLERANCES},
+        }
+    return result
+
+
+def reference_boxes(coco: ColumnarCoco) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Annotated (x1, y1, x2, y2) boxes, category ids and per-image offsets"""
+    boxes = coco.bboxes.copy()
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes, coco.category_ids, coco.ann_offsets
+
+
+def evaluate(data_dir: str, model_dir: str, cache_dir: str, score_thresholds: Sequence[float],
+             cache_score_threshold: float = CACHE_SCORE_THRESHOLD) -> Dict:
+    import torch
+
+    # Like predict.py: the int8 CPU model without GPU
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    start = time.perf_counter()
+    annotations, json_file = Path(data_dir) / "annotations.npz", Path(data_dir) / "annotations.json"
+    if not annotations.exists() or (json_file.exists() and not matches_source(str(annotations), str(json_file))):
+        annotations = Path(cache_dir) / f"annotations_{file_hash([json_file])}.npz"
+        if not annotations.exists():
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            convert_coco(str(json_file), str(annotations))
+    coco = ColumnarCoco(str(annotations))
+    true_angles, true_views = angles_and_views(*reference_boxes(coco))
+
+    image_paths = [Path(data_dir) / file_name for file_name in coco.file_names.tolist()]
+    predictions, cache_stats = cached_predictions(image_paths, model_dir, cache_dir, device, cache_score_threshold)
+
+    results = {}
+    for threshold in score_thresholds:
+        angles, views = angles_and_views(*_pack(predictions, threshold))
+        results[f"{threshold:g}"] = score(angles, views, true_angles, true_views)
+    return {"predictions": cache_stats, "duration_s": time.perf_counter() - start, "score_thresholds": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-dir", type=str, default=os.environ.get("SM_CHANNEL_VALIDATION"),
+                        help="directory of annotations.json (or annotations.npz) and the images")
+    parser.add_argument("--model-dir", type=str, default=os.environ.get("SM_MODEL_DIR", "/opt/ml/model"))
+    parser.add_argument("--cache-dir", type=str, default=".evaluation_cache")
+    parser.add_argument("--score-thresholds", type=str, default=DEFAULT_SCORE_THRESHOLDS)
+    parser.add_argument("--cache-score-threshold", type=float, default=CACHE_SCORE_THRESHOLD)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    evaluation = evaluate(args.data_dir, args.model_dir, args.cache_dir,
+                          [float(value) for value in args.score_thresholds.split(",")], args.cache_score_threshold)
+    print(json.dumps(evaluation, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(evaluation, file, indent=2)
@@ -0,0 +1,72 @@
+from typing import Optional
+import logging
+import os
+import sys
+from pathlib import Path
+
+import torch
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.engine import DefaultPredictor
+from detectron2.modeling import build_model
+
+
+logger = logging.Logger("ExportCPU", level=logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter("%(levelname)s | %(name)s | %(message)s"))
+logger.addHandler(handler)
+
+CPU_MODEL_FILE = "model_cpu_int8.pt"
+
+
+def quantize_for_cpu(model: torch.nn.Module) -> torch.nn.Module:
+    """Quantize the fully connected layers (box head and predictors) of a model to int8 with dynamic activation scales"""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None) -> int:
+    """Set the number of intra-op threads used by PyTorch, `INFERENCE_NUM_THREADS` or one per CPU by default"""
+    num_threads = num_threads or int(os.environ.get("INFERENCE_NUM_THREADS", os.cpu_count() or 1))
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def export_cpu_model(cfg, output_dir: str) -> Path:
+    """Export the model of `cfg.MODEL.WEIGHTS` as an int8 dynamically quantized CPU artifact
+
+    Parameters
+    ----------
+    cfg : CfgNode
+        Detectron2 configuration of the trained model
+    output_dir : str
+        directory where the artifact is written as `CPU_MODEL_FILE`
+
+    Returns
+    -------
+    Path
+        path of the exported artifact (the state dict of the quantized model)
+    """
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+    quantized_model = quantize_for_cpu(model)
+
+    path = Path(output_dir) / CPU_MODEL_FILE
+    torch.save(quantized_model.state_dict(), path)
+    logger.info(f"Exported int8 CPU model to {path}")
+    return path
+
+
+def load_cpu_predictor(cfg, path: str) -> DefaultPredictor:
+    """Create a predictor that runs the quantized CPU artifact exported by `export_cpu_model`"""
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    # The weights come from the artifact, the checkpoint is not loaded
+    cfg.MODEL.WEIGHTS = ""
+    predictor = DefaultPredictor(cfg)
+    predictor.model = quantize_for_cpu(predictor.model)
+    predictor.model.load_state_dict(torch.load(path, map_location="cpu"))
+    predictor.model.eval()
+    return predictor
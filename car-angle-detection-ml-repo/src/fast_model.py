@@ -0,0 +1,156 @@
+"""Self-contained inference artifact that loads with one memory-mapped read
+
+The artifact holds the Detectron2 configuration and the weights of a model in one file: an
+8 byte magic, the length of a JSON header as a little-endian uint64, the header (configuration
+as YAML, name, dtype, shape and offset of each tensor) and the raw tensor data, every tensor
+aligned to 64 bytes. Float32 tensors are stored as float16 unless float16 loses too much of them
+(values beyond the float16 range, or too small for it) and are converted back at load time.
+
+Loading maps the file once and wraps the tensor data in place, instead of unpickling a
+checkpoint through fvcore and merging a YAML file next to it. Reading and writing only need
+torch and numpy, Detectron2 is imported by the functions that build models.
+"""
+from typing import Dict, Optional, Tuple
+import json
+import logging
+import math
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+logger = logging.Logger("FastModel", level=logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setFormatter(logging.Formatter("%(levelname)s | %(name)s | %(message)s"))
+logger.addHandler(handler)
+
+FAST_MODEL_FILE = "model_fast_fp16.bin"
+# The pretrained COCO model used for the car mask, so that serving does not download it
+PRETRAINED_FAST_MODEL_FILE = "pretrained_fast_fp16.bin"
+MAGIC = b"D2FAST1\n"
+ALIGNMENT = 64
+# Largest error of the float16 round trip relative to the largest value of a tensor
+MAX_FP16_ERROR = 1e-3
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _compact(tensor: torch.Tensor) -> torch.Tensor:
+    """The float16 copy of a float32 tensor if it keeps the tensor, the tensor itself otherwise"""
+    if tensor.dtype != torch.float32 or tensor.numel() == 0:
+        return tensor
+    half = tensor.half()
+    scale = tensor.abs().max().item()
+    error = (half.float() - tensor).abs().max().item()
+    if not math.isfinite(error) or error > MAX_FP16_ERROR * scale:
+        return tensor
+    return half
+
+
+def write_fast_model(state_dict: Dict[str, torch.Tensor], config_yaml: str, path: Path) -> Path:
+    """Write a state dict and the YAML configuration of its model as a fast loading artifact"""
+    tensors, entries, offset = [], {}, 0
+    for name, tensor in state_dict.items():
+        stored = _compact(tensor.detach().cpu().contiguous())
+        data = stored.numpy()
+        entries[name] = {
+            "dtype": data.dtype.name,
+            "load_dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(data.shape),
+            "offset": offset,
+        }
+        tensors.append(data)
+        offset = _align(offset + data.nbytes)
+    header = json.dumps({"config": config_yaml, "tensors": entries}).encode()
+
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint64(len(header)).tobytes())
+        file.write(header)
+        data_start = _align(file.tell())
+        for data, entry in zip(tensors, entries.values()):
+            file.seek(data_start + entry["offset"])
+            file.write(data.tobytes())
+        file.truncate(data_start + offset)
+    return path
+
+
+def read_fast_model(path: Path, device: Optional[str] = None) -> Tuple[str, Dict[str, torch.Tensor]]:
+    """
+    Return the YAML configuration and the state dict of an artifact. Without `device`, the tensors
+    are views of the memory map (copy-on-write) in their stored dtypes, which `load_state_dict`
+    converts while copying them into the model, so the file is read once and not copied in between.
+    With `device`, the tensors are converted to their original dtypes on `device`.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+    if data[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError(f"{path} is not a fast model artifact")
+    header_length = int(data[len(MAGIC):len(MAGIC) + 8].view("<u8")[0])
+    header_start = len(MAGIC) + 8
+    header = json.loads(data[header_start:header_start + header_length].tobytes())
+    data_start = _align(header_start + header_length)
+
+    state_dict = {}
+    for name, entry in header["tensors"].items():
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        tensor = torch.from_numpy(np.asarray(data[start:start + count * dtype.itemsize]).view(dtype).reshape(entry["shape"]))
+        if device is not None:
+            tensor = tensor.to(device=device, dtype=getattr(torch, entry["load_dtype"]))
+        state_dict[name] = tensor
+    return header["config"], state_dict
+
+
+def export_fast_model(cfg, output_dir: str, file_name: str = FAST_MODEL_FILE) -> Path:
+    """Export the model of `cfg.MODEL.WEIGHTS` with `cfg` as a fast loading artifact
+
+    Parameters
+    ----------
+    cfg : CfgNode
+        Detectron2 configuration of the model
+    output_dir : str
+        directory where the artifact is written as `file_name`
+
+    Returns
+    -------
+    Path
+        path of the exported artifact
+    """
+    from detectron2.checkpoint import DetectionCheckpointer
+    from detectron2.modeling import build_model
+
+    cfg = cfg.clone()
+    cfg.MODEL.DEVICE = "cpu"
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    # The weights are in the artifact
+    cfg.MODEL.WEIGHTS = ""
+    path = write_fast_model(model.state_dict(), cfg.dump(), Path(output_dir) / file_name)
+    logger.info(f"Exported fast loading model to {path} ({path.stat().st_size / 2**20:.1f} MiB)")
+    return path
+
+
+def load_fast_predictor(path: Path, device: str, score_threshold: float):
+    """Create a predictor on `device` from a fast loading artifact, logging the load time"""
+    from detectron2.config import CfgNode, get_cfg
+    from detectron2.engine import DefaultPredictor
+
+    start = time.perf_counter()
+    config_yaml, state_dict = read_fast_model(path)
+    cfg = get_cfg()
+    cfg.merge_from_other_cfg(CfgNode.load_cfg(config_yaml))
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = score_threshold
+    cfg.MODEL.DEVICE = device
+    cfg.MODEL.WEIGHTS = ""
+    predictor = DefaultPredictor(cfg)
+    predictor.model.load_state_dict(state_dict)
+    predictor.model.eval()
+    duration = time.perf_counter() - start
+    logger.info(f"Loaded fast model {path} on {device} in {duration:.3f}s")
+    return predictor
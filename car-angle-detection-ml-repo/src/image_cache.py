@@ -0,0 +1,142 @@
+"""Pre-decoded training images, stored once as resized uint8 arrays in one memory-mapped file
+
+The images of a COCO annotation file are decoded, downscaled to the largest size training resizes
+them to and appended to `images.u8`. `index.npz` maps each COCO image id to the position and
+shape of its pixels, so that the data loader reads an image as a view of the memory map instead
+of decoding the JPEG at every epoch. The index also records the sizes and the hash of the annotation
+file the cache was built from, `cache_matches` tells whether an existing cache can be reused.
+
+    python image_cache.py --annotations data/annotations.json --image-root data/ --output /opt/ml/input/image_cache
+"""
+import argparse
+import json
+import os
+import time
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+
+from coco_columnar import file_sha256
+from image_decoding import decode_image
+
+INDEX_FILE = "index.npz"
+DATA_FILE = "images.u8"
+# Default INPUT.MIN_SIZE_TRAIN (largest value) and INPUT.MAX_SIZE_TRAIN of Detectron2
+DEFAULT_MIN_SIZE = 800
+DEFAULT_MAX_SIZE = 1333
+
+
+def cache_size(height: int, width: int, min_size: int, max_size: int) -> Tuple[int, int]:
+    """Size of an image in the cache: downscaled like `ResizeShortestEdge` would, never upscaled"""
+    scale = min(1.0, min_size / min(height, width), max_size / max(height, width))
+    return max(1, int(round(height * scale))), max(1, int(round(width * scale)))
+
+
+def cache_matches(cache_dir: str, annotations_file: str, min_size: int = DEFAULT_MIN_SIZE,
+                  max_size: int = DEFAULT_MAX_SIZE) -> bool:
+    """Whether `cache_dir` holds a cache built from `annotations_file` with these sizes"""
+    index_file = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.exists(index_file) or not os.path.exists(os.path.join(cache_dir, DATA_FILE)):
+        return False
+    with np.load(index_file) as index:
+        # Caches written before the build parameters were recorded are rebuilt
+        if not {"min_size", "max_size", "annotations_hash"} <= set(index.files):
+            return False
+        return (int(index["min_size"]) == min_size and int(index["max_size"]) == max_size
+                and str(index["annotations_hash"]) == file_sha256(annotations_file))
+
+
+def build_image_cache(annotations_file: str, image_root: str, cache_dir: str,
+                      min_size: int = DEFAULT_MIN_SIZE, max_size: int = DEFAULT_MAX_SIZE) -> Dict:
+    """Decode and resize the images of a COCO annotation file into `cache_dir`
+
+    Images are BGR, like `cfg.INPUT.FORMAT` by default. JPEGs larger than needed are decoded at
+    reduced resolution. Returns statistics of the build.
+    """
+    with open(annotations_file) as file:
+        images = json.load(file)["images"]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    num_images = len(images)
+    image_ids = np.empty(num_images, dtype=np.int64)
+    offsets = np.empty(num_images, dtype=np.int64)
+    shapes = np.empty((num_images, 2), dtype=np.int32)
+    original_shapes = np.empty((num_images, 2), dtype=np.int32)
+    offset = 0
+    with open(os.path.join(cache_dir, DATA_FILE), "wb") as data:
+        for i, image in enumerate(images):
+            with open(os.path.join(image_root, image["file_name"]), "rb") as file:
+                encoded = file.read()
+            height, width = cache_size(image["height"], image["width"], min_size, max_size)
+            np_image, original_shape = decode_image(encoded, target_size=min(height, width))
+            if np_image is None:
+                raise ValueError(f"Cannot decode {image['file_name']}")
+            height, width = cache_size(*original_shape, min_size, max_size)
+            if np_image.shape[:2] != (height, width):
+                np_image = cv2.resize(np_image, (width, height), interpolation=cv2.INTER_AREA)
+            data.write(np.ascontiguousarray(np_image).tobytes())
+
+            image_ids[i], offsets[i] = image["id"], offset
+            shapes[i], original_shapes[i] = (height, width), original_shape
+            offset += height * width * 3
+
+    np.savez(os.path.join(cache_dir, INDEX_FILE), image_ids=image_ids, offsets=offsets, shapes=shapes,
+             original_shapes=original_shapes, image_format=np.array("BGR"), min_size=np.int64(min_size),
+             max_size=np.int64(max_size), annotations_hash=np.array(file_sha256(annotations_file)))
+    return {"num_images": num_images, "bytes": offset, "duration_s": time.perf_counter() - start}
+
+
+class ImageCache:
+    """Read access to a cache written by `build_image_cache`
+
+    The data file is memory-mapped on first access in each process, DataLoader workers map it
+    themselves instead of receiving a copy, and the pages are shared through the page cache.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with np.load(os.path.join(cache_dir, INDEX_FILE)) as index:
+            self.offsets = index["offsets"]
+            self.shapes = index["shapes"]
+            self.original_shapes = index["original_shapes"]
+            self.image_format = str(index["image_format"])
+            self._positions = {int(image_id): i for i, image_id in enumerate(index["image_ids"])}
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, image_id: int) -> bool:
+        return image_id in self._positions
+
+    @property
+    def data(self) -> np.ndarray:
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.cache_dir, DATA_FILE), dtype=np.uint8, mode="r")
+        return self._data
+
+    def get(self, image_id: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Return the cached image as a read-only (height, width, 3) view and the size of the original image"""
+        i = self._positions[image_id]
+        height, width = (int(value) for value in self.shapes[i])
+        start = int(self.offsets[i])
+        image = self.data[start:start + height * width * 3].reshape(height, width, 3)
+        return image, tuple(int(value) for value in self.original_shapes[i])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annotations", type=str, required=True)
+    parser.add_argument("--image-root", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--min-size", type=int, default=DEFAULT_MIN_SIZE)
+    parser.add_argument("--max-size", type=int, default=DEFAULT_MAX_SIZE)
+    args = parser.parse_args()
+    print(json.dumps(build_image_cache(args.annotations, args.image_root, args.output, args.min_size, args.max_size)))
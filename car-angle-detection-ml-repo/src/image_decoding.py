@@ -0,0 +1,73 @@
+from typing import Optional, Tuple
+import io
+
+import numpy as np
+import cv2
+from PIL import Image
+
+
+# JPEG images are decoded at 1/8, 1/4 or 1/2 resolution through libjpeg DCT scaling
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def image_size(encoded_image: bytes) -> Tuple[int, int]:
+    """Read the (height, width) of an encoded image from its header, without decoding it"""
+    width, height = Image.open(io.BytesIO(encoded_image)).size
+    return height, width
+
+
+def reduced_decode_flag(height: int, width: int, target_size: Optional[int]) -> Tuple[int, int]:
+    """Select the strongest reduced decoding that keeps the shortest edge at or above `target_size`
+
+    Returns
+    -------
+    Tuple[int, int]
+        the reduction factor and the matching OpenCV imread flag, (1, `cv2.IMREAD_COLOR`) if the
+        image cannot be reduced or no `target_size` is given
+    """
+    if target_size:
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if min(height, width) // factor >= target_size:
+                return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+def decode_image(encoded_image: bytes, target_size: Optional[int] = None) -> Tuple[Optional[np.ndarray], Optional[Tuple[int, int]]]:
+    """Decode an image, at reduced resolution if it is larger than needed
+
+    Parameters
+    ----------
+    encoded_image : bytes
+        encoded image
+    target_size : int, optional
+        minimum size of the shortest edge of the decoded image. If given, the image is decoded
+        at 1/2, 1/4 or 1/8 of its resolution as long as its shortest edge stays at or above it.
+
+    Returns
+    -------
+    Tuple[Optional[np.ndarray], Optional[Tuple[int, int]]]
+        the decoded BGR image (None if it cannot be decoded) and the (height, width) of the
+        image at full resolution (None if the image cannot be decoded or its header read)
+    """
+    np_buffer = np.frombuffer(encoded_image, np.uint8)
+    if not target_size:
+        np_image = cv2.imdecode(np_buffer, cv2.IMREAD_COLOR)
+        return np_image, (None if np_image is None else np_image.shape[:2])
+
+    try:
+        height, width = image_size(encoded_image)
+    except OSError:
+        # PIL.UnidentifiedImageError: not an image, like a None from cv2.imdecode
+        return None, None
+    _, flag = reduced_decode_flag(height, width, target_size)
+    np_image = cv2.imdecode(np_buffer, flag)
+    if np_image is None:
+        return None, (height, width)
+    # The header size is before EXIF orientation, which OpenCV applies when decoding
+    if (np_image.shape[0] > np_image.shape[1]) != (height > width) and height != width:
+        height, width = width, height
+    return np_image, (height, width)
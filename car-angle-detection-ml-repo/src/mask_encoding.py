@@ -0,0 +1,64 @@
+from typing import Mapping, Optional
+import base64
+
+import numpy as np
+import cv2
+from pycocotools import mask as mask_utils
+
+
+MASK_FORMAT_RLE = "rle"
+MASK_FORMAT_BITPACK = "bitpack"
+MASK_FORMAT_POLYGON = "polygon"
+MASK_FORMATS = (MASK_FORMAT_RLE, MASK_FORMAT_BITPACK, MASK_FORMAT_POLYGON)
+DEFAULT_MASK_FORMAT = MASK_FORMAT_RLE
+
+
+def _encode_rle(mask: np.ndarray) -> Mapping:
+    rle = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    return {"counts": rle["counts"].decode("ascii")}
+
+
+def _encode_bitpack(mask: np.ndarray) -> Mapping:
+    packed = np.packbits(mask.astype(bool).ravel())
+    return {"data": base64.b64encode(packed.tobytes()).decode("ascii")}
+
+
+def _encode_polygon(mask: np.ndarray) -> Mapping:
+    # OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    polygons = [contour.reshape(-1).tolist() for contour in contours if len(contour) >= 3]
+    return {"polygons": polygons}
+
+
+_ENCODERS = {
+    MASK_FORMAT_RLE: _encode_rle,
+    MASK_FORMAT_BITPACK: _encode_bitpack,
+    MASK_FORMAT_POLYGON: _encode_polygon,
+}
+
+
+def encode_mask(mask: Optional[np.ndarray], mask_format: str = DEFAULT_MASK_FORMAT) -> Optional[Mapping]:
+    """Encode a binary mask into a compact, JSON serializable representation
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean mask of shape (height, width), or None
+    mask_format : str
+        one of `rle` (COCO compressed RLE string, lossless), `bitpack` (base64 encoded
+        `np.packbits` buffer in row-major order, lossless) or `polygon` (outer contours
+        as flat [x1, y1, x2, y2, ...] lists, lossy)
+
+    Returns
+    -------
+    Mapping
+        a dictionary that contains the format (`format`), the mask shape (`size`) as
+        [height, width] and the format specific payload, or None if `mask` is None
+    """
+    if mask is None:
+        return None
+    if mask_format not in _ENCODERS:
+        raise ValueError(f"Mask format [{mask_format}] is not supported, use one of {MASK_FORMATS}")
+    encoded = {"format": mask_format, "size": [int(mask.shape[0]), int(mask.shape[1])]}
+    encoded.update(_ENCODERS[mask_format](mask))
+    return encoded
@@ -1,7 +1,9 @@
-from typing import BinaryIO, Mapping
-import json
+from typing import BinaryIO, Dict, List, Mapping, Optional, Tuple
 import logging
+import os
+import struct
 import sys
+import time
 from pathlib import Path
 
 import numpy as np
@@ -12,6 +14,12 @@ from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
 from detectron2 import model_zoo
 
+from export_cpu import CPU_MODEL_FILE, configure_cpu_threads, load_cpu_predictor, quantize_for_cpu
+from fast_model import FAST_MODEL_FILE, PRETRAINED_FAST_MODEL_FILE, load_fast_predictor
+from image_decoding import decode_image
+from mask_encoding import DEFAULT_MASK_FORMAT, MASK_FORMATS, encode_mask
+from serialization import CONTENT_TYPES, JSON_CONTENT_TYPE, serialize
+
 
 logger = logging.Logger("InferenceScript", level=logging.INFO)
 handler = logging.StreamHandler(sys.stdout)
@@ -22,80 +30,70 @@ COCO_CONFIG_FILE = "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"
 COCO_MODEL_CHECKPOINT = "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml"
 DEFAULT_SCORE_THRESHOLD = 0.5
 TRAINED_SCORE_THRESHOLD = 0.7
+# COCO classes of the pretrained model that are considered as cars: Car and Truck
+CAR_CLASSES = (2, 7)
+IMAGE_CONTENT_TYPE = "application/x-image"
+IMAGE_BATCH_CONTENT_TYPE = "application/x-image-batch"
+OUTPUT_BOXES = "boxes"
+OUTPUT_SCORES = "scores"
+OUTPUT_CLASSES = "classes"
+OUTPUT_CAR_MASK = "car_mask"
+OUTPUT_MASKS = "masks"
+OUTPUTS = (OUTPUT_BOXES, OUTPUT_SCORES, OUTPUT_CLASSES, OUTPUT_CAR_MASK, OUTPUT_MASKS)
+DEFAULT_OUTPUTS = (OUTPUT_BOXES, OUTPUT_SCORES, OUTPUT_CLASSES, OUTPUT_CAR_MASK)
+# Outputs that require the trained car parts model, the car mask only requires the pretrained model
+TRAINED_MODEL_OUTPUTS = (OUTPUT_BOXES, OUTPUT_SCORES, OUTPUT_CLASSES, OUTPUT_MASKS)
+# Maximum number of images sent through a model in one forward pass
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))
+
+
+def _get_pretraind_model(model_dir: Optional[str] = None):
+    """Get Detectron2 default predictor
+
+    The fast loading artifact exported with the trained model is used if present in `model_dir`.
+    Otherwise the weights are downloaded from the Detectron2 model zoo unless `PRETRAINED_MODEL_WEIGHTS`
+    points to a local checkpoint of the same configuration.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    path_fast_model = Path(model_dir) / PRETRAINED_FAST_MODEL_FILE if model_dir else None
+    if path_fast_model is not None and path_fast_model.exists() and not os.environ.get("PRETRAINED_MODEL_WEIGHTS"):
+        predictor = load_fast_predictor(path_fast_model, device, DEFAULT_SCORE_THRESHOLD)
+        if device == "cpu":
+            predictor.model = quantize_for_cpu(predictor.model)
+        return predictor
 
-
-def _get_pretraind_model():
-    """Get Detectron2 default predictor"""
     cfg = get_cfg()
     cfg.merge_from_file(model_zoo.get_config_file(COCO_CONFIG_FILE))
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = DEFAULT_SCORE_THRESHOLD
-    cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url(COCO_MODEL_CHECKPOINT)
+    cfg.MODEL.WEIGHTS = os.environ.get("PRETRAINED_MODEL_WEIGHTS") or model_zoo.get_checkpoint_url(COCO_MODEL_CHECKPOINT)
+    cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
     predictor = DefaultPredictor(cfg)
+    if cfg.MODEL.DEVICE == "cpu":
+        predictor.model = quantize_for_cpu(predictor.model)
     return predictor
 
 
-def _load_from_bytearray(request_body: BinaryIO) -> np.ndarray:
-    npimg = np.frombuffer(request_body, np.uint8)
-    return cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+def _get_trained_model(model_dir: str) -> DefaultPredictor:
+    """Get Detectron2 default predictor for the trained car parts model stored in `model_dir`
 
-
-def get_main_car_mask(seg_predictor, np_image):
-    """Get the main mask of the car object in the given image
-
-    Parameters
-    ----------
-    predictor : DefaultPredictor
-        Detectron2 default predictor
-    input_object : np.ndarray
-
-    Returns
-    -------
-    np.ndarray
-        A Boolean Numpy array that contains the mask of the main car. The function uses a MRCNN predictor 
-        to segment the input image. It focusses on the ouput classes 2 and 7 which coresspond to Car and Truck.
-        If the image conatins more than one object of this class, the object with the largest mask is selected,
-        if no object is found, it returns None.
-    """
-    outputs = seg_predictor(np_image)
-    pred_classes = outputs['instances'].pred_classes.cpu().numpy()
-    pred_masks = outputs['instances'].pred_masks.cpu().numpy() 
-    mask_size = 0
-    mask_return = None
-    for obj, mask in zip(pred_classes, pred_masks):
-        if obj in [2, 7]:
-            cur_size = mask.sum()
-            if cur_size > mask_size:
-                mask_return = mask
-                mask_size = cur_size
-        else:
-            continue
-
-    return mask_return
-
-
-def model_fn(model_dir: str) -> DefaultPredictor:
-    """Load trained model
-
-    Parameters
-    ----------
-    model_dir : str
-        S3 location of the model directory
-
-    Returns
-    -------
-    DefaultPredictor
-        PyTorch model created by using Detectron2 API
+    Without GPU, the int8 CPU artifact exported by `export_cpu.export_cpu_model` is used if present.
+    Otherwise the fast loading artifact exported by `fast_model.export_fast_model` is preferred over
+    the configuration and checkpoint.
     """
-    logger.info(f"Model dir {model_dir}")
-    path_cfg, path_model = None, None
+    path_cfg, path_model, path_cpu_model, path_fast_model = None, None, None, None
     for p_file in Path(model_dir).iterdir():
         if p_file.suffix == ".yaml":
-            logger.info('Test')
-            logger.info(p_file)
-
             path_cfg = p_file
         if p_file.suffix == ".pth":
             path_model = p_file
+        if p_file.name == CPU_MODEL_FILE:
+            path_cpu_model = p_file
+        if p_file.name == FAST_MODEL_FILE:
+            path_fast_model = p_file
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if path_fast_model is not None and not (device == "cpu" and path_cpu_model is not None):
+        return load_fast_predictor(path_fast_model, device, TRAINED_SCORE_THRESHOLD)
 
     logger.info(f"Using configuration specified in {path_cfg}")
     logger.info(f"Using model saved at {path_model}")
@@ -107,79 +105,343 @@ def model_fn(model_dir: str) -> DefaultPredictor:
     if path_cfg is None:
         err_msg = "Missing configuration JSON file"
         logger.error(err_msg)
-        raise RuntimeError(err_msg) 
+        raise RuntimeError(err_msg)
     cfg = get_cfg()
     cfg.merge_from_file(path_cfg)
     cfg.MODEL.WEIGHTS = str(path_model)
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = TRAINED_SCORE_THRESHOLD
-    cfg.MODEL.DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+    cfg.MODEL.DEVICE = device
 
+    if cfg.MODEL.DEVICE == "cpu" and path_cpu_model is not None:
+        logger.info(f"Using int8 CPU model saved at {path_cpu_model}")
+        return load_cpu_predictor(cfg, path_cpu_model)
     return DefaultPredictor(cfg)
 
 
-def input_fn(request_body: BinaryIO, request_content_type: str) -> np.ndarray:
+def _warm_up(predictor: DefaultPredictor) -> None:
+    """Run one prediction on a blank image so that lazy CUDA/cuDNN initialisation does not hit the first request"""
+    size = predictor.cfg.INPUT.MIN_SIZE_TEST
+    _run_batch(predictor, [np.zeros((size, size, 3), dtype=np.uint8)])
+
+
+def _parse_content_type(content_type: str) -> Tuple[str, Dict[str, str]]:
+    """Split a content type such as `application/x-image; mask_format=rle` into its media type and parameters"""
+    media_type, *params = [part.strip() for part in content_type.split(";")]
+    parameters = {}
+    for param in params:
+        key, _, value = param.partition("=")
+        parameters[key.strip().lower()] = value.strip().strip('"')
+    return media_type.lower(), parameters
+
+
+def _load_from_bytearray(request_body: BinaryIO, target_size: Optional[int] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+    np_image, original_size = decode_image(request_body, target_size)
+    if np_image is None:
+        err_msg = "Could not decode the input image"
+        logger.error(err_msg)
+        raise ValueError(err_msg)
+    return np_image, original_size
+
+
+def _rescale_mask(mask: Optional[np.ndarray], size: Tuple[int, int]) -> Optional[np.ndarray]:
+    """Resize a mask predicted on a reduced image back to the (height, width) of the original image"""
+    if mask is None or mask.shape == tuple(size):
+        return mask
+    return cv2.resize(mask.astype(np.uint8), (size[1], size[0]), interpolation=cv2.INTER_NEAREST).astype(bool)
+
+
+def _split_image_batch(request_body: bytes) -> List[bytes]:
+    """Split a batch request into its encoded images
+
+    The batch is a concatenation of frames, each made of the image size in bytes as a
+    4 byte big-endian unsigned integer followed by the encoded image.
+    """
+    encoded_images = []
+    offset = 0
+    while offset < len(request_body):
+        if offset + 4 > len(request_body):
+            err_msg = "Truncated image batch: incomplete length prefix"
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+        (length,) = struct.unpack_from(">I", request_body, offset)
+        offset += 4
+        if offset + length > len(request_body):
+            err_msg = f"Truncated image batch: expected {length} bytes for image {len(encoded_images)}"
+            logger.error(err_msg)
+            raise ValueError(err_msg)
+        encoded_images.append(request_body[offset:offset + length])
+        offset += length
+    return encoded_images
+
+
+def _run_batch(predictor: DefaultPredictor, images: List[np.ndarray]) -> List[Mapping]:
+    """Run the model of a predictor on several images in one forward pass
+
+    Mirrors `DefaultPredictor.__call__` (input format, test-time resize and rescaling of
+    the outputs to the original image size), but for a list of images.
+    """
+    inputs = []
+    for original_image in images:
+        if predictor.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = predictor.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        inputs.append({"image": image, "height": height, "width": width})
+    with torch.no_grad():
+        return predictor.model(inputs)
+
+
+def _run_batched(predictor: DefaultPredictor, images: List[np.ndarray]) -> List[Mapping]:
+    """Run `_run_batch` on chunks of at most `MAX_BATCH_SIZE` images"""
+    outputs = []
+    for start in range(0, len(images), MAX_BATCH_SIZE):
+        outputs.extend(_run_batch(predictor, images[start:start + MAX_BATCH_SIZE]))
+    return outputs
+
+
+def get_main_car_mask(instances):
+    """Get the main mask of the car object from the segmentation of an image
+
+    Parameters
+    ----------
+    instances : Instances
+        Detectron2 instances predicted by the pretrained COCO MRCNN model for one image
+
+    Returns
+    -------
+    np.ndarray
+        A Boolean Numpy array that contains the mask of the main car. The function uses a MRCNN predictor 
+        to segment the input image. It focusses on the ouput classes 2 and 7 which coresspond to Car and Truck.
+        If the image conatins more than one object of this class, the object with the largest mask is selected,
+        if no object is found, it returns None.
+        The class filter and the mask areas are computed on the device of the model, only the selected mask
+        is copied to the host.
+    """
+    if len(instances) == 0:
+        return None
+    pred_classes = instances.pred_classes
+    is_car = torch.zeros_like(pred_classes, dtype=torch.bool)
+    for car_class in CAR_CLASSES:
+        is_car |= pred_classes == car_class
+    areas = instances.pred_masks.flatten(1).sum(dim=1)
+    areas = torch.where(is_car, areas, torch.zeros_like(areas))
+    index = torch.argmax(areas)
+    if areas[index].item() == 0:
+        return None
+    return instances.pred_masks[index].cpu().numpy()
+
+
+def model_fn(model_dir: str) -> Mapping:
+    """Load trained model and the pretrained COCO model used for the car mask
+
+    Both models are loaded and warmed up once per worker, so that `predict_fn` only
+    pays for inference. Without GPU, both models run with int8 quantized fully connected
+    layers and `INFERENCE_NUM_THREADS` intra-op threads.
+
+    Parameters
+    ----------
+    model_dir : str
+        S3 location of the model directory
+
+    Returns
+    -------
+    Mapping
+        a model registry that contains: the trained car parts predictor (`trained`), the
+        pretrained COCO predictor used to segment the car (`pretrained`) and the load and
+        warm-up durations in seconds (`timings`)
+    """
+    logger.info(f"Model dir {model_dir}")
+    timings = {}
+    if not torch.cuda.is_available():
+        logger.info(f"No GPU available, running on CPU with {configure_cpu_threads()} threads")
+
+    start = time.perf_counter()
+    trained_predictor = _get_trained_model(model_dir)
+    timings["trained_load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pretrained_predictor = _get_pretraind_model(model_dir)
+    timings["pretrained_load"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _warm_up(trained_predictor)
+    timings["trained_warm_up"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _warm_up(pretrained_predictor)
+    timings["pretrained_warm_up"] = time.perf_counter() - start
+
+    logger.info("Model registry ready: " + ", ".join(f"{k}={v:.3f}s" for k, v in timings.items()))
+    return {
+        "trained": trained_predictor,
+        "pretrained": pretrained_predictor,
+        "timings": timings,
+    }
+
+
+def input_fn(request_body: BinaryIO, request_content_type: str) -> Mapping:
     """Parse input data
 
     Parameters
     ----------
     request_body : BinaryIO
-        encoded input image
+        encoded input image, or for `application/x-image-batch` a concatenation of encoded
+        images, each prefixed by its size in bytes as a 4 byte big-endian unsigned integer
     request_content_type : str
-        type of content
+        type of content, optionally with the parameters
+        - `outputs`: comma separated list of the outputs to return among `boxes`, `scores`, `classes`,
+          `car_mask` and `masks` (per instance masks of the trained model), defaults to
+          `boxes,scores,classes,car_mask`
+        - `mask_format`: how masks are encoded (`rle`, `bitpack` or `polygon`)
+        - `target_size`: if given, JPEG images are decoded at 1/2, 1/4 or 1/8 of their resolution as
+          long as their shortest edge stays at or above `target_size` pixels. Predictions are still
+          returned in the coordinates of the original image.
+        e.g. `application/x-image; outputs=boxes,classes; mask_format=rle; target_size=800`
 
     Returns
     -------
-    np.ndarray
-        input image
+    Mapping
+        a dictionary that contains: the input images (`images`), the (height, width) of the images
+        at full resolution (`original_sizes`), whether the request is a batch (`batch`), the requested
+        outputs (`outputs`) and the requested mask encoding (`mask_format`)
 
     Raises
     ------
     ValueError
-        ValueError if the content type is not `application/x-image`
+        ValueError if the content type is not `application/x-image` or `application/x-image-batch`,
+        if an image cannot be decoded or if an output or the mask format is unknown
     """
-    if request_content_type == "application/x-image":
-        np_image = _load_from_bytearray(request_body)
+    media_type, parameters = _parse_content_type(request_content_type)
+    try:
+        target_size = int(parameters.get("target_size", 0))
+    except ValueError:
+        err_msg = f"Target size [{parameters['target_size']}] must be an integer"
+        logger.error(err_msg)
+        raise ValueError(err_msg)
+
+    if media_type == IMAGE_CONTENT_TYPE:
+        decoded = [_load_from_bytearray(request_body, target_size)]
+    elif media_type == IMAGE_BATCH_CONTENT_TYPE:
+        decoded = [_load_from_bytearray(encoded, target_size) for encoded in _split_image_batch(request_body)]
     else:
         err_msg = f"Type [{request_content_type}] not support this type yet"
         logger.error(err_msg)
         raise ValueError(err_msg)
-    return np_image
 
+    mask_format = parameters.get("mask_format", DEFAULT_MASK_FORMAT)
+    if mask_format not in MASK_FORMATS:
+        err_msg = f"Mask format [{mask_format}] not supported, use one of {MASK_FORMATS}"
+        logger.error(err_msg)
+        raise ValueError(err_msg)
+
+    outputs = parameters.get("outputs")
+    outputs = DEFAULT_OUTPUTS if outputs is None else tuple(o.strip() for o in outputs.split(",") if o.strip())
+    unknown_outputs = [output for output in outputs if output not in OUTPUTS]
+    if unknown_outputs:
+        err_msg = f"Outputs {unknown_outputs} not supported, use any of {OUTPUTS}"
+        logger.error(err_msg)
+        raise ValueError(err_msg)
+    return {
+        "images": [np_image for np_image, _ in decoded],
+        "original_sizes": [original_size for _, original_size in decoded],
+        "batch": media_type == IMAGE_BATCH_CONTENT_TYPE,
+        "outputs": outputs,
+        "mask_format": mask_format,
+    }
 
-def predict_fn(input_object: np.ndarray, predictor: DefaultPredictor) -> Mapping:
+
+def predict_fn(input_object: Mapping, models: Mapping):
     """Run Detectron2 prediction
 
+    All images of the request go through the models in batched forward passes of at most
+    `MAX_BATCH_SIZE` images. Only the models and the device to host copies needed for the
+    requested outputs are run: the pretrained model is skipped unless `car_mask` is requested
+    and the trained model is skipped if only `car_mask` is requested.
+
     Parameters
     ----------
-    input_object : np.ndarray
-        input image
-    predictor : DefaultPredictor
-        Detectron2 default predictor (see Detectron2 documentation for details)
+    input_object : Mapping
+        parsed request returned by `input_fn`
+    models : Mapping
+        model registry returned by `model_fn`
 
     Returns
     -------
-    Mapping
-        a dictionary that contains: the image shape (`image_height`, `image_width`), the predicted
-        bounding boxes in format x1y1x2y2 (`pred_boxes`), the confidence scores (`scores`) and the
-        labels associated with the bounding boxes (`pred_boxes`)
+    Mapping or List[Mapping]
+        for each image a dictionary that contains the image shape (`image_height`, `image_width`)
+        and, if requested, the predicted bounding boxes in format x1y1x2y2 (`pred_boxes`, float32
+        array), the confidence scores (`scores`, float32 array), the labels associated with the
+        bounding boxes (`pred_classes`, int32 array),
+        the encoded instance masks (`pred_masks`) and the encoded mask of the main car (`car_mask`),
+        see `mask_encoding.encode_mask`. Batch requests return a list with one dictionary per image,
+        in request order.
     """
-    logger.info(f"Prediction on image of shape {input_object.shape}")
-    pretrained_predictor = _get_pretraind_model()
-    car_mask = get_main_car_mask(pretrained_predictor, input_object)
-    outputs = predictor(input_object)
-    logger.info(f"Car Mask {car_mask}")
-    fmt_out = {
-        "image_height": input_object.shape[0],
-        "image_width": input_object.shape[1],
-        "pred_boxes": outputs["instances"].pred_boxes.tensor.tolist(),
-        "scores": outputs["instances"].scores.tolist(),
-        "pred_classes": outputs["instances"].pred_classes.tolist(),
-        "car_mask": car_mask.tolist()
-    }
-    logger.info(f"Number of detected boxes: {len(fmt_out['pred_boxes'])}")
-    return fmt_out
+    np_images = input_object["images"]
+    original_sizes = input_object["original_sizes"]
+    requested = input_object["outputs"]
+    mask_format = input_object["mask_format"]
+    logger.info(f"Prediction of {requested} on {len(np_images)} image(s) of shape {[np_image.shape for np_image in np_images]}")
+
+    predictions = [{"image_height": height, "image_width": width} for height, width in original_sizes]
+    # Scale factors from the decoded images back to the original images, (1, 1) unless decoded at reduced size
+    box_scales = [
+        np.array([width / np_image.shape[1], height / np_image.shape[0]] * 2, dtype=np.float32)
+        for np_image, (height, width) in zip(np_images, original_sizes)
+    ]
+
+    if OUTPUT_CAR_MASK in requested:
+        seg_outputs = _run_batched(models["pretrained"], np_images)
+        for prediction, seg_output, original_size in zip(predictions, seg_outputs, original_sizes):
+            car_mask = _rescale_mask(get_main_car_mask(seg_output["instances"]), original_size)
+            prediction["car_mask"] = encode_mask(car_mask, mask_format)
+
+    if any(output in requested for output in TRAINED_MODEL_OUTPUTS):
+        outputs = _run_batched(models["trained"], np_images)
+        for prediction, output, original_size, box_scale in zip(predictions, outputs, original_sizes, box_scales):
+            instances = output["instances"]
+            if OUTPUT_BOXES in requested:
+                prediction["pred_boxes"] = instances.pred_boxes.tensor.cpu().numpy().astype(np.float32) * box_scale
+            if OUTPUT_SCORES in requested:
+                prediction["scores"] = instances.scores.cpu().numpy().astype(np.float32)
+            if OUTPUT_CLASSES in requested:
+                prediction["pred_classes"] = instances.pred_classes.cpu().numpy().astype(np.int32)
+            if OUTPUT_MASKS in requested:
+                prediction["pred_masks"] = [
+                    encode_mask(_rescale_mask(mask, original_size), mask_format) for mask in instances.pred_masks.cpu().numpy()
+                ]
+            logger.info(f"Number of detected instances: {len(instances)}")
+
+    return predictions if input_object["batch"] else predictions[0]
 
 
 def output_fn(predictions, response_content_type):
-    r"""Serialize the prediction result into the desired response content type"""
-    return json.dumps(predictions)
+    r"""Serialize the prediction result into the desired response content type
+
+    Parameters
+    ----------
+    predictions : Mapping or List[Mapping]
+        predictions returned by `predict_fn`
+    response_content_type : str
+        accepted content type of the response: `application/json` (default, also used for `*/*`)
+        or `application/x-npz` (typed arrays, see `serialization.to_npz`)
+
+    Returns
+    -------
+    str or bytes
+        serialized predictions
+
+    Raises
+    ------
+    ValueError
+        ValueError if none of the accepted content types is supported
+    """
+    for accept in (response_content_type or JSON_CONTENT_TYPE).split(","):
+        media_type, _ = _parse_content_type(accept)
+        if media_type in ("*/*", "application/*"):
+            media_type = JSON_CONTENT_TYPE
+        if media_type in CONTENT_TYPES:
+            return serialize(predictions, media_type)
+    err_msg = f"Accept [{response_content_type}] not supported, use one of {CONTENT_TYPES}"
+    logger.error(err_msg)
+    raise ValueError(err_msg)
@@ -0,0 +1,63 @@
+from typing import List, Mapping, Union
+import io
+import json
+
+import numpy as np
+
+
+JSON_CONTENT_TYPE = "application/json"
+NPZ_CONTENT_TYPE = "application/x-npz"
+CONTENT_TYPES = (JSON_CONTENT_TYPE, NPZ_CONTENT_TYPE)
+# Key of the JSON document holding the fields of a prediction that are not arrays (image size, encoded masks)
+NPZ_META_KEY = "meta"
+NPZ_BATCH_SIZE_KEY = "batch_size"
+
+Predictions = Union[Mapping, List[Mapping]]
+
+
+def _to_builtin(prediction: Mapping) -> Mapping:
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in prediction.items()}
+
+
+def to_json(predictions: Predictions) -> str:
+    """Serialize one prediction or a list of predictions into JSON, arrays become nested lists"""
+    if isinstance(predictions, list):
+        return json.dumps([_to_builtin(prediction) for prediction in predictions])
+    return json.dumps(_to_builtin(predictions))
+
+
+def _npz_arrays(prediction: Mapping, prefix: str = "") -> Mapping:
+    arrays = {prefix + key: value for key, value in prediction.items() if isinstance(value, np.ndarray)}
+    meta = {key: value for key, value in prediction.items() if not isinstance(value, np.ndarray)}
+    arrays[prefix + NPZ_META_KEY] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+    return arrays
+
+
+def to_npz(predictions: Predictions) -> bytes:
+    """Serialize one prediction or a list of predictions into an uncompressed `.npz` archive
+
+    Arrays (`pred_boxes` as float32, `scores` as float32, `pred_classes` as int32) are stored
+    as typed arrays under their name, the remaining fields as a UTF-8 encoded JSON document
+    under `meta`. For a list of predictions the keys are prefixed with the index of the
+    image, e.g. `0/pred_boxes`, and the number of images is stored under `batch_size`.
+    """
+    if isinstance(predictions, list):
+        arrays = {NPZ_BATCH_SIZE_KEY: np.array(len(predictions), dtype=np.int32)}
+        for index, prediction in enumerate(predictions):
+            arrays.update(_npz_arrays(prediction, prefix=f"{index}/"))
+    else:
+        arrays = _npz_arrays(predictions)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+_SERIALIZERS = {
+    JSON_CONTENT_TYPE: to_json,
+    NPZ_CONTENT_TYPE: to_npz,
+}
+
+
+def serialize(predictions: Predictions, content_type: str) -> Union[str, bytes]:
+    """Serialize predictions into one of `CONTENT_TYPES`"""
+    return _SERIALIZERS[content_type](predictions)
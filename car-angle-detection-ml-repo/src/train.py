@@ -8,6 +8,8 @@ setup_logger()
 import os
 import sys
 import argparse
+import json
+import tempfile
 import yaml
 
 # import some common detectron2 utilities
@@ -17,18 +19,60 @@ from detectron2.config import get_cfg
 from detectron2.data.datasets import register_coco_instances
 import logging
 
+from coco_columnar import matches_source, register_columnar_coco
+from data_loading import build_cached_train_loader
+from export_cpu import export_cpu_model
+from fast_model import PRETRAINED_FAST_MODEL_FILE, export_fast_model
+from image_cache import build_image_cache, cache_matches
+from training_profiler import AUTOTUNE_FILE, ThroughputProfiler, apply_batch_size, autotune_data_loader
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
+TINY_MAX_ITER = 20
+
+
+class CachedImageTrainer(DefaultTrainer):
+    """DefaultTrainer reading the training images from the pre-decoded cache in `image_cache_dir`"""
+    image_cache_dir = None
+
+    @classmethod
+    def build_train_loader(cls, cfg):
+        return build_cached_train_loader(cfg, cls.image_cache_dir)
+
+
+def register_dataset(name, data_dir):
+    # the columnar annotations written by coco_columnar.py load without parsing the JSON,
+    # unless the JSON next to them changed since they were converted
+    columnar_file, json_file = f"{data_dir}/annotations.npz", f"{data_dir}/annotations.json"
+    if os.path.exists(columnar_file):
+        if not os.path.exists(json_file) or matches_source(columnar_file, json_file):
+            register_columnar_coco(name, columnar_file, data_dir)
+            return
+        logger.warning(f'{columnar_file} was not converted from {json_file}, using the JSON annotations.')
+    register_coco_instances(name, {}, json_file, data_dir)
+
+
+def export_pretrained_model(args, output_dir):
+    """
+    Export the pretrained COCO model used for the car mask as an fp16 single-file artifact, so that the
+    endpoint does not download it from the model zoo. The endpoint falls back to the download if this fails.
+    """
+    pretrained_cfg = get_cfg()
+    pretrained_cfg.merge_from_file(model_zoo.get_config_file(args.coco_config_file))
+    pretrained_cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url(args.coco_model_checkpoint)
+    try:
+        export_fast_model(pretrained_cfg, output_dir, PRETRAINED_FAST_MODEL_FILE)
+    except Exception:
+        logger.exception('Could not export the pretrained model, the endpoint will download it from the model zoo.')
+
 
 def train(args):
     logger.info('train_dir')
     logger.info(args.train_data_dir)
-    register_coco_instances("train_dataset", {}, f"{args.train_data_dir}/annotations.json",
-                            f"{args.train_data_dir}")
-    register_coco_instances("valid_dataset", {}, f"{args.val_data_dir}/annotations.json",
-                            f"{args.val_data_dir}")
+    register_dataset("train_dataset", args.train_data_dir)
+    register_dataset("valid_dataset", args.val_data_dir)
 
     cfg = get_cfg()
     cfg.merge_from_file(model_zoo.get_config_file(args.coco_config_file))
@@ -43,22 +87,69 @@ def train(args):
     cfg.SOLVER.STEPS = args.steps
     cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = args.batch_size_per_img
     cfg.MODEL.ROI_HEADS.NUM_CLASSES = args.num_classes
-    cfg.OUTPUT_DIR = '/opt/ml/model'
-    trainer = DefaultTrainer(cfg)
+    cfg.OUTPUT_DIR = args.output_dir
+    if args.tiny:
+        # small inputs, random weights and a few iterations on CPU, to test training anywhere in seconds
+        cfg.MODEL.DEVICE = "cpu"
+        cfg.MODEL.WEIGHTS = ""
+        cfg.DATALOADER.NUM_WORKERS = 0
+        cfg.INPUT.MIN_SIZE_TRAIN = (128,)
+        cfg.INPUT.MAX_SIZE_TRAIN = 224
+        cfg.MODEL.RPN.BATCH_SIZE_PER_IMAGE = 32
+        cfg.MODEL.RPN.POST_NMS_TOPK_TRAIN = 100
+        cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 32
+        cfg.SOLVER.MAX_ITER = min(cfg.SOLVER.MAX_ITER, TINY_MAX_ITER)
+        cfg.SOLVER.STEPS = ()
+        cfg.SOLVER.WARMUP_ITERS = 0
+    os.makedirs(cfg.OUTPUT_DIR, exist_ok=True)
+
+    trainer_class = DefaultTrainer
+    if args.image_cache_dir:
+        # decode and resize the training images once instead of at every epoch
+        # rebuilt when the annotations or the training sizes changed since it was built
+        annotations_file = f"{args.train_data_dir}/annotations.json"
+        min_size, max_size = max(cfg.INPUT.MIN_SIZE_TRAIN), cfg.INPUT.MAX_SIZE_TRAIN
+        if not cache_matches(args.image_cache_dir, annotations_file, min_size, max_size):
+            stats = build_image_cache(annotations_file, args.train_data_dir, args.image_cache_dir,
+                                      min_size=min_size, max_size=max_size)
+            logger.info(f'Image cache built in {args.image_cache_dir}: {stats}')
+        CachedImageTrainer.image_cache_dir = args.image_cache_dir
+        trainer_class = CachedImageTrainer
+    if args.autotune:
+        results = autotune_data_loader(cfg, trainer_class.build_train_loader,
+                                       num_workers=[int(value) for value in args.autotune_workers.split(",")],
+                                       ims_per_batch=[int(value) for value in args.autotune_batch_sizes.split(",")])
+        with open(f'{cfg.OUTPUT_DIR}/{AUTOTUNE_FILE}', 'w') as file:
+            json.dump(results, file, indent=2)
+        best = results["best"]
+        if best is not None:
+            logger.info(f'Autotune picked {best["num_workers"]} workers and {best["ims_per_batch"]} images per batch.')
+            cfg.DATALOADER.NUM_WORKERS = best["num_workers"]
+            apply_batch_size(cfg, best["ims_per_batch"])
+    trainer = trainer_class(cfg)
+    # per iteration data and compute time, images/sec and peak memory in throughput.json
+    trainer.register_hooks([ThroughputProfiler(cfg.OUTPUT_DIR, cfg.SOLVER.IMS_PER_BATCH)])
     trainer.resume_or_load(resume=False)
     trainer.train()
     config_dict = yaml.safe_load(cfg.dump())
     # save the config file needed to load the trained model during inference
     with open(f'{cfg.OUTPUT_DIR}/config.yaml', 'w') as file:
         documents = yaml.dump(config_dict, file)
+    # export an int8 quantized model used by the endpoint when no GPU is available
+    cfg.MODEL.WEIGHTS = os.path.join(cfg.OUTPUT_DIR, "model_final.pth")
+    export_cpu_model(cfg, cfg.OUTPUT_DIR)
+    # export an fp16 single-file artifact of the trained model, which the endpoint loads with one memory-mapped read
+    export_fast_model(cfg, cfg.OUTPUT_DIR)
+    if not args.tiny:
+        export_pretrained_model(args, cfg.OUTPUT_DIR)
     logger.info(f'Model trained successfully and artefacts stored at {cfg.OUTPUT_DIR}.')
 
-if __name__ == "__main__":
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--train-data-dir", type=str,
-                        default=os.environ["SM_CHANNEL_TRAINING"])
+                        default=os.environ.get("SM_CHANNEL_TRAINING"))
     parser.add_argument("--val-data-dir", type=str,
-                        default=os.environ["SM_CHANNEL_VALIDATION"])
+                        default=os.environ.get("SM_CHANNEL_VALIDATION"))
     parser.add_argument("--model-device", type=str,
                         default="cuda")
     parser.add_argument("--num-workers", type=int,
@@ -79,4 +170,29 @@ if __name__ == "__main__":
                         default="COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml")
     parser.add_argument("--coco-model-checkpoint", type=str,
                         default="COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml")
-    train(parser.parse_args())
+    # defaults to SM_MODEL_DIR, or a temporary directory with --tiny
+    parser.add_argument("--output-dir", type=str,
+                        default=None)
+    # try worker counts and batch sizes for a few iterations and train with the fastest stable ones
+    parser.add_argument("--autotune", action="store_true")
+    parser.add_argument("--autotune-workers", type=str,
+                        default="2,4,8")
+    parser.add_argument("--autotune-batch-sizes", type=str,
+                        default="2,4,8")
+    # small CPU run writing to temporary directories unless --output-dir and --image-cache-dir are given
+    parser.add_argument("--tiny", action="store_true")
+    # empty to decode the image files at every epoch, defaults to /opt/ml/input/image_cache
+    parser.add_argument("--image-cache-dir", type=str,
+                        default=None)
+    args = parser.parse_args(argv)
+
+    tiny_dir = tempfile.mkdtemp(prefix="tiny_train_") if args.tiny else None
+    if args.output_dir is None:
+        args.output_dir = os.path.join(tiny_dir, "model") if args.tiny else os.environ.get("SM_MODEL_DIR", "/opt/ml/model")
+    if args.image_cache_dir is None:
+        args.image_cache_dir = os.path.join(tiny_dir, "image_cache") if args.tiny else "/opt/ml/input/image_cache"
+    return args
+
+
+if __name__ == "__main__":
+    train(parse_args())
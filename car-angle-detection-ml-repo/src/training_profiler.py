@@ -0,0 +1,209 @@
+"""Where the time of training goes, and the data loader settings that make it fastest
+
+`ThroughputProfiler` is a trainer hook that records for each iteration the time waiting for the
+batch (the `data_time` the trainer measures), the forward/backward/optimizer time, images per
+second and peak memory, written as JSON to `OUTPUT_DIR` at the end of training.
+
+`autotune_data_loader` runs a few iterations of each combination of `DATALOADER.NUM_WORKERS` and
+`SOLVER.IMS_PER_BATCH` and returns the fastest one that ran without running out of memory and with
+steady iteration times. `apply_batch_size` scales the learning rate and the schedule to a new batch
+size, keeping the number of epochs.
+"""
+import itertools
+import json
+import logging
+import os
+import resource
+import statistics
+import time
+from typing import Callable, Dict, List, Sequence
+
+import torch
+from detectron2.engine import HookBase
+from detectron2.modeling import build_model
+from detectron2.utils import comm
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FILE = "throughput.json"
+AUTOTUNE_FILE = "autotune.json"
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {
+        "mean_ms": statistics.mean(values) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+    }
+
+
+def _peak_memory() -> Dict[str, float]:
+    # ru_maxrss is in kilobytes on Linux
+    memory = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if torch.cuda.is_available():
+        memory["peak_gpu_allocated_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        memory["peak_gpu_reserved_mb"] = torch.cuda.max_memory_reserved() / 2**20
+    return memory
+
+
+class ThroughputProfiler(HookBase):
+    """
+    Records data wait and compute time per iteration and writes them with a summary to
+    `output_dir/throughput.json`. The first `warmup` iterations (worker start, CUDA initialization)
+    are left out of the summary.
+
+    The step time is the time of the trainer's `run_step` only, which the hook wraps for the
+    duration of training, so the other hooks (checkpoints, evaluation, writers) are not counted
+    whatever the position of this hook.
+    """
+
+    def __init__(self, output_dir: str, ims_per_batch: int, warmup: int = 20):
+        self.output_file = os.path.join(output_dir, PROFILE_FILE)
+        self.ims_per_batch = ims_per_batch
+        self.warmup = warmup
+        self.iterations = []
+        self._step_time = None
+
+    def before_train(self):
+        run_step = self.trainer.run_step
+
+        def timed_run_step():
+            start = time.perf_counter()
+            try:
+                run_step()
+            finally:
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                self._step_time = time.perf_counter() - start
+
+        self.trainer.run_step = timed_run_step
+
+    def after_step(self):
+        step_time = self._step_time
+        # Put by the trainer in the main process only
+        data_time = self.trainer.storage.history("data_time").latest() if "data_time" in self.trainer.storage.histories() else 0.0
+        self.iterations.append({
+            "iter": self.trainer.iter,
+            "data_time_s": data_time,
+            "compute_time_s": step_time - data_time,
+            "step_time_s": step_time,
+        })
+
+    def after_train(self):
+        # Back to the method of the class
+        del self.trainer.run_step
+        if not comm.is_main_process():
+            return
+        measured = self.iterations[self.warmup:] or self.iterations
+        data_times = [iteration["data_time_s"] for iteration in measured]
+        compute_times = [iteration["compute_time_s"] for iteration in measured]
+        step_times = [iteration["step_time_s"] for iteration in measured]
+        total = sum(step_times)
+        summary = {
+            "iterations": len(measured),
+            "ims_per_batch": self.ims_per_batch,
+            "data_time": _summary(data_times),
+            "compute_time": _summary(compute_times),
+            "images_per_s": len(measured) * self.ims_per_batch * comm.get_world_size() / total if total else None,
+            "data_share": sum(data_times) / total if total else None,
+            **_peak_memory(),
+        }
+        logger.info(f"Training throughput: {summary}")
+        with open(self.output_file, "w") as file:
+            json.dump({"summary": summary, "per_iteration": self.iterations}, file)
+
+
+def _time_iterations(model, optimizer, loader, num_iters: int, warmup: int) -> List[float]:
+    """Step times of `num_iters` iterations after `warmup` ones, data loading included"""
+    times = []
+    iterator = iter(loader)
+    try:
+        for i in range(warmup + num_iters):
+            start = time.perf_counter()
+            losses = sum(model(next(iterator)).values())
+            optimizer.zero_grad()
+            losses.backward()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    finally:
+        # Stops the worker processes
+        del iterator
+    return times
+
+
+def autotune_data_loader(cfg, build_train_loader: Callable, num_workers: Sequence[int] = (2, 4, 8),
+                         ims_per_batch: Sequence[int] = (2, 4, 8), num_iters: int = 20, warmup: int = 5,
+                         max_variation: float = 0.25, max_memory_share: float = 0.9) -> Dict:
+    """
+    Time each combination of worker count and batch size on a model of `cfg` and return the
+    results with the fastest stable setting as `best` (None if none is stable).
+
+    A setting is stable if it does not run out of memory, its peak GPU memory stays under
+    `max_memory_share` of the device memory and the coefficient of variation of its iteration
+    times is under `max_variation`. The weights are not updated.
+    """
+    model = build_model(cfg)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    total_memory = torch.cuda.get_device_properties(0).total_memory if torch.cuda.is_available() else None
+
+    trials = []
+    for workers, batch in itertools.product(num_workers, ims_per_batch):
+        trial_cfg = cfg.clone()
+        trial_cfg.defrost()
+        trial_cfg.DATALOADER.NUM_WORKERS = workers
+        trial_cfg.SOLVER.IMS_PER_BATCH = batch
+        trial = {"num_workers": workers, "ims_per_batch": batch}
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            times = _time_iterations(model, optimizer, build_train_loader(trial_cfg), num_iters, warmup)
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            optimizer.zero_grad()
+            torch.cuda.empty_cache()
+            trial.update(stable=False, error="out of memory")
+            trials.append(trial)
+            logger.info(f"Autotune: {trial}")
+            continue
+
+        mean = statistics.mean(times)
+        variation = statistics.stdev(times) / mean if len(times) > 1 else 0.0
+        memory_share = torch.cuda.max_memory_allocated() / total_memory if total_memory else None
+        trial.update(
+            images_per_s=batch / mean,
+            step_ms=mean * 1000,
+            variation=variation,
+            memory_share=memory_share,
+            stable=variation <= max_variation and (memory_share is None or memory_share <= max_memory_share),
+        )
+        trials.append(trial)
+        logger.info(f"Autotune: {trial}")
+
+    del model, optimizer
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    stable = [trial for trial in trials if trial["stable"]]
+    return {"trials": trials, "best": max(stable, key=lambda trial: trial["images_per_s"]) if stable else None}
+
+
+def apply_batch_size(cfg, ims_per_batch: int):
+    """
+    Set `SOLVER.IMS_PER_BATCH`, scaling the learning rate linearly and the iterations inversely
+    so that training sees as many epochs as before.
+    """
+    scale = ims_per_batch / cfg.SOLVER.IMS_PER_BATCH
+    if scale == 1:
+        return
+    cfg.SOLVER.BASE_LR *= scale
+    cfg.SOLVER.MAX_ITER = int(round(cfg.SOLVER.MAX_ITER / scale))
+    cfg.SOLVER.STEPS = tuple(int(round(step / scale)) for step in cfg.SOLVER.STEPS)
+    cfg.SOLVER.WARMUP_ITERS = int(round(cfg.SOLVER.WARMUP_ITERS / scale))
+    cfg.SOLVER.CHECKPOINT_PERIOD = max(1, int(round(cfg.SOLVER.CHECKPOINT_PERIOD / scale)))
+    cfg.SOLVER.IMS_PER_BATCH = ims_per_batch
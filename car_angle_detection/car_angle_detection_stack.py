@@ -227,9 +227,11 @@ class CarAngleDetectionStack(Stack):
         # Defines an AWS Lambda resource
         rekognition_lambda = _lambda.DockerImageFunction(
             self, 'RekognitionLambda',
-            code=_lambda.DockerImageCode.from_image_asset("lambda/rekognition_car_angle_detection/"),
+            code=_lambda.DockerImageCode.from_image_asset("lambda/", file="rekognition_car_angle_detection/Dockerfile"),
             environment={
                 'BUCKET': bucket.bucket_name,
+                # Second tier of the detection result cache, the first tier is in memory
+                'RESULT_CACHE_DIR': "/tmp/result-cache",
             },
             timeout=Duration.seconds(60),
         )
@@ -241,15 +243,43 @@ class CarAngleDetectionStack(Stack):
         rekognition_lambda.add_to_role_policy(
             statement=detect_rekognition_policy)
 
+        # Read images referenced by S3 key and write the annotated results back
+        bucket.grant_read_write(rekognition_lambda)
+
+        # Bulk angle detection of many images in the bucket, same image as the Rekognition Lambda
+        rekognition_bulk_lambda = _lambda.DockerImageFunction(
+            self, 'RekognitionBulkLambda',
+            code=_lambda.DockerImageCode.from_image_asset("lambda/", file="rekognition_car_angle_detection/Dockerfile",
+                                                          cmd=["bulk.lambda_handler"]),
+            environment={
+                'BUCKET': bucket.bucket_name,
+                # Number of images processed concurrently, bounded by the Rekognition TPS quota
+                'BULK_MAX_WORKERS': "16",
+            },
+            memory_size=1024,
+            timeout=Duration.minutes(15),
+        )
+
+        rekognition_bulk_lambda.add_to_role_policy(
+            statement=detect_rekognition_policy)
+
+        bucket.grant_read_write(rekognition_bulk_lambda)
+
         # Defines an AWS Lambda resource
         detectron_lambda = _lambda.DockerImageFunction(
             self, 'DetectronLambda',
-            code=_lambda.DockerImageCode.from_image_asset("lambda/detectron_car_angle_detection/"),
+            code=_lambda.DockerImageCode.from_image_asset("lambda/", file="detectron_car_angle_detection/Dockerfile"),
             environment={
                 'BUCKET': bucket.bucket_name,
                 # ENDPOINT_NAME has to be the same as in car-angle-detection-ml-repo/car_angle_train.py
-                'ENDPOINT_NAME': "detectron-endpoint"
+                'ENDPOINT_NAME': "detectron-endpoint",
+                # Longest image side sent to the endpoint, larger uploads are downscaled by the Lambda
+                'MAX_IMAGE_SIDE': "1333",
+                # Video requests: frames per second sent to the endpoint at most
+                'VIDEO_MAX_FPS': "5"
             },
+            # Videos are decoded frame by frame in the function
+            memory_size=1024,
             timeout=Duration.seconds(60),
         )
 
@@ -260,6 +290,28 @@ class CarAngleDetectionStack(Stack):
         detectron_lambda.add_to_role_policy(
             statement=detect_detectron_policy)
 
+        bucket.grant_read_write(detectron_lambda)
+
+        # Single entry point: Rekognition first, Detectron only when the Rekognition result is unusable
+        router_lambda = _lambda.DockerImageFunction(
+            self, 'RouterLambda',
+            code=_lambda.DockerImageCode.from_image_asset("lambda/", file="car_angle_router/Dockerfile"),
+            environment={
+                'BUCKET': bucket.bucket_name,
+                'RESULT_CACHE_DIR': "/tmp/result-cache",
+                'ENDPOINT_NAME': "detectron-endpoint",
+                'MAX_IMAGE_SIDE': "1333"
+            },
+            timeout=Duration.seconds(60),
+        )
+
+        router_lambda.add_to_role_policy(
+            statement=detect_rekognition_policy)
+        router_lambda.add_to_role_policy(
+            statement=detect_detectron_policy)
+
+        bucket.grant_read_write(router_lambda)
+
         api_rekognition = _apigateway.RestApi(self, "rekognition-api",
                   rest_api_name="Car Angle Rekognition Service",
                   description="This service serves predictions.")
@@ -273,3 +325,10 @@ class CarAngleDetectionStack(Stack):
         get_detectron_integration = _apigateway.LambdaIntegration(detectron_lambda,
                 request_templates={"application/json": '{ "statusCode": "200" }'})
         api_detectron.root.add_method("POST", get_detectron_integration)
+
+        api_router = _apigateway.RestApi(self, "router-api",
+                  rest_api_name="Car Angle Router Service",
+                  description="This service serves predictions, escalating from Rekognition to detectron when needed.")
+        get_router_integration = _apigateway.LambdaIntegration(router_lambda,
+                request_templates={"application/json": '{ "statusCode": "200" }'})
+        api_router.root.add_method("POST", get_router_integration)
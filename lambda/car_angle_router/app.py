@@ -0,0 +1,107 @@
+import json
+from io import BytesIO
+
+from PIL import Image
+
+import detectron_app
+import rekognition_app
+from image_io import image_response_fields, read_request_image
+from metrics import BYTES, InvocationMetrics
+
+TIER_REKOGNITION = "rekognition"
+TIER_DETECTRON = "detectron"
+
+# Survives warm invocations, logged with the metrics of each request so that the share of escalated
+# requests and the latency of each tier can be followed in the logs
+tier_stats = {
+    tier: {"requests": 0, "resolved": 0, "total_ms": 0.0}
+    for tier in (TIER_REKOGNITION, TIER_DETECTRON)
+}
+
+
+def _record(tier, metrics, resolved):
+    stats = tier_stats[tier]
+    stats["requests"] += 1
+    stats["resolved"] += int(resolved)
+    stats["total_ms"] += metrics.values[f"{tier}_ms"]
+
+
+def rekognition_tier(request, body_bytes):
+    """
+    Cheap first tier: Rekognition default labels and the angle between the wheel centers.
+
+    Returns the car and wheel boxes, the angle, the wheel centers of the reference vector and
+    the reason why the angle could not be computed (None if it could).
+    """
+    car_bbs, wheel_bbs = rekognition_app.detect_cars_and_wheels(request, body_bytes)
+    # Only the image size is needed, the image is not decoded
+    img = Image.open(BytesIO(body_bytes))
+    angle, wheel_centers_rel, message = rekognition_app.car_angle_from_detections(car_bbs, wheel_bbs, img)
+    return car_bbs, wheel_bbs, angle, wheel_centers_rel, message
+
+
+def needs_escalation(message):
+    """
+    Whether the Rekognition result is unusable: it found too many cars or not 2 or 3 wheels.
+    """
+    return message is not None
+
+
+def lambda_handler(event, context):
+    metrics = InvocationMetrics("router")
+    request = json.loads(event["body"])
+    with metrics.stage("read_image"):
+        body_bytes = read_request_image(request, rekognition_app.s3, rekognition_app.BUCKET)
+    metrics.put("image_bytes", len(body_bytes), BYTES)
+    render = request.get("render", True)
+
+    # Only Detectron detects the view (front, back, side), Rekognition would be paid for nothing
+    view_requested = bool(request.get("view", False))
+    metrics.put("view_requested", int(view_requested))
+    if view_requested:
+        escalate, message = True, "view requested"
+    else:
+        with metrics.stage(TIER_REKOGNITION):
+            car_bbs, wheel_bbs, angle, wheel_centers_rel, message = rekognition_tier(request, body_bytes)
+        escalate = needs_escalation(message)
+        _record(TIER_REKOGNITION, metrics, resolved=not escalate)
+    metrics.put("escalated", int(escalate and not view_requested))
+
+    if not escalate:
+        tier = TIER_REKOGNITION
+        if render:
+            angle, img = rekognition_app.label_image(img_string=body_bytes, car_bbs=car_bbs, wheel_bbs=wheel_bbs)
+            body = {**image_response_fields(img, request, rekognition_app.s3, rekognition_app.BUCKET), "angle": angle}
+        else:
+            body = rekognition_app.geometry_fields(img_string=body_bytes, car_bbs=car_bbs, wheel_bbs=wheel_bbs)
+    else:
+        tier = TIER_DETECTRON
+        print(f"Running Detectron: {message}")
+        with metrics.stage(TIER_DETECTRON):
+            result = detectron_app.predict_boxes(body_bytes, metrics)
+            view, angle, wheel_centers_rel = detectron_app.car_angle_from_bbs(result)
+        _record(TIER_DETECTRON, metrics, resolved=angle is not None)
+        if render:
+            img = detectron_app.label_image(img_string=body_bytes, wheel_centers_rel=wheel_centers_rel)
+            body = {
+                **image_response_fields(img, request, detectron_app.s3, detectron_app.BUCKET),
+                "view": None if view is None else view.value,
+                "angle": angle
+            }
+        else:
+            body = detectron_app.geometry_fields(result, view, angle, wheel_centers_rel)
+
+    body["tier"] = tier
+    metrics.set_property("tier", tier)
+    metrics.set_property("tier_stats", tier_stats)
+    metrics.flush()
+
+    return {
+        'statusCode': 200,
+        "headers": {
+            "Access-Control-Allow-Origin": event["headers"]["origin"],
+            "Access-Control-Allow-Headers": "Content-Type",
+            "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
+        },
+        'body': json.dumps(body)
+    }
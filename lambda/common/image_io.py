@@ -0,0 +1,58 @@
+import base64
+import os
+import posixpath
+from io import BytesIO
+
+# Prefix of the annotated images written back to the bucket in S3 mode
+RESULT_PREFIX = os.environ.get("RESULT_PREFIX", "results/")
+PRESIGNED_URL_EXPIRY = int(os.environ.get("PRESIGNED_URL_EXPIRY", 3600))
+
+
+def is_s3_request(request):
+    """
+    Whether a request body names an object in the stack's bucket (`{"s3_key": ...}`)
+    instead of carrying the image as a base64 data URL (`{"image": ...}`).
+    """
+    return "s3_key" in request
+
+
+def read_request_image(request, s3, bucket):
+    """
+    Return the encoded image of a request, downloaded from `bucket` in S3 mode.
+    """
+    if is_s3_request(request):
+        return s3.get_object(Bucket=bucket, Key=request["s3_key"])["Body"].read()
+    return base64.b64decode(request["image"].split(",")[-1])
+
+
+def result_key(s3_key):
+    """
+    Key of the annotated image for the input image stored at `s3_key`.
+    """
+    return RESULT_PREFIX + posixpath.splitext(s3_key)[0] + ".jpg"
+
+
+def encode_jpeg(img):
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def image_response_fields(img, request, s3, bucket):
+    """
+    Return the fields of the response body that carry the annotated image.
+
+    In S3 mode the image is written to `result_key` in `bucket` and returned as
+    a presigned URL (`image_url`, `result_key`), otherwise it is inlined as a
+    base64 data URL (`image`).
+    """
+    img_bytes = encode_jpeg(img)
+    if not is_s3_request(request):
+        return {"image": "data:image/jpeg;base64," + base64.b64encode(img_bytes).decode('utf-8')}
+
+    key = result_key(request["s3_key"])
+    s3.put_object(Bucket=bucket, Key=key, Body=img_bytes, ContentType="image/jpeg")
+    url = s3.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=PRESIGNED_URL_EXPIRY
+    )
+    return {"image_url": url, "result_key": key}
@@ -0,0 +1,88 @@
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+
+# See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CarAngleDetection")
+# Share of warm invocations that emit their metrics, cold starts are always emitted
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", 1.0))
+
+MILLISECONDS = "Milliseconds"
+BYTES = "Bytes"
+COUNT = "Count"
+
+# True until the first invocation of the execution environment has created its metrics
+_cold_start = True
+
+
+class InvocationMetrics:
+    """
+    Metrics of one invocation of a Lambda handler, emitted as one CloudWatch Embedded Metric Format
+    log line by `flush`.
+
+    Stages are timed with `with metrics.stage("name"):` and recorded as `<name>_ms`, other values
+    (payload sizes, box counts) with `put`. Values recorded once per item of a request (the frames
+    of a video) are summed with `add` and `stage(name, accumulate=True)` instead of overwritten.
+    The `Service` dimension tells the handlers apart.
+    Properties are logged with the metrics but are not metrics themselves.
+    """
+
+    def __init__(self, service, namespace=METRICS_NAMESPACE, sample_rate=METRICS_SAMPLE_RATE):
+        global _cold_start
+        self.service = service
+        self.namespace = namespace
+        self.cold_start = _cold_start
+        _cold_start = False
+        self.sampled = self.cold_start or random.random() < sample_rate
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+        self._start = time.perf_counter()
+        self.put("ColdStart", int(self.cold_start))
+
+    def put(self, name, value, unit=COUNT):
+        self.values[name] = value
+        self.units[name] = unit
+
+    def add(self, name, value, unit=COUNT):
+        self.put(name, self.values.get(name, 0) + value, unit)
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    @contextmanager
+    def stage(self, name, accumulate=False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.add if accumulate else self.put
+            record(f"{name}_ms", (time.perf_counter() - start) * 1000, MILLISECONDS)
+
+    def to_emf(self):
+        """
+        Embedded Metric Format document of the metrics recorded so far, with the total duration.
+        """
+        self.put("total_ms", (time.perf_counter() - self._start) * 1000, MILLISECONDS)
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [["Service"]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in self.units.items()],
+                }],
+            },
+            "Service": self.service,
+            **self.properties,
+            **self.values,
+        }
+
+    def flush(self):
+        """
+        Print the metrics as one log line if this invocation is sampled, CloudWatch extracts them from the logs.
+        """
+        if self.sampled:
+            print(json.dumps(self.to_emf()))
@@ -0,0 +1,119 @@
+"""Angle of a car from the bounding boxes of its wheels, for one image or a batch of images
+
+The reference vector joins the centers of two wheels: of all pairs of wheels (in the order of
+`itertools.combinations`), sorted by the distance between their centers, the second shortest
+is taken for 3 wheels (usually 2 front wheels and 1 rear wheel) and the shortest otherwise.
+The angle is the one between this vector and the horizontal of the image, in degrees.
+
+A batch is packed into one array of box points of all images, `points[offsets[i]:offsets[i + 1]]`
+being the boxes of image i. Images are grouped by number of wheels so that each group is
+computed with array operations, and per-image results are identical to a loop over the images.
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+
+
+def rekognition_box_points(boxes, image_size):
+    """
+    Points of boxes as returned by Rekognition, relative (Left, Top, Width, Height) rows of `boxes`,
+    in pixels of images of `image_size` (width, height), or one size per box. The outline is closed,
+    the top left corner comes twice, which the center of the box is the mean of.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    image_size = np.asarray(image_size, dtype=np.float64)
+    width, height = image_size[..., 0], image_size[..., 1]
+    left, top = width * boxes[:, 0], height * boxes[:, 1]
+    right, bottom = left + width * boxes[:, 2], top + height * boxes[:, 3]
+    points = np.empty((len(boxes), 5, 2))
+    points[:, [0, 3, 4], 0] = left[:, None]
+    points[:, [1, 2], 0] = right[:, None]
+    points[:, [0, 1, 4], 1] = top[:, None]
+    points[:, [2, 3], 1] = bottom[:, None]
+    return points
+
+
+# Columns of (x1, y1, x2, y2) giving the corners (x1, y1), (x2, y1), (x1, y2), (x2, y2)
+_XYXY_CORNERS = np.array([[0, 1], [2, 1], [0, 3], [2, 3]])
+
+
+def xyxy_box_points(boxes):
+    """
+    Corners of boxes given as (x1, y1, x2, y2) rows in pixels, as predicted by Detectron.
+    The dtype of `boxes` is kept.
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    return boxes[:, _XYXY_CORNERS]
+
+
+@lru_cache(maxsize=None)
+def _pairs(n):
+    """Indices of the two wheels of all pairs, in the order of itertools.combinations(range(n), 2)"""
+    return np.triu_indices(n, 1)
+
+
+def wheel_angles(points, offsets):
+    """
+    Car angles of a batch of images.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Points of the wheel boxes of all images, (num_boxes, num_points, 2), e.g. from
+        `rekognition_box_points` or `xyxy_box_points`. The center of a box is the mean of its points.
+    offsets : np.ndarray
+        (num_images + 1,) start of the boxes of each image in `points`, and the total number of boxes.
+
+    Returns
+    -------
+    tuple
+        angles : (num_images,) absolute angles in degrees, NaN for images with less than 2 wheels.
+        pairs : (num_images, 2) indices of the wheels of the reference vector within each image, -1 if none.
+        centers : (num_boxes, 2) wheel centers.
+    """
+    offsets = np.asarray(offsets, dtype=np.intp)
+    centers = np.asarray(points).mean(axis=1)
+    counts = np.diff(offsets)
+    num_images = len(counts)
+    ratios = np.zeros(num_images, dtype=centers.dtype)
+    pairs = np.full((num_images, 2), -1, dtype=np.intp)
+
+    for n in np.unique(counts[counts >= 2]):
+        images = np.flatnonzero(counts == n)
+        wheel_centers = centers[offsets[images, None] + np.arange(n)]
+        first, second = _pairs(n)
+        vecs = wheel_centers[:, first] - wheel_centers[:, second]
+        norms = np.sqrt((vecs * vecs).sum(axis=2))
+        # Stable like sorted(), pairs of equal length keep their order
+        reference = np.argsort(norms, axis=1, kind="stable")[:, 1 if n == 3 else 0]
+        vec = vecs[np.arange(len(images)), reference]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratios[images] = vec[:, 1] / vec[:, 0]
+        pairs[images, 0], pairs[images, 1] = first[reference], second[reference]
+
+    valid = pairs[:, 0] >= 0
+    angles = np.full(num_images, np.nan)
+    # math.atan and np.arctan can differ in the last bit, math.atan keeps results identical to the
+    # per-image computation and costs little next to the rest
+    angles[valid] = np.abs(np.degrees(np.fromiter(map(math.atan, ratios[valid].tolist()), dtype=np.float64, count=int(valid.sum()))))
+    return angles, pairs, centers
+
+
+def wheel_angle(points):
+    """
+    Car angle of one image from the points of its (at least 2) wheel boxes.
+
+    Returns the absolute angle in degrees and the two wheel centers of the reference vector for plotting.
+    Same operations as `wheel_angles` without the batch bookkeeping, which would dominate for one image.
+    """
+    centers = np.asarray(points).mean(axis=1)
+    n = len(centers)
+    first, second = _pairs(n)
+    vecs = centers[first] - centers[second]
+    norms = np.sqrt((vecs * vecs).sum(axis=1))
+    reference = np.argsort(norms, kind="stable")[1 if n == 3 else 0]
+    vec = vecs[reference]
+    angle = math.degrees(math.atan(vec[1] / vec[0]))
+    wheel_centers_rel = [tuple(centers[first[reference]].tolist()), tuple(centers[second[reference]].tolist())]
+    return np.abs(angle), wheel_centers_rel
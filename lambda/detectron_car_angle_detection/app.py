@@ -1,16 +1,74 @@
 import os
 import json
+import posixpath
+import struct
+import tempfile
 
 import boto3
-import base64
+from botocore.config import Config
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+# ImageDraw and ImageFont are imported by label_image: geometry-only requests do not need them
+from PIL import Image
 
-from position_detection import car_angle_from_bbs
+from image_io import image_response_fields, read_request_image
+from metrics import BYTES, InvocationMetrics
+from position_detection import CLASS_TO_NUMBER, car_angle_from_bbs
+from prediction_decoding import NPZ_CONTENT_TYPE, decode_prediction
 
-runtime = boto3.Session().client(service_name="runtime.sagemaker")
+# The default session is shared with the s3 client, a separate Session would load the botocore data files again
+runtime = boto3.client("sagemaker-runtime")
+s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
+BUCKET = os.environ.get("BUCKET")
+
+# car_angle_from_bbs only needs boxes and classes, this lets the endpoint skip the car mask model
+ENDPOINT_CONTENT_TYPE = "application/x-image; outputs=boxes,classes"
+# Several images in one request, each prefixed by its size as a 4 byte big-endian integer
+ENDPOINT_BATCH_CONTENT_TYPE = "application/x-image-batch; outputs=boxes,classes"
+# Images whose longest side exceeds this are downscaled before calling the endpoint, 0 disables it
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", 0))
+JPEG_QUALITY = 90
+# Frames per second of a video sent to the endpoint at most, before near-identical frames are dropped
+VIDEO_MAX_FPS = float(os.environ.get("VIDEO_MAX_FPS", 5))
+# Frames sent to the endpoint in one request, the endpoint runs them in batches of its MAX_BATCH_SIZE
+VIDEO_BATCH_SIZE = int(os.environ.get("VIDEO_BATCH_SIZE", 8))
+
+def downscale_image(img_string, max_side):
+    '''
+    Downscale an encoded image so that its longest side is at most `max_side` pixels.
+
+    Returns the encoded image to send to the endpoint and the (x, y) factors that scale
+    coordinates in the sent image back to the original image.
+    '''
+    img = Image.open(BytesIO(img_string))
+    width, height = img.size
+    if not max_side or max(width, height) <= max_side:
+        return img_string, (1.0, 1.0)
+
+    ratio = max_side / max(width, height)
+    size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    # For JPEGs, let the decoder skip resolution through DCT scaling before resizing
+    img.draft('RGB', size)
+    img = img.convert('RGB').resize(size, Image.BILINEAR)
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+    return buffered.getvalue(), (width / size[0], height / size[1])
+
+def rescale_prediction(result, scale):
+    '''
+    Scale the boxes of an endpoint prediction made on a downscaled image back to the original image.
+    '''
+    if scale == (1.0, 1.0):
+        return result
+    scale_x, scale_y = scale
+    result["pred_boxes"] = np.asarray(result["pred_boxes"], dtype=np.float32) * np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+    result["image_width"] = int(round(result["image_width"] * scale_x))
+    result["image_height"] = int(round(result["image_height"] * scale_y))
+    return result
 
 def label_image(img_string, wheel_centers_rel):
+    from PIL import ImageDraw, ImageFont
+
     img = Image.open(BytesIO(img_string)).convert('RGB')
     
     draw = ImageDraw.Draw(img)
@@ -21,34 +79,138 @@ def label_image(img_string, wheel_centers_rel):
         draw.line(wheel_centers_rel, fill='#3333FF', width=5)
     return img
 
+def geometry_fields(result, view, angle, wheel_centers_rel):
+    '''
+    Fields of the response body when no image is rendered: the view, the angle, the wheel centers
+    of the reference vector and the wheel boxes (x1, y1, x2, y2) in pixels of the original image.
+    '''
+    pred_boxes = np.asarray(result["pred_boxes"]).reshape(-1, 4)
+    pred_classes = np.asarray(result["pred_classes"])
+    return {
+        "view": None if view is None else view.value,
+        "angle": angle,
+        "wheel_centers": [list(center) for center in wheel_centers_rel or []],
+        "wheel_boxes": pred_boxes[pred_classes == CLASS_TO_NUMBER["wheel"]].tolist(),
+        "image_width": int(result["image_width"]),
+        "image_height": int(result["image_height"]),
+    }
+
+def invoke_endpoint(body, content_type, metrics):
+    '''
+    Invoke the endpoint and return the decoded prediction (a list of predictions for a batch).
+    Stages and payload sizes are summed on `metrics` over the calls of a request and the calls
+    are counted by `endpoint_calls`.
+    '''
+    with metrics.stage("endpoint", accumulate=True):
+        response = runtime.invoke_endpoint(
+                        EndpointName=os.environ["ENDPOINT_NAME"], ContentType=content_type, Accept=NPZ_CONTENT_TYPE, Body=body
+                    )
+        prediction = response["Body"].read()
+    with metrics.stage("decode", accumulate=True):
+        result = decode_prediction(prediction, NPZ_CONTENT_TYPE)
+    metrics.add("endpoint_calls", 1)
+    metrics.add("endpoint_request_bytes", len(body), BYTES)
+    metrics.add("endpoint_response_bytes", len(prediction), BYTES)
+    return result
+
+def predict_boxes(img_string, metrics):
+    '''
+    Invoke the endpoint on an encoded image (downscaled first if needed) and return the decoded
+    prediction with boxes in pixels of the original image. Stages are timed on `metrics`.
+    '''
+    with metrics.stage("downscale", accumulate=True):
+        endpoint_bytes, scale = downscale_image(img_string, MAX_IMAGE_SIDE)
+    result = rescale_prediction(invoke_endpoint(endpoint_bytes, ENDPOINT_CONTENT_TYPE, metrics), scale)
+    metrics.add("boxes", len(result["pred_classes"]))
+    return result
+
+def predict_frames(frames, metrics):
+    '''
+    Invoke the endpoint once on a list of BGR frames, already downscaled, and return their predictions.
+    '''
+    import cv2
+
+    with metrics.stage("encode_frames", accumulate=True):
+        encoded = [cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes() for frame in frames]
+        body = b"".join(struct.pack(">I", len(image)) + image for image in encoded)
+    results = invoke_endpoint(body, ENDPOINT_BATCH_CONTENT_TYPE, metrics)
+    metrics.add("boxes", sum(len(result["pred_classes"]) for result in results))
+    return results
+
+def image_fields(request, metrics):
+    '''
+    Fields of the response body for an image: the annotated image or, with `"render": false`, the geometry.
+    '''
+    with metrics.stage("read_image"):
+        body_bytes = read_request_image(request, s3, BUCKET)
+    metrics.put("image_bytes", len(body_bytes), BYTES)
+    result = predict_boxes(body_bytes, metrics)
+
+    with metrics.stage("angle"):
+        view, angle, wheel_centers_rel = car_angle_from_bbs(result)
+    metrics.put("wheels", int(np.count_nonzero(np.asarray(result["pred_classes"]) == CLASS_TO_NUMBER["wheel"])))
+
+    if request.get("render", True):
+        with metrics.stage("render"):
+            img = label_image(img_string=body_bytes, wheel_centers_rel=wheel_centers_rel)
+        with metrics.stage("encode"):
+            return {
+                **image_response_fields(img, request, s3, BUCKET),
+                "view": None if view is None else view.value,
+                "angle": angle
+            }
+    with metrics.stage("geometry"):
+        return geometry_fields(result, view, angle, wheel_centers_rel)
+
+def video_fields(request, metrics):
+    '''
+    Fields of the response body for a video uploaded to the bucket (`{"s3_key": ..., "video": true}`):
+    the smoothed angle track of its distinct frames, sent to the endpoint `VIDEO_BATCH_SIZE` at a time,
+    see video.car_angle_track.
+    '''
+    from video import car_angle_track
+
+    def detect(frames):
+        return predict_frames(frames, metrics)
+
+    # The video is streamed to /tmp and decoded frame by frame, it is never held in memory
+    with tempfile.NamedTemporaryFile(suffix=posixpath.splitext(request["s3_key"])[1]) as file:
+        with metrics.stage("read_video"):
+            s3.download_fileobj(BUCKET, request["s3_key"], file)
+            file.flush()
+        metrics.put("video_bytes", file.tell(), BYTES)
+        with metrics.stage("video"):
+            body = car_angle_track(file.name, detect, max_fps=VIDEO_MAX_FPS, max_side=MAX_IMAGE_SIDE or None,
+                                   batch_size=VIDEO_BATCH_SIZE)
+    metrics.put("kept_frames", body["kept_frames"])
+    metrics.put("dropped_frames", body["dropped_frames"])
+    return body
+
+
 def lambda_handler(event, context):
-    body_bytes = json.loads(event["body"])["image"].split(",")[-1]
-    body_bytes = base64.b64decode(body_bytes)
-    
-    response = runtime.invoke_endpoint(
-                    EndpointName=os.environ["ENDPOINT_NAME"], ContentType="application/x-image", Body=body_bytes
-                )
-    result = response["Body"].read()
-    result = json.loads(result)
+    metrics = InvocationMetrics("detectron")
+    request = json.loads(event["body"])
+    if request.get("video", False):
+        if not request.get("s3_key"):
+            return _response(event, 400, json.dumps({"message": "A video request needs the s3_key of the uploaded video"}))
+        body = video_fields(request, metrics)
+    else:
+        body = image_fields(request, metrics)
+        metrics.set_property("render", request.get("render", True))
 
-    view, angle, wheel_centers_rel = car_angle_from_bbs(result)
-    
-    img = label_image(img_string=body_bytes, wheel_centers_rel=wheel_centers_rel)
+    response_body = json.dumps(body)
+    metrics.put("response_bytes", len(response_body), BYTES)
+    metrics.flush()
+    return _response(event, 200, response_body)
 
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    img_str = "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
 
+def _response(event, status_code, body):
     return {
-        'statusCode': 200,
+        'statusCode': status_code,
         "headers": {
             "Access-Control-Allow-Origin": event["headers"]["origin"],
             "Access-Control-Allow-Headers": "Content-Type",
             "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
         },
-        'body': json.dumps({
-            "image": img_str,
-            "view": None if view is None else view.value,
-            "angle": angle
-        })
+        'body': body
     }
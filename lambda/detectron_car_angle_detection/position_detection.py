@@ -1,9 +1,9 @@
 from enum import Enum
-from itertools import combinations
-import math
 
 import numpy as np
 
+from wheel_geometry import wheel_angle, xyxy_box_points
+
 CLASS_TO_NUMBER = {"wheel": 18, "back_bumper": 1, "front_bumper": 7}
 
 
@@ -24,11 +24,8 @@ def bbox_for_class(bbs, pred_classes, class_name):
     # Select only bboxes for wheels
     bbs = np.compress(pred_classes == CLASS_TO_NUMBER[class_name], bbs, axis=0)
 
-    bbs_reformated = []
-    for bb in bbs:
-        bb = np.array([[bb[0], bb[1]], [bb[2], bb[1]], [bb[0], bb[3]], [bb[2], bb[3]]])
-        bbs_reformated.append(bb)
-    return bbs_reformated
+    # Corners (x1, y1), (x2, y1), (x1, y2), (x2, y2) of each box
+    return list(xyxy_box_points(bbs))
 
 
 def car_angle_wheel_bbs(wheel_bbs):
@@ -45,23 +42,8 @@ def car_angle_wheel_bbs(wheel_bbs):
     tuple:
         Car angle and relative positions of car wheels to each other.
     '''
-    n_wheels = len(wheel_bbs)
-
-    wheel_centers = [wheel_bb.mean(axis=0) for wheel_bb in wheel_bbs]
-    # Get all possible vectors between wheel bounding boxes and sort them by their length
-    wheel_center_comb = list(combinations(wheel_centers, 2))
-
-    # Note: We enumerate these vectors to later still have information on which wheels belong to which vector (need that for plotting)
-    vecs = [(k, pair[0] - pair[1]) for k, pair in enumerate(wheel_center_comb)]
-    vecs = sorted(vecs, key=lambda vec: np.linalg.norm(vec[1]))
-
-    # If we have 3 vectors (normally the case if we have 2 front wheels and 1 rear wheel)
-    # we want to take the 2nd longest as reference to get the angle.
-    vec_rel = vecs[1] if n_wheels == 3 else vecs[0]
-    angle = math.degrees(math.atan(vec_rel[1][1]/vec_rel[1][0]))
-
-    wheel_centers_rel = [tuple(wheel.tolist()) for wheel in wheel_center_comb[vec_rel[0]]]
-    return np.abs(angle), wheel_centers_rel
+    # The reference vector is chosen by wheel_geometry, which also computes the angles of whole batches
+    return wheel_angle(np.stack(wheel_bbs))
 
 
 def car_angle_from_bbs(outputs):
@@ -105,14 +87,9 @@ def car_angle_from_bbs(outputs):
     elif n_class["front_bumper"] == 0 and n_class["back_bumper"] == 0:
         view = View.SIDE
     else:
-<<<<<<< HEAD:src/position_detection.py
-        raise Exception(f"Detected inconsistent number of {n_class['front_bumper']} front and {n_class['back_bumper']} back bumpers.")
-
-=======
         print(f"Detected inconsistent number of {n_class['front_bumper']} front and {n_class['back_bumper']} back bumpers.")
         return [None] * 3
-    
->>>>>>> c056655b5668a4cdc8bf16b5e1cd39a7d4bbde88:cdk-automation/lambda/detectron_car_angle_detection/position_detection.py
+
     # Get the angle
     if n_class["wheel"] == 0:
         # Angle is zero
@@ -122,12 +99,7 @@ def car_angle_from_bbs(outputs):
         angle, wheel_centers_rel = car_angle_wheel_bbs(class_bbs["wheel"])
 
     else:
-<<<<<<< HEAD:src/position_detection.py
-        raise Exception(f"Nr. of detected wheels should be 0, 2 or 3 - detected {n_class['wheel']}.")
-
-=======
         print(f"Nr. of detected wheels should be 0, 2 or 3 - detected {n_class['wheel']}.")
         return [None] * 3
-        
->>>>>>> c056655b5668a4cdc8bf16b5e1cd39a7d4bbde88:cdk-automation/lambda/detectron_car_angle_detection/position_detection.py
+
     return view, angle, wheel_centers_rel
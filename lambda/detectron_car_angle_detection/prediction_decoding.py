@@ -0,0 +1,117 @@
+import base64
+import json
+from io import BytesIO
+
+import numpy as np
+
+JSON_CONTENT_TYPE = "application/json"
+NPZ_CONTENT_TYPE = "application/x-npz"
+
+
+def _rle_counts_from_string(counts):
+    '''
+    Decode the COCO compressed RLE string (as produced by pycocotools) into run lengths.
+    '''
+    counts = counts.encode('ascii') if isinstance(counts, str) else counts
+    runs = []
+    p = 0
+    while p < len(counts):
+        x, k, more = 0, 0, True
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return runs
+
+
+def _decode_rle(encoded, height, width):
+    runs = _rle_counts_from_string(encoded["counts"])
+    # Runs alternate between 0 and 1 starting with 0, in column-major order
+    values = np.arange(len(runs)) % 2 == 1
+    flat = np.repeat(values, runs)
+    return flat.reshape(width, height).T
+
+
+def _decode_bitpack(encoded, height, width):
+    packed = np.frombuffer(base64.b64decode(encoded["data"]), dtype=np.uint8)
+    return np.unpackbits(packed, count=height * width).reshape(height, width).astype(bool)
+
+
+def _decode_polygon(encoded, height, width):
+    # Only polygon masks need PIL, it is not imported for the other formats
+    from PIL import Image, ImageDraw
+
+    img = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(img)
+    for polygon in encoded["polygons"]:
+        draw.polygon(polygon, outline=1, fill=1)
+    return np.asarray(img, dtype=bool)
+
+
+_DECODERS = {
+    "rle": _decode_rle,
+    "bitpack": _decode_bitpack,
+    "polygon": _decode_polygon,
+}
+
+
+def decode_mask(encoded):
+    '''
+    Decode a mask returned by the Detectron endpoint (e.g. `car_mask`) into a boolean array.
+
+    Parameters
+    ----------
+    encoded : dict
+        Encoded mask with `format` (`rle`, `bitpack` or `polygon`), `size` as [height, width]
+        and the format specific payload.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of shape (height, width), or None if no mask was returned.
+    '''
+    if encoded is None:
+        return None
+    height, width = encoded["size"]
+    return _DECODERS[encoded["format"]](encoded, height, width)
+
+
+def _prediction_from_npz(archive, prefix=""):
+    prediction = json.loads(archive[prefix + "meta"].tobytes().decode('utf-8'))
+    for key in archive.files:
+        if key.startswith(prefix) and key != prefix + "meta":
+            name = key[len(prefix):]
+            if "/" not in name:
+                prediction[name] = archive[key]
+    return prediction
+
+
+def decode_prediction(body, content_type=NPZ_CONTENT_TYPE):
+    '''
+    Decode a response of the Detectron endpoint.
+
+    Parameters
+    ----------
+    body : bytes
+        Response body.
+    content_type : str
+        `application/x-npz` (typed arrays are returned as NumPy arrays) or `application/json`.
+
+    Returns
+    -------
+    dict or list
+        The prediction, or a list of predictions for a batch request.
+    '''
+    if content_type.split(";")[0].strip() == JSON_CONTENT_TYPE:
+        return json.loads(body)
+    with np.load(BytesIO(body), allow_pickle=False) as archive:
+        if "batch_size" in archive.files:
+            return [_prediction_from_npz(archive, prefix=f"{index}/") for index in range(int(archive["batch_size"]))]
+        return _prediction_from_npz(archive)
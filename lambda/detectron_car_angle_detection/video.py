@@ -0,0 +1,225 @@
+"""Car angle track of a video
+
+Frames are decoded one at a time from the file (never the whole video), frames that are nearly
+identical to the last processed frame are dropped before inference, and the wheel geometry of
+`position_detection` is applied to the wheel boxes detected in the remaining frames. The angles
+are smoothed over time into a track.
+
+A detector is any callable taking a BGR frame and returning a prediction with `pred_boxes`
+(x1, y1, x2, y2 in pixels) and `pred_classes`, like the decoded endpoint response. With a
+`batch_size`, the detector takes a list of up to `batch_size` frames and returns their predictions,
+so that an endpoint is called once per batch instead of once per frame. Without an
+endpoint, `stub_wheel_detector` finds dark blobs and can be used to measure the pipeline on CPU:
+
+    python video.py walkaround.mp4 --max-fps 10 --output track.json
+"""
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+
+from position_detection import CLASS_TO_NUMBER, bbox_for_class, car_angle_wheel_bbs
+
+# A frame is a duplicate if less than this share of its grey thumbnail pixels changed by more than
+# PIXEL_CHANGE (0-255, above compression noise). A mean difference would hide small moving wheels.
+DUPLICATE_THRESHOLD = 0.005
+PIXEL_CHANGE = 16
+THUMBNAIL_SIZE = (32, 32)
+# Time constant of the exponential smoothing of the angle track
+SMOOTHING_SECONDS = 0.5
+
+
+def iter_frames(path, max_fps=None, max_side=None):
+    """
+    Decode the frames of a video file one by one.
+
+    Yields (frame index, time in seconds, BGR frame). With `max_fps`, frames in between are
+    skipped without being decoded. With `max_side`, frames are downscaled so that their longest
+    side is at most `max_side` pixels, which does not change angles.
+    """
+    import cv2
+
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {path}")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        stride = max(1, round(fps / max_fps)) if max_fps else 1
+        index = 0
+        while True:
+            if index % stride:
+                if not capture.grab():
+                    break
+                index += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if max_side and max(frame.shape[:2]) > max_side:
+                ratio = max_side / max(frame.shape[:2])
+                size = (max(1, round(frame.shape[1] * ratio)), max(1, round(frame.shape[0] * ratio)))
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            yield index, index / fps, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def frame_thumbnail(frame):
+    import cv2
+
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(grey, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def drop_duplicate_frames(frames, threshold=DUPLICATE_THRESHOLD, stats=None):
+    """
+    Filter (index, time, frame) tuples, dropping frames whose thumbnail differs from the one
+    of the last kept frame in less than a `threshold` share of pixels. Comparing with the last kept
+    frame, not the previous one, lets slow changes add up until a frame is kept.
+    The numbers of kept and dropped frames are counted in `stats` if given.
+    """
+    last_thumbnail = None
+    for index, timestamp, frame in frames:
+        thumbnail = frame_thumbnail(frame)
+        if last_thumbnail is not None and (np.abs(thumbnail - last_thumbnail) > PIXEL_CHANGE).mean() < threshold:
+            if stats is not None:
+                stats["dropped_frames"] += 1
+            continue
+        last_thumbnail = thumbnail
+        if stats is not None:
+            stats["kept_frames"] += 1
+        yield index, timestamp, frame
+
+
+def frame_angle(prediction):
+    """
+    Angle and wheel centers of the reference vector from the wheel boxes of one prediction,
+    (None, []) unless 2 or 3 wheels are detected.
+    """
+    wheel_bbs = bbox_for_class(
+        bbs=np.asarray(prediction["pred_boxes"]).reshape(-1, 4),
+        pred_classes=np.asarray(prediction["pred_classes"]),
+        class_name="wheel",
+    )
+    if len(wheel_bbs) not in (2, 3):
+        return None, []
+    angle, wheel_centers_rel = car_angle_wheel_bbs(wheel_bbs)
+    return float(angle), wheel_centers_rel
+
+
+def smooth_angles(track, smoothing_s=SMOOTHING_SECONDS):
+    """
+    Add a `smoothed_angle` to the track entries: exponential moving average over time, so that
+    gaps left by dropped frames weigh like the frames they stand for. Frames without an angle
+    keep the last smoothed angle.
+    """
+    smoothed, last_time = None, None
+    for entry in track:
+        if entry["angle"] is not None:
+            if smoothed is None:
+                smoothed = entry["angle"]
+            else:
+                alpha = 1 - math.exp(-(entry["time_s"] - last_time) / smoothing_s) if smoothing_s > 0 else 1.0
+                smoothed += alpha * (entry["angle"] - smoothed)
+            last_time = entry["time_s"]
+        entry["smoothed_angle"] = smoothed
+    return track
+
+
+def _batched(frames, batch_size):
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def car_angle_track(path, detect, max_fps=None, max_side=None, threshold=DUPLICATE_THRESHOLD, smoothing_s=SMOOTHING_SECONDS,
+                    batch_size=None):
+    """
+    Run `detect` on the distinct frames of a video and return the smoothed angle track with
+    frame counts and the processing speed relative to real time. With `batch_size`, `detect` is
+    called on lists of up to `batch_size` frames.
+    """
+    start = time.perf_counter()
+    stats = {"kept_frames": 0, "dropped_frames": 0}
+    track = []
+    frames = drop_duplicate_frames(iter_frames(path, max_fps=max_fps, max_side=max_side), threshold=threshold, stats=stats)
+    for batch in _batched(frames, batch_size or 1):
+        images = [frame for _, _, frame in batch]
+        predictions = detect(images) if batch_size else [detect(images[0])]
+        for (index, timestamp, _), prediction in zip(batch, predictions):
+            angle, wheel_centers_rel = frame_angle(prediction)
+            track.append({
+                "frame": index,
+                "time_s": timestamp,
+                "angle": angle,
+                "wheel_centers": [list(center) for center in wheel_centers_rel],
+            })
+    # The last decoded frame may have been dropped, the duration comes from the capture itself
+    duration = _video_duration(path)
+    processing_s = time.perf_counter() - start
+    return {
+        **stats,
+        "duration_s": duration,
+        "processing_s": processing_s,
+        "realtime_factor": duration / processing_s if processing_s else None,
+        "track": smooth_angles(track, smoothing_s),
+    }
+
+
+def _video_duration(path):
+    import cv2
+
+    capture = cv2.VideoCapture(str(path))
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        return capture.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+    finally:
+        capture.release()
+
+
+def stub_wheel_detector(frame, max_intensity=60, min_area=50):
+    """
+    Local stand-in for the endpoint: every dark blob of at least `min_area` pixels is a wheel.
+    """
+    import cv2
+
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    count, _, blobs, _ = cv2.connectedComponentsWithStats((grey <= max_intensity).astype(np.uint8))
+    # Row 0 is the background
+    blobs = blobs[1:count]
+    blobs = blobs[blobs[:, cv2.CC_STAT_AREA] >= min_area]
+    x, y = blobs[:, cv2.CC_STAT_LEFT], blobs[:, cv2.CC_STAT_TOP]
+    boxes = np.stack([x, y, x + blobs[:, cv2.CC_STAT_WIDTH], y + blobs[:, cv2.CC_STAT_HEIGHT]], axis=1)
+    return {
+        "pred_boxes": boxes.astype(np.float32),
+        "pred_classes": np.full(len(boxes), CLASS_TO_NUMBER["wheel"], dtype=np.int32),
+    }
+
+
+def main(args):
+    result = car_angle_track(args.video, stub_wheel_detector, max_fps=args.max_fps, max_side=args.max_side,
+                             threshold=args.threshold, smoothing_s=args.smoothing_s)
+    summary = {key: value for key, value in result.items() if key != "track"}
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("video", type=str)
+    parser.add_argument("--max-fps", type=float, default=None)
+    parser.add_argument("--max-side", type=int, default=None)
+    parser.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD)
+    parser.add_argument("--smoothing-s", type=float, default=SMOOTHING_SECONDS)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
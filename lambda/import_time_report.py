@@ -0,0 +1,136 @@
+"""Import-time and init-duration report of the Lambda handlers
+
+Imports a handler module in a fresh interpreter with `-X importtime`, the way the Lambda runtime
+does on a cold start, and reports the init duration (import of the handler module including the
+creation of its boto3 clients), the import time of each top-level package (the self time of its
+modules summed) and the slowest modules as JSON, so that cold starts can be compared across commits and checked against
+a budget in tests (see tests/unit/lambda_import_time_test.py).
+
+The handler directories are put on the path in the same layout as in the Docker images, modules
+renamed by a Dockerfile are copied under their new name to a temporary directory.
+Run it with the Python version of the image for numbers close to the deployed function.
+
+    python lambda/import_time_report.py rekognition --output rekognition_import.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+LAMBDA_DIR = Path(__file__).resolve().parent
+
+# Handler module and the directories it is importable from, see the Dockerfiles
+HANDLERS = {
+    "rekognition": ("app", ["rekognition_car_angle_detection", "common"]),
+    "rekognition_bulk": ("bulk", ["rekognition_car_angle_detection", "common"]),
+    "detectron": ("app", ["detectron_car_angle_detection", "common"]),
+    "router": ("app", ["car_angle_router", "rekognition_car_angle_detection", "detectron_car_angle_detection", "common"]),
+}
+# Modules copied under another name by the Dockerfile of a handler, relative to the lambda directory
+RENAMED_MODULES = {
+    "router": {
+        "rekognition_app": "rekognition_car_angle_detection/app.py",
+        "detectron_app": "detectron_car_angle_detection/app.py",
+    },
+}
+
+_IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def parse_importtime(stderr):
+    """
+    Parse the `-X importtime` output into a list of (module, self_us, cumulative_us, depth),
+    in import completion order.
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by 2 spaces per level after the separator
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def import_time_report(handler, top=15, python=sys.executable):
+    """
+    Import the module of `handler` (a key of `HANDLERS`) in a fresh interpreter and return its report.
+    """
+    module, directories = HANDLERS[handler]
+    with tempfile.TemporaryDirectory() as renamed_dir:
+        paths = [str(LAMBDA_DIR / directory) for directory in directories]
+        renamed = RENAMED_MODULES.get(handler, {})
+        if renamed:
+            for name, source in renamed.items():
+                shutil.copyfile(LAMBDA_DIR / source, Path(renamed_dir) / f"{name}.py")
+            # Precompiled like in the image, so that the copies are not compiled during the measurement
+            subprocess.run([python, "-m", "compileall", "-q", renamed_dir], check=True)
+            paths.insert(0, renamed_dir)
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(paths)
+        # Clients are created at import, they need a region but make no calls
+        env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+        process = subprocess.run(
+            [python, "-X", "importtime", "-c", _IMPORT_SNIPPET.format(module=module)],
+            # With -c the working directory comes first on the path, as the task root does in the image
+            cwd=str(LAMBDA_DIR / directories[0]), env=env, capture_output=True, text=True, check=True,
+        )
+    modules = parse_importtime(process.stderr)
+    # Keep the modules imported by the handler, not those of the interpreter startup: entries are
+    # listed on completion, so the handler's imports are those since the previous top-level entry
+    end = next(i for i, (name, _, _, depth) in enumerate(modules) if name == module and depth == 0)
+    start = max((i + 1 for i, (_, _, _, depth) in enumerate(modules[:end]) if depth == 0), default=0)
+    modules = modules[start:end + 1]
+
+    packages = {}
+    for name, self_us, _, _ in modules:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    return {
+        "handler": handler,
+        "module": module,
+        "python": python,
+        "init_duration_ms": float(process.stdout.strip().splitlines()[-1]) * 1000,
+        "import_time_ms": modules[-1][2] / 1000,
+        "num_modules": len(modules),
+        "modules": [name for name, _, _, _ in modules],
+        "packages_ms": {
+            package: total_self_us / 1000
+            for package, total_self_us in sorted(packages.items(), key=lambda item: -item[1])[:top]
+        },
+        "slowest_self_ms": {
+            name: self_us / 1000
+            for name, self_us, _, _ in sorted(modules, key=lambda module: -module[1])[:top]
+        },
+    }
+
+
+def main(args):
+    reports = [import_time_report(handler, top=args.top) for handler in args.handlers or HANDLERS]
+    # The list of all imported modules is only useful to tests, it is left out of the printed report
+    for report in reports:
+        report.pop("modules")
+    print(json.dumps(reports, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("handlers", nargs="*", help=f"any of {', '.join(HANDLERS)}, all by default")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
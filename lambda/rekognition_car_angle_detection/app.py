@@ -1,17 +1,31 @@
 import json
-from typing import List
+import os
+from io import BytesIO
 
 import boto3
-import base64
-from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont
-from itertools import combinations
+from botocore.config import Config
+# ImageDraw and ImageFont are imported by label_image: geometry-only requests do not need them
+from PIL import Image
 
-import numpy as np
-from itertools import combinations
-import math
+from image_io import image_response_fields, is_s3_request, read_request_image
+from metrics import BYTES, InvocationMetrics
+from result_cache import ResultCache, cache_key
+from wheel_geometry import rekognition_box_points, wheel_angle
 
 rek = boto3.client('rekognition')
+s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
+BUCKET = os.environ.get("BUCKET")
+
+MIN_CONFIDENCE = 80
+
+# Survives warm invocations, see result_cache.ResultCache
+result_cache = ResultCache(
+    max_bytes=int(os.environ.get("RESULT_CACHE_MAX_BYTES", 16 * 2**20)),
+    cache_dir=os.environ.get("RESULT_CACHE_DIR"),
+    max_dir_bytes=int(os.environ.get("RESULT_CACHE_DIR_MAX_BYTES", 256 * 2**20)),
+    s3_bucket=os.environ.get("BUCKET") if os.environ.get("RESULT_CACHE_S3_PREFIX") else None,
+    s3_prefix=os.environ.get("RESULT_CACHE_S3_PREFIX", ""),
+)
 
 #font_file = '/opt/ml/arial.ttf'
 
@@ -70,7 +84,7 @@ def car_angle_from_wheels(wheel_instances, img):
     Returns the angle between a horizontal line and a reference vector between
     the front and rear wheel of the car (aka reference vector).
     
-    Most part of this function deals with finding this vector.
+    The vector is chosen by wheel_geometry, which also computes the angles of whole batches.
     
     Parameters
     ----------
@@ -85,77 +99,142 @@ def car_angle_from_wheels(wheel_instances, img):
     float, list
         Car angle and a the wheel centers for plotting.
     """
-    n_wheels = len(wheel_instances)
+    boxes = [[wheel['Left'], wheel['Top'], wheel['Width'], wheel['Height']] for wheel in wheel_instances]
+    return wheel_angle(rekognition_box_points(boxes, img.size))
 
-    # Get a list of the centre of all wheel bounding boxes
-    wheel_centers = [np.array(_extract_bb_coords(wheel, img)).mean(axis=0) for wheel in wheel_instances]
-    
-    # Get all possible vectors between wheel bounding boxes and sort them by their length
-    wheel_center_comb = list(combinations(wheel_centers, 2))
-    # Note: We enumerate these vectors to later still have information on which wheels belong to which vector (need that for plotting)
-    vecs = [(k, pair[0] - pair[1]) for k,pair in enumerate(wheel_center_comb)]
-    vecs = sorted(vecs, key = lambda vec: np.linalg.norm(vec[1]))
-    
-    # If we have 3 vectors (normally the case if we have 2 front wheels and 1 rear wheel)
-    # we want to take the 2nd longest as reference to get the angle.
-    vec_rel = vecs[1] if n_wheels == 3 else vecs[0]
-    angle = math.degrees(math.atan(vec_rel[1][1]/vec_rel[1][0]))
-    
-    wheel_centers_rel = [tuple(wheel.tolist()) for wheel in wheel_center_comb[vec_rel[0]]]
-    return np.abs(angle), wheel_centers_rel
+
+def car_angle_from_detections(car_bbs, wheel_bbs, img):
+    """
+    Takes the car and wheel bounding boxes detected by Rekognition for an image.
+    Returns the car angle, the wheel centers of the reference vector and a message
+    explaining why no angle could be computed (None if it could).
+
+    img: PIL image, only its size is used so it does not need to be decoded
+    """
+    # If there is more than 1 car in the image we don't get the angle
+    if len(car_bbs) > 1:
+        return None, [], "Too many cars"
+
+    # If there are less than 2 or more than 3 wheels, something is odd and we don't return an angle
+    if len(wheel_bbs) not in [2,3]:
+        return None, [], "Too many or too few wheels detected"
+
+    # If there are 2 or 3 wheels, get the angle
+    angle, wheel_centers_rel = car_angle_from_wheels(wheel_bbs, img)
+    return angle, wheel_centers_rel, None
 
 
-def label_image(img_string, response):
+def label_image(img_string, car_bbs, wheel_bbs):
     """
-    Takes an image and a Rekognition response with detections for this image.
+    Takes an image and the car and wheel bounding boxes detected by Rekognition for this image.
     Plots relevant information on the image.
     
-    img: PIL image
+    img_string: encoded image
     
-    response:
+    car_bbs, wheel_bbs: bounding boxes as returned by `get_wheels_and_cars_default`
     """
     
+    from PIL import ImageDraw, ImageFont
+
     img = Image.open(BytesIO(img_string)).convert('RGB')
     imgWidth, imgHeight = img.size
     
-    car_bbs, wheel_bbs = get_wheels_and_cars_default(response)
-    
     draw = ImageDraw.Draw(img)
     #fnt = ImageFont.truetype(font=font_file, size=30)
     fnt = ImageFont.load_default()
     
-    # If there is more than 1 car in the image we don't get the angle
-    if len(car_bbs) > 1:
-        text = "Too many cars"
-        print(text)
-        draw.text((imgWidth * 0.1, imgHeight * 0.1), text, font=fnt, fill="#CC0000")
-        return None, img
-
-    # If there are less than 2 or more than 3 wheels, something is odd and we don't return an angle
-    if len(wheel_bbs) not in [2,3]:
-        text = "Too many or too few wheels detected"
+    angle, wheel_centers_rel, text = car_angle_from_detections(car_bbs, wheel_bbs, img)
+    if text is not None:
         print(text)
         draw.text((imgWidth * 0.1, imgHeight * 0.1), text, font=fnt, fill="#CC0000")
         return None, img
     
-    # If there are 2 or 3 wheels, get the angle and plot the reference vector
-    angle, wheel_centers_rel = car_angle_from_wheels(wheel_bbs, img) 
+    # Plot the angle and the reference vector
     draw.text((imgWidth * 0.5, imgHeight * 0.7), f"Angle: {angle:.2f}°", font=fnt, fill="#CC0000")
     draw.line(wheel_centers_rel, fill='#3333FF', width=5)
     return angle, img
 
 
-def lambda_handler(event, context):
-    body_bytes = json.loads(event["body"])["image"].split(",")[-1]
-    body_bytes = base64.b64decode(body_bytes)
+def pixel_boxes(boxes, img):
+    """
+    Rekognition bounding boxes (ratios of the image size) as (x1, y1, x2, y2) boxes in pixels.
+
+    img: PIL image, only its size is used
+    """
+    return [[*points[0], *points[2]] for points in (_extract_bb_coords(box, img) for box in boxes)]
 
-    response = rek.detect_labels(Image={'Bytes': body_bytes}, MinConfidence=80)
-    
-    angle, img = label_image(img_string=body_bytes, response=response)
 
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    img_str = "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode('utf-8')
+def geometry_fields(img_string, car_bbs, wheel_bbs):
+    """
+    Compute the angle without rendering: returns the fields of the response body with the angle,
+    the wheel centers of the reference vector and the car and wheel boxes (x1, y1, x2, y2) in pixels.
+    Only the image header is read to get its size, the image is not decoded.
+    """
+    img = Image.open(BytesIO(img_string))
+    angle, wheel_centers_rel, message = car_angle_from_detections(car_bbs, wheel_bbs, img)
+    return {
+        "angle": angle,
+        "message": message,
+        "wheel_centers": [list(center) for center in wheel_centers_rel],
+        "car_boxes": pixel_boxes(car_bbs, img),
+        "wheel_boxes": pixel_boxes(wheel_bbs, img),
+        "image_width": img.size[0],
+        "image_height": img.size[1],
+    }
+
+
+def detect_cars_and_wheels(request, body_bytes):
+    """
+    Return the car and wheel bounding boxes detected by Rekognition for the image of a request,
+    from the result cache if the same image was seen before.
+
+    The cached record holds the boxes only, callers recompute the angle from them. Records that
+    also hold an `angle`, as written before the router was added, are still read.
+    """
+    key = cache_key(body_bytes, MIN_CONFIDENCE)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached["car_bbs"], cached["wheel_bbs"]
+
+    if is_s3_request(request):
+        # Rekognition reads the object itself, the image is not sent again
+        image = {'S3Object': {'Bucket': BUCKET, 'Name': request["s3_key"]}}
+    else:
+        image = {'Bytes': body_bytes}
+    response = rek.detect_labels(Image=image, MinConfidence=MIN_CONFIDENCE)
+    car_bbs, wheel_bbs = get_wheels_and_cars_default(response)
+    result_cache.put(key, {"car_bbs": car_bbs, "wheel_bbs": wheel_bbs})
+    return car_bbs, wheel_bbs
+
+
+def lambda_handler(event, context):
+    metrics = InvocationMetrics("rekognition")
+    request = json.loads(event["body"])
+    with metrics.stage("read_image"):
+        body_bytes = read_request_image(request, s3, BUCKET)
+    metrics.put("image_bytes", len(body_bytes), BYTES)
+
+    cache_hits = result_cache.stats["hits"]
+    with metrics.stage("detect"):
+        car_bbs, wheel_bbs = detect_cars_and_wheels(request, body_bytes)
+    metrics.put("result_cache_hit", result_cache.stats["hits"] - cache_hits)
+    metrics.put("cars", len(car_bbs))
+    metrics.put("wheels", len(wheel_bbs))
+
+    if request.get("render", True):
+        with metrics.stage("render"):
+            angle, img = label_image(img_string=body_bytes, car_bbs=car_bbs, wheel_bbs=wheel_bbs)
+        with metrics.stage("encode"):
+            body = {**image_response_fields(img, request, s3, BUCKET), "angle": angle}
+    else:
+        with metrics.stage("geometry"):
+            body = geometry_fields(img_string=body_bytes, car_bbs=car_bbs, wheel_bbs=wheel_bbs)
+    metrics.set_property("render", request.get("render", True))
+    metrics.set_property("result_cache", result_cache.stats)
+
+    response_body = json.dumps(body)
+    metrics.put("response_bytes", len(response_body), BYTES)
+    metrics.flush()
 
     return {
         'statusCode': 200,
@@ -164,8 +243,5 @@ def lambda_handler(event, context):
             "Access-Control-Allow-Headers": "Content-Type",
             "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
         },
-        'body': json.dumps({
-            "image": img_str,
-            "angle": angle
-        })
+        'body': response_body
     }
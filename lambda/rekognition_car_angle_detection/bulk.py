@@ -0,0 +1,193 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import boto3
+from botocore.config import Config
+from PIL import Image
+
+from app import MIN_CONFIDENCE, car_angle_from_detections, get_wheels_and_cars_default, pixel_boxes
+
+BULK_MAX_WORKERS = int(os.environ.get("BULK_MAX_WORKERS", 16))
+BULK_RESULT_PREFIX = os.environ.get("BULK_RESULT_PREFIX", "results/bulk/")
+# Bytes read from the start of an image to get its size from the header
+HEADER_BYTES = 128 * 1024
+# Size of the parts the output is uploaded in as results come, S3 needs at least 5 MiB but for the last part
+BULK_PART_BYTES = int(os.environ.get("BULK_PART_BYTES", 8 * 2**20))
+# Time left to finish the images in flight and write the output when no more images are started
+BULK_STOP_MARGIN_MS = int(os.environ.get("BULK_STOP_MARGIN_MS", 60 * 1000))
+
+# Shared by all worker threads: one connection per worker and client side rate adaptation on throttling
+client_config = Config(
+    max_pool_connections=BULK_MAX_WORKERS,
+    retries={"mode": "adaptive", "max_attempts": 10},
+)
+rek = boto3.client('rekognition', config=client_config)
+s3 = boto3.client('s3', config=client_config)
+
+
+def list_keys(bucket, prefix, start_after=None):
+    """
+    List the keys of all objects under `prefix` in `bucket`, in key order, after `start_after` if given.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    start = {"StartAfter": start_after} if start_after else {}
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **start):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith("/"):
+                yield obj["Key"]
+
+
+def read_image_header(bucket, key):
+    """
+    Open an image stored in S3 from its first bytes only, which is enough to read its size.
+    Falls back to the full object if the header is larger than `HEADER_BYTES`.
+    """
+    head = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{HEADER_BYTES - 1}")["Body"].read()
+    try:
+        img = Image.open(BytesIO(head))
+        img.size
+        return img
+    except (OSError, SyntaxError):
+        return Image.open(BytesIO(s3.get_object(Bucket=bucket, Key=key)["Body"].read()))
+
+
+def detect_car_angle(bucket, key):
+    """
+    Detect the car angle of the image stored at `key`, without downloading the full image.
+    Returns one result record, with the same geometry fields as `"render": false` requests
+    (boxes as (x1, y1, x2, y2) in pixels).
+    """
+    start = time.perf_counter()
+    img = read_image_header(bucket, key)
+    response = rek.detect_labels(Image={'S3Object': {'Bucket': bucket, 'Name': key}}, MinConfidence=MIN_CONFIDENCE)
+    car_bbs, wheel_bbs = get_wheels_and_cars_default(response)
+    angle, wheel_centers_rel, message = car_angle_from_detections(car_bbs, wheel_bbs, img)
+    return {
+        "s3_key": key,
+        "angle": None if angle is None else float(angle),
+        "message": message,
+        "wheel_centers": [list(center) for center in wheel_centers_rel],
+        "car_boxes": pixel_boxes(car_bbs, img),
+        "wheel_boxes": pixel_boxes(wheel_bbs, img),
+        "image_width": img.size[0],
+        "image_height": img.size[1],
+        "duration_s": time.perf_counter() - start,
+    }
+
+
+class S3JsonlWriter:
+    """
+    Writes JSON lines to an S3 object as they come: lines are buffered and uploaded as the parts
+    of a multipart upload whenever `BULK_PART_BYTES` are buffered. An output smaller than one part
+    is written with one `put_object` on close.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.buffer = BytesIO()
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, record):
+        self.buffer.write((json.dumps(record) + "\n").encode('utf-8'))
+        if self.buffer.tell() >= BULK_PART_BYTES:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        number = len(self.parts) + 1
+        response = s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number,
+                                  Body=self.buffer.getvalue())
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+        self.buffer = BytesIO()
+
+    def close(self):
+        if self.upload_id is None:
+            s3.put_object(Bucket=self.bucket, Key=self.key, Body=self.buffer.getvalue())
+            return
+        if self.buffer.tell():
+            self._upload_part()
+        s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                     MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def _out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < BULK_STOP_MARGIN_MS
+
+
+def lambda_handler(event, context):
+    """
+    Detect the car angle of many images stored in the stack's bucket.
+
+    event: {"s3_keys": [...]} or {"s3_prefix": "...", "start_after": "..."}, and optionally the key
+        of the output object ("output_key"). Images are processed on a pool of `BULK_MAX_WORKERS`
+        threads with at most twice as many images in flight, and one JSON line per image is
+        written to the output object in input order, uploaded in parts as results come. Failed
+        images get a line with an "error" field.
+
+    When less than `BULK_STOP_MARGIN_MS` are left before the timeout, no more images are started,
+    the output is completed with the images in flight and the summary holds the event that
+    processes the remaining images as "continuation" (None once all images are done).
+    """
+    bucket = event.get("bucket", os.environ["BUCKET"])
+    if "s3_keys" in event:
+        keys = iter(event["s3_keys"])
+    else:
+        keys = list_keys(bucket, event["s3_prefix"], event.get("start_after"))
+    request_id = getattr(context, "aws_request_id", None) or str(int(time.time()))
+    output_key = event.get("output_key", f"{BULK_RESULT_PREFIX}{request_id}.jsonl")
+
+    start = time.perf_counter()
+    count, errors = 0, 0
+    last_key, stopped = event.get("start_after"), False
+    writer = S3JsonlWriter(bucket, output_key)
+    try:
+        with ThreadPoolExecutor(BULK_MAX_WORKERS) as pool:
+            # Bounded so that listing does not run ahead of processing
+            pending = deque()
+            while True:
+                stopped = stopped or _out_of_time(context)
+                key = None if stopped else next(keys, None)
+                if key is not None:
+                    pending.append((key, pool.submit(detect_car_angle, bucket, key)))
+                    last_key = key
+                if not pending:
+                    break
+                if key is None or len(pending) >= 2 * BULK_MAX_WORKERS:
+                    done_key, future = pending.popleft()
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        record = {"s3_key": done_key, "error": repr(e)}
+                        errors += 1
+                    writer.write(record)
+                    count += 1
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+    continuation = None
+    if stopped:
+        remaining = list(keys) if "s3_keys" in event else next(keys, None)
+        if remaining:
+            continuation = {key: value for key, value in event.items() if key not in ("output_key", "start_after")}
+            if "s3_keys" in event:
+                continuation["s3_keys"] = remaining
+            else:
+                continuation["start_after"] = last_key
+
+    summary = {"output_key": output_key, "count": count, "errors": errors, "duration_s": time.perf_counter() - start,
+               "continuation": continuation}
+    print(json.dumps(summary))
+    return summary
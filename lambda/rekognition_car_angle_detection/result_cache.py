@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import boto3
+
+
+def cache_key(img_string, min_confidence):
+    """
+    Content address of a detection result: hash of the decoded image bytes and of the detection settings.
+    """
+    digest = hashlib.sha256(img_string)
+    digest.update(f"|MinConfidence={min_confidence}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache of detection results keyed by `cache_key`.
+
+    The first tier is an in-process LRU bounded by the total size of the serialized results,
+    it survives warm invocations of the Lambda. The optional second tier is a directory
+    (e.g. on /tmp) bounded by `max_dir_bytes`, where the least recently used files (by mtime)
+    are deleted first, or a prefix in an S3 bucket. Values must be JSON serializable.
+    """
+
+    def __init__(self, max_bytes, cache_dir=None, max_dir_bytes=0, s3_bucket=None, s3_prefix="result-cache/"):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_dir_bytes = max_dir_bytes
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self._entries = OrderedDict()
+        self._size = 0
+        self._dir_size = 0
+        self._s3 = None
+        self.stats = {"hits": 0, "misses": 0, "memory_hits": 0, "dir_hits": 0, "s3_hits": 0, "evictions": 0,
+                      "dir_evictions": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._dir_size = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.is_file())
+
+    def get(self, key):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.stats["memory_hits"] += 1
+        else:
+            data = self._get_dir(key)
+            if data is not None:
+                self.stats["dir_hits"] += 1
+            else:
+                data = self._get_s3(key)
+                if data is not None:
+                    self.stats["s3_hits"] += 1
+            if data is not None:
+                self._put_memory(key, data)
+
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return json.loads(data)
+
+    def put(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        self._put_memory(key, data)
+        self._put_dir(key, data)
+        self._put_s3(key, data)
+
+    def _put_memory(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _get_dir(self, key):
+        if not self.cache_dir:
+            return None
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        # The mtime orders the files for eviction
+        os.utime(path)
+        return data
+
+    def _put_dir(self, key, data):
+        if not self.cache_dir or len(data) > self.max_dir_bytes:
+            return
+        path = os.path.join(self.cache_dir, key)
+        if os.path.exists(path):
+            self._dir_size -= os.path.getsize(path)
+        with open(path, 'wb') as file:
+            file.write(data)
+        self._dir_size += len(data)
+        if self._dir_size > self.max_dir_bytes:
+            self._evict_dir(keep=key)
+
+    def _evict_dir(self, keep):
+        """
+        Delete the least recently used files until the directory holds at most `max_dir_bytes`.
+        """
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file() and entry.name != keep]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime_ns):
+            if self._dir_size <= self.max_dir_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._dir_size -= size
+            self.stats["dir_evictions"] += 1
+
+    def _s3_client(self):
+        if self._s3 is None:
+            self._s3 = boto3.client('s3')
+        return self._s3
+
+    def _get_s3(self, key):
+        if not self.s3_bucket:
+            return None
+        try:
+            return self._s3_client().get_object(Bucket=self.s3_bucket, Key=self.s3_prefix + key)["Body"].read()
+        except self._s3_client().exceptions.NoSuchKey:
+            return None
+
+    def _put_s3(self, key, data):
+        if self.s3_bucket:
+            self._s3_client().put_object(Bucket=self.s3_bucket, Key=self.s3_prefix + key, Body=data)
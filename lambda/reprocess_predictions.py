@@ -0,0 +1,262 @@
+"""Offline reprocessing of stored endpoint predictions
+
+Runs `position_detection.car_angle_from_bbs` again on predictions of the Detectron endpoint that
+were stored earlier, so that changes to the thresholds or the view logic can be applied to past
+images without calling the endpoint. Inputs are local files or directories or `s3://bucket/prefix`
+URIs of `.jsonl` (one prediction per line), `.json` (one prediction or a batch) or `.npz`
+(endpoint response) files with at least `pred_boxes` and `pred_classes`.
+
+Records are streamed: files are read one at a time (JSONL line by line), chunks of records are
+processed on a pool of processes with a bounded number of chunks in flight and results are written
+in input order as they come, to JSONL or, for a `.parquet` output and with pyarrow installed, to
+Parquet. Memory use does not grow with the size of the input.
+
+    python lambda/reprocess_predictions.py s3://my-bucket/predictions/ --output angles.parquet --workers 8
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+
+LAMBDA_DIR = Path(__file__).resolve().parent
+sys.path[:0] = [str(LAMBDA_DIR / "common"), str(LAMBDA_DIR / "detectron_car_angle_detection")]
+from position_detection import car_angle_from_bbs  # noqa: E402
+from prediction_decoding import NPZ_CONTENT_TYPE, decode_prediction  # noqa: E402
+
+SUFFIXES = (".jsonl", ".json", ".npz")
+
+
+def iter_sources(inputs):
+    """
+    Expand the inputs into (name, opener) pairs, opener returning a binary file object.
+    """
+    for uri in inputs:
+        if uri.startswith("s3://"):
+            import boto3
+
+            s3 = boto3.client("s3")
+            bucket, _, prefix = uri[len("s3://"):].partition("/")
+            for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    if obj["Key"].endswith(SUFFIXES):
+                        yield f"s3://{bucket}/{obj['Key']}", lambda key=obj["Key"]: s3.get_object(Bucket=bucket, Key=key)["Body"]
+            continue
+
+        path = Path(uri)
+        paths = sorted(p for p in path.rglob("*") if p.name.endswith(SUFFIXES)) if path.is_dir() else [path]
+        for path in paths:
+            yield str(path), lambda path=path: open(path, "rb")
+
+
+def iter_records(inputs, counters):
+    """
+    Yield (source, kind, payload) for every record of the inputs: JSON text or NPZ bytes, unparsed,
+    parsing is left to the worker processes. Bytes read are counted in `counters`.
+    """
+    for name, opener in iter_sources(inputs):
+        body = opener()
+        try:
+            if name.endswith(".jsonl"):
+                # Iterating an S3 StreamingBody yields 1 KiB chunks, not lines
+                lines = body.iter_lines(keepends=True) if hasattr(body, "iter_lines") else body
+                for number, line in enumerate(lines, start=1):
+                    counters["bytes_read"] += len(line)
+                    if line.strip():
+                        yield f"{name}:{number}", "json", line
+            else:
+                payload = body.read()
+                counters["bytes_read"] += len(payload)
+                yield name, "npz" if name.endswith(".npz") else "json", payload
+        finally:
+            body.close()
+
+
+def _chunked(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def reprocess_prediction(source, prediction, id_field):
+    """
+    Output record of one prediction. The reason why no angle was found, printed by
+    car_angle_from_bbs, is kept as `message`.
+    """
+    messages = io.StringIO()
+    with redirect_stdout(messages):
+        view, angle, wheel_centers_rel = car_angle_from_bbs(prediction)
+    record_id = prediction.get(id_field)
+    return {
+        "source": source,
+        "id": None if record_id is None else str(record_id),
+        "view": None if view is None else view.value,
+        "angle": None if angle is None else float(angle),
+        "wheel_centers": [list(center) for center in wheel_centers_rel or []],
+        "message": messages.getvalue().strip() or None,
+        "error": None,
+    }
+
+
+def process_chunk(chunk, id_field):
+    """
+    Worker function: parse and reprocess a chunk of records. Records that cannot be parsed or
+    processed get an `error` instead of failing the whole run.
+    """
+    results = []
+    for source, kind, payload in chunk:
+        try:
+            prediction = decode_prediction(payload, NPZ_CONTENT_TYPE) if kind == "npz" else json.loads(payload)
+            if isinstance(prediction, list):
+                results.extend(reprocess_prediction(f"{source}[{index}]", item, id_field) for index, item in enumerate(prediction))
+            else:
+                results.append(reprocess_prediction(source, prediction, id_field))
+        except Exception as e:
+            results.append({"source": source, "id": None, "view": None, "angle": None,
+                            "wheel_centers": [], "message": None, "error": repr(e)})
+    return results
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def write(self, records):
+        self.file.writelines(json.dumps(record) + "\n" for record in records)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes each chunk of records as a row group, pyarrow is only needed for Parquet outputs.
+    """
+
+    def __init__(self, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ValueError("Parquet output needs pyarrow, `pip install pyarrow` or write to .jsonl") from e
+        self.pa = pa
+        self.schema = pa.schema([
+            ("source", pa.string()),
+            ("id", pa.string()),
+            ("view", pa.int8()),
+            ("angle", pa.float64()),
+            ("wheel_centers", pa.list_(pa.list_(pa.float64()))),
+            ("message", pa.string()),
+            ("error", pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, records):
+        self.writer.write_table(self.pa.Table.from_pylist(records, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(output):
+    """
+    Writer for a local path or an `s3://` URI (written locally first, uploaded on close).
+    """
+    writer_class = ParquetWriter if output.endswith(".parquet") else JsonlWriter
+    if not output.startswith("s3://"):
+        return writer_class(output)
+
+    import boto3
+
+    local = tempfile.NamedTemporaryFile(suffix=Path(output).suffix, delete=False)
+    local.close()
+    writer = writer_class(local.name)
+    close = writer.close
+
+    def close_and_upload():
+        close()
+        bucket, _, key = output[len("s3://"):].partition("/")
+        boto3.client("s3").upload_file(local.name, bucket, key)
+        os.remove(local.name)
+    writer.close = close_and_upload
+    return writer
+
+
+def reprocess(inputs, output, workers=None, chunk_size=1000, id_field="s3_key", progress_every=10.0):
+    """
+    Reprocess all records of `inputs` into `output` and return a summary of the run.
+    """
+    workers = workers or os.cpu_count()
+    counters = {"bytes_read": 0, "records": 0, "errors": 0}
+    start = last_progress = time.perf_counter()
+
+    def report_progress(final=False):
+        elapsed = time.perf_counter() - start
+        print(f"{counters['records']} records, {counters['errors']} errors, {counters['records'] / elapsed:.0f} records/s, "
+              f"{counters['bytes_read'] / 2**20:.1f} MiB read{' (done)' if final else ''}", file=sys.stderr)
+
+    writer = open_writer(output)
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            # Bounded so that reading does not run ahead of processing, results are written in input order
+            pending = deque()
+            chunks = _chunked(iter_records(inputs, counters), chunk_size)
+            while True:
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append(pool.submit(process_chunk, chunk, id_field))
+                if not pending:
+                    break
+                if chunk is None or len(pending) >= 2 * workers:
+                    results = pending.popleft().result()
+                    writer.write(results)
+                    counters["records"] += len(results)
+                    counters["errors"] += sum(result["error"] is not None for result in results)
+                    if time.perf_counter() - last_progress >= progress_every:
+                        report_progress()
+                        last_progress = time.perf_counter()
+    finally:
+        writer.close()
+    report_progress(final=True)
+
+    duration = time.perf_counter() - start
+    return {
+        "output": output,
+        "records": counters["records"],
+        "errors": counters["errors"],
+        "bytes_read": counters["bytes_read"],
+        "duration_s": duration,
+        "records_per_s": counters["records"] / duration if duration else None,
+        "workers": workers,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main(args):
+    summary = reprocess(args.inputs, args.output, workers=args.workers, chunk_size=args.chunk_size,
+                        id_field=args.id_field, progress_every=args.progress_every)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="files, directories or s3://bucket/prefix URIs")
+    parser.add_argument("--output", type=str, required=True, help=".jsonl or .parquet, local or s3://")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--id-field", type=str, default="s3_key", help="field of the predictions copied to the output as `id`")
+    parser.add_argument("--progress-every", type=float, default=10.0, help="seconds between progress lines on stderr")
+    main(parser.parse_args())
@@ -0,0 +1,109 @@
+import base64
+import importlib.util
+import json
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+from botocore.stub import Stubber
+
+LAMBDA_DIR = Path(__file__).resolve().parents[2] / "lambda"
+# Same module names as in lambda/car_angle_router/Dockerfile
+MODULES = {
+    "rekognition_app": LAMBDA_DIR / "rekognition_car_angle_detection" / "app.py",
+    "detectron_app": LAMBDA_DIR / "detectron_car_angle_detection" / "app.py",
+    "app": LAMBDA_DIR / "car_angle_router" / "app.py",
+}
+CAR = {"Left": 0.1, "Top": 0.1, "Width": 0.8, "Height": 0.6}
+WHEELS = [
+    {"Left": 0.15, "Top": 0.6, "Width": 0.1, "Height": 0.1},
+    {"Left": 0.7, "Top": 0.55, "Width": 0.1, "Height": 0.1},
+]
+
+
+@pytest.fixture
+def router(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("BUCKET", "test-bucket")
+    monkeypatch.setenv("ENDPOINT_NAME", "detectron-endpoint")
+    monkeypatch.delenv("RESULT_CACHE_DIR", raising=False)
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "common"))
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "detectron_car_angle_detection"))
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "rekognition_car_angle_detection"))
+    for name, path in MODULES.items():
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, name, module)
+        spec.loader.exec_module(module)
+    return sys.modules["app"]
+
+
+def _event(**request):
+    buffered = BytesIO()
+    Image.new("RGB", (64, 48)).save(buffered, format="JPEG")
+    image = "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")
+    return {"body": json.dumps({"image": image, "render": False, **request}), "headers": {"origin": "*"}}
+
+
+def _labels(cars, wheels):
+    return {"Labels": [
+        {"Name": "Car", "Instances": [{"BoundingBox": box} for box in cars]},
+        {"Name": "Wheel", "Instances": [{"BoundingBox": box} for box in wheels]},
+    ]}
+
+
+def test_clean_side_view_stays_on_rekognition(router, monkeypatch):
+    monkeypatch.setattr(router.detectron_app, "predict_boxes", lambda img_string, metrics: pytest.fail("escalated"))
+    with Stubber(router.rekognition_app.rek) as rek_stub:
+        rek_stub.add_response("detect_labels", _labels([CAR], WHEELS))
+        body = json.loads(router.lambda_handler(_event(), None)["body"])
+
+    assert body["tier"] == "rekognition"
+    assert body["angle"] == pytest.approx(3.9005, abs=1e-4)
+    assert router.tier_stats["rekognition"]["resolved"] == 1
+    assert router.tier_stats["detectron"]["requests"] == 0
+
+
+PREDICTION = {
+    "pred_boxes": np.array([[10, 30, 16, 36], [44, 28, 50, 34]], dtype=np.float32),
+    "pred_classes": np.array([18, 18], dtype=np.int32),
+    "image_width": 64,
+    "image_height": 48,
+}
+
+
+@pytest.mark.parametrize("cars, wheels", [
+    ([CAR, CAR], WHEELS),
+    ([CAR], WHEELS[:1]),
+])
+def test_unusable_rekognition_result_escalates_to_detectron(router, monkeypatch, cars, wheels):
+    monkeypatch.setattr(router.detectron_app, "predict_boxes", lambda img_string, metrics: PREDICTION)
+    with Stubber(router.rekognition_app.rek) as rek_stub:
+        rek_stub.add_response("detect_labels", _labels(cars, wheels))
+        body = json.loads(router.lambda_handler(_event(), None)["body"])
+
+    assert body["tier"] == "detectron"
+    assert body["view"] == 2
+    assert body["angle"] == pytest.approx(np.degrees(np.arctan(2 / 34)))
+    assert router.tier_stats["rekognition"]["resolved"] == 0
+    assert router.tier_stats["detectron"] == {**router.tier_stats["detectron"], "requests": 1, "resolved": 1}
+
+
+def test_view_request_goes_straight_to_detectron(router, monkeypatch, capsys):
+    monkeypatch.setattr(router.detectron_app, "predict_boxes", lambda img_string, metrics: PREDICTION)
+    # No response stubbed, calling Rekognition fails the test
+    with Stubber(router.rekognition_app.rek):
+        body = json.loads(router.lambda_handler(_event(view=True), None)["body"])
+
+    assert body["tier"] == "detectron"
+    assert body["view"] == 2
+    assert router.tier_stats["rekognition"]["requests"] == 0
+    assert router.tier_stats["detectron"]["requests"] == 1
+    emf = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert emf["view_requested"] == 1
+    assert emf["escalated"] == 0
+    assert "rekognition_ms" not in emf
@@ -18,13 +18,13 @@ def test_lambda_permission():
     app = core.App()
     stack = CarAngleDetectionStack(app, "car-angle-detection", bucket_name=BUCKET)
     template = assertions.Template.from_stack(stack)
-    template.resource_count_is("AWS::Lambda::Permission", 4)
+    template.resource_count_is("AWS::Lambda::Permission", 6)
 
 def test_lambda_function():
     app = core.App()
     stack = CarAngleDetectionStack(app, "car-angle-detection", bucket_name=BUCKET)
     template = assertions.Template.from_stack(stack)
-    template.resource_count_is("AWS::Lambda::Function", 2)
+    template.resource_count_is("AWS::Lambda::Function", 4)
 
 def test_kms_key():
     app = core.App()
@@ -36,14 +36,14 @@ def test_iam_role():
     app = core.App()
     stack = CarAngleDetectionStack(app, "car-angle-detection", bucket_name=BUCKET)
     template = assertions.Template.from_stack(stack)
-    template.resource_count_is("AWS::IAM::Role", 10)
+    template.resource_count_is("AWS::IAM::Role", 13)
 
 
 def test_iam_policy():
     app = core.App()
     stack = CarAngleDetectionStack(app, "car-angle-detection", bucket_name=BUCKET)
     template = assertions.Template.from_stack(stack)
-    template.resource_count_is("AWS::IAM::Policy", 8)
+    template.resource_count_is("AWS::IAM::Policy", 10)
 
 
 def test_events_rule():
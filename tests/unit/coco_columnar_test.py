@@ -0,0 +1,92 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "car-angle-detection-ml-repo" / "src"))
+from coco_columnar import ColumnarCoco, convert_coco, matches_source  # noqa: E402
+
+COCO = {
+    # Out of id order, like after edits of the file
+    "images": [
+        {"id": 7, "file_name": "b.jpg", "height": 60, "width": 80},
+        {"id": 3, "file_name": "a.jpg", "height": 48, "width": 64},
+        {"id": 9, "file_name": "empty.jpg", "height": 10, "width": 10},
+    ],
+    "annotations": [
+        {"id": 1, "image_id": 7, "category_id": 18, "bbox": [1, 2, 3, 4], "area": 12, "iscrowd": 0,
+         "segmentation": [[1, 2, 4, 2, 4, 6], [0, 0, 1, 1]]},
+        {"id": 2, "image_id": 3, "category_id": 5, "bbox": [5, 6, 7, 8], "area": 56, "iscrowd": 1,
+         "segmentation": [[5, 6, 12, 6, 12, 14, 5, 14]]},
+        {"id": 3, "image_id": 7, "category_id": 5, "bbox": [9, 10, 11, 12], "area": 132, "iscrowd": 0,
+         "segmentation": []},
+    ],
+    "categories": [{"id": 18, "name": "wheel"}, {"id": 5, "name": "front_bumper"}],
+}
+
+
+@pytest.fixture
+def converted(tmp_path):
+    annotations_file = tmp_path / "annotations.json"
+    annotations_file.write_text(json.dumps(COCO))
+    columnar_file = tmp_path / "annotations.npz"
+    convert_coco(str(annotations_file), str(columnar_file))
+    return annotations_file, columnar_file
+
+
+def test_columnar_file_records_its_source(converted):
+    annotations_file, columnar_file = converted
+    assert matches_source(str(columnar_file), str(annotations_file))
+
+    # An npz left over after the JSON was edited
+    coco = dict(COCO, annotations=COCO["annotations"][:2])
+    annotations_file.write_text(json.dumps(coco))
+    assert not matches_source(str(columnar_file), str(annotations_file))
+
+
+def test_annotation_range_and_polygons(converted):
+    _, columnar_file = converted
+    coco = ColumnarCoco(str(columnar_file))
+
+    assert coco.image_ids.tolist() == [3, 7, 9] and len(coco) == 3
+    assert coco.ann_ids[coco.annotation_range(3)].tolist() == [2]
+    # Annotations of an image keep the order of the file
+    assert coco.ann_ids[coco.annotation_range(7)].tolist() == [1, 3]
+    assert coco.annotation_range(9) == slice(3, 3)
+    with pytest.raises(KeyError):
+        coco.annotation_range(4)
+    first = coco.annotation_range(7).start
+    assert [polygon.tolist() for polygon in coco.polygons(first)] == [[1, 2, 4, 2, 4, 6], [0, 0, 1, 1]]
+    assert coco.category_counts() == {"front_bumper": 2, "wheel": 1}
+
+
+def test_dataset_dicts_match_the_json(converted):
+    _, columnar_file = converted
+    records = ColumnarCoco(str(columnar_file)).dataset_dicts("images")
+
+    # Contiguous ids in the order of the category ids, like load_coco_json
+    contiguous_ids = {5: 0, 18: 1}
+    images = {image["id"]: image for image in COCO["images"]}
+    assert [record["image_id"] for record in records] == sorted(images)
+    for record in records:
+        image = images[record["image_id"]]
+        assert record["file_name"] == f"images/{image['file_name']}"
+        assert (record["height"], record["width"]) == (image["height"], image["width"])
+        expected = [annotation for annotation in COCO["annotations"] if annotation["image_id"] == image["id"]]
+        assert len(record["annotations"]) == len(expected)
+        for annotation, source in zip(record["annotations"], expected):
+            assert annotation["bbox"] == source["bbox"]
+            assert annotation["category_id"] == contiguous_ids[source["category_id"]]
+            assert annotation["iscrowd"] == source["iscrowd"] and annotation["bbox_mode"] == 1
+            # Polygons of less than 3 points (6 coordinates) are dropped
+            assert annotation["segmentation"] == [polygon for polygon in source["segmentation"] if len(polygon) >= 6]
+    assert records[1]["annotations"][0]["segmentation"] == [[1, 2, 4, 2, 4, 6]]
+
+
+def test_annotations_of_unknown_images_are_rejected(tmp_path):
+    annotations_file = tmp_path / "annotations.json"
+    annotations_file.write_text(json.dumps(dict(COCO, images=COCO["images"][1:])))
+    with pytest.raises(ValueError):
+        convert_coco(str(annotations_file), str(tmp_path / "annotations.npz"))
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "car-angle-detection-ml-repo" / "src"))
+from evaluate_angles import NO_VIEW, _pack, angles_and_views  # noqa: E402
+from position_detection import CLASS_TO_NUMBER, car_angle_from_bbs  # noqa: E402
+
+# Wheels, bumpers and a class the post-processing ignores
+CLASSES = np.array([CLASS_TO_NUMBER["wheel"]] * 3 + [CLASS_TO_NUMBER["front_bumper"], CLASS_TO_NUMBER["back_bumper"], 4])
+
+
+def _random_predictions(count, seed=0):
+    rng = np.random.default_rng(seed)
+    predictions = []
+    for _ in range(count):
+        num_boxes = int(rng.integers(0, 7))
+        corners = rng.uniform(0, 640, size=(num_boxes, 2))
+        sizes = rng.uniform(5, 120, size=(num_boxes, 2))
+        predictions.append({
+            "pred_boxes": np.hstack([corners, corners + sizes]).astype(np.float32),
+            "pred_classes": rng.choice(CLASSES, size=num_boxes).astype(np.int32),
+            "scores": rng.uniform(0.5, 1.0, size=num_boxes).astype(np.float32),
+        })
+    return predictions
+
+
+def test_angles_and_views_match_the_lambda():
+    predictions = _random_predictions(3000)
+    angles, views = angles_and_views(*_pack(predictions, score_threshold=0.0))
+
+    for prediction, angle, view in zip(predictions, angles, views):
+        expected_view, expected_angle, _ = car_angle_from_bbs(prediction)
+        assert view == (NO_VIEW if expected_view is None else expected_view.value)
+        if expected_angle is None:
+            assert np.isnan(angle)
+        else:
+            # Float64 here, float32 in the Lambda
+            assert angle == pytest.approx(expected_angle, abs=1e-4)
+    # Sanity check of the random predictions: every branch of the post-processing is taken
+    assert {NO_VIEW, 0, 1, 2} <= set(views.tolist()) and (~np.isnan(angles) & (angles != 0)).any()
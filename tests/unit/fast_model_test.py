@@ -0,0 +1,79 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "car-angle-detection-ml-repo" / "src"))
+from fast_model import ALIGNMENT, MAGIC, MAX_FP16_ERROR, read_fast_model, write_fast_model  # noqa: E402
+
+CONFIG = "MODEL:\n  WEIGHTS: ''\n"
+
+
+def _state_dict():
+    generator = torch.Generator().manual_seed(0)
+    return {
+        "conv.weight": torch.randn(8, 3, 3, 3, generator=generator),
+        # Beyond the float16 range, and too small for it: both stay float32
+        "head.bias": torch.tensor([1e5, 1.0, -2.0], dtype=torch.float32),
+        "tiny.scale": torch.tensor([1e-8, 3e-8], dtype=torch.float32),
+        "bn.num_batches_tracked": torch.tensor(12345678901, dtype=torch.int64),
+        "anchors.cell": torch.arange(7, dtype=torch.int64).reshape(7, 1),
+        "empty": torch.zeros(0, 4),
+        "odd.weight": torch.randn(5, generator=generator),
+    }
+
+
+def _header(path):
+    data = path.read_bytes()
+    length = int(np.frombuffer(data[len(MAGIC):len(MAGIC) + 8], dtype="<u8")[0])
+    return json.loads(data[len(MAGIC) + 8:len(MAGIC) + 8 + length])
+
+
+def test_round_trip(tmp_path):
+    state_dict = _state_dict()
+    path = write_fast_model(state_dict, CONFIG, tmp_path / "model.bin")
+    config, loaded = read_fast_model(path)
+
+    assert config == CONFIG and list(loaded) == list(state_dict)
+    entries = _header(path)["tensors"]
+    # float16 where it keeps the tensor, float32 otherwise, other dtypes as they are
+    assert entries["conv.weight"]["dtype"] == "float16" and loaded["conv.weight"].dtype == torch.float16
+    assert entries["head.bias"]["dtype"] == "float32" and entries["tiny.scale"]["dtype"] == "float32"
+    assert entries["bn.num_batches_tracked"]["dtype"] == "int64"
+    for name, tensor in state_dict.items():
+        assert loaded[name].shape == tensor.shape
+        scale = tensor.abs().max().item() if tensor.numel() and tensor.is_floating_point() else 0
+        torch.testing.assert_close(loaded[name].to(tensor.dtype), tensor, rtol=0, atol=MAX_FP16_ERROR * scale)
+    assert torch.equal(loaded["head.bias"], state_dict["head.bias"])
+    assert torch.equal(loaded["tiny.scale"], state_dict["tiny.scale"])
+    assert loaded["bn.num_batches_tracked"].item() == 12345678901
+
+
+def test_tensors_are_aligned(tmp_path):
+    path = write_fast_model(_state_dict(), CONFIG, tmp_path / "model.bin")
+    header = _header(path)
+    header_length = len(json.dumps(header).encode())
+    data_start = (len(MAGIC) + 8 + header_length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    assert all((data_start + entry["offset"]) % ALIGNMENT == 0 for entry in header["tensors"].values())
+    # Views of the memory map, each starting on an aligned address of the file
+    _, loaded = read_fast_model(path)
+    assert all(tensor.data_ptr() % ALIGNMENT == 0 for tensor in loaded.values() if tensor.numel())
+
+
+def test_device_restores_the_original_dtypes(tmp_path):
+    state_dict = _state_dict()
+    path = write_fast_model(state_dict, CONFIG, tmp_path / "model.bin")
+    _, loaded = read_fast_model(path, device="cpu")
+    assert {name: tensor.dtype for name, tensor in loaded.items()} == {name: tensor.dtype for name, tensor in state_dict.items()}
+    # Copies, not views of the memory map
+    loaded["conv.weight"] += 1
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / "model_final.pth"
+    path.write_bytes(b"PK\x03\x04" + bytes(64))
+    with pytest.raises(ValueError):
+        read_fast_model(path)
@@ -0,0 +1,75 @@
+import json
+import pickle
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("PIL")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "car-angle-detection-ml-repo" / "src"))
+from image_cache import ImageCache, build_image_cache, cache_matches  # noqa: E402
+
+MIN_SIZE, MAX_SIZE = 128, 224
+# (height, width): larger than the training sizes, very wide, and smaller than them (never upscaled)
+SHAPES = {1: (480, 640), 2: (200, 900), 3: (90, 120)}
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    images = []
+    for image_id, (height, width) in SHAPES.items():
+        # Smooth content, so that the resized cache can be compared with the original
+        y, x = np.mgrid[0:height, 0:width]
+        image = np.stack([x * 255 // width, y * 255 // height, np.full_like(x, 40 * image_id)], axis=-1).astype(np.uint8)
+        cv2.imwrite(str(tmp_path / f"{image_id}.jpg"), image)
+        images.append({"id": image_id, "file_name": f"{image_id}.jpg", "height": height, "width": width})
+    annotations_file = tmp_path / "annotations.json"
+    annotations_file.write_text(json.dumps({"images": images, "annotations": [], "categories": []}))
+    return tmp_path, str(annotations_file)
+
+
+def test_cached_images_fit_the_training_sizes(dataset):
+    data_dir, annotations_file = dataset
+    cache_dir = str(data_dir / "cache")
+    stats = build_image_cache(annotations_file, str(data_dir), cache_dir, MIN_SIZE, MAX_SIZE)
+    cache = ImageCache(cache_dir)
+
+    assert stats["num_images"] == len(cache) == 3 and 4 not in cache
+    for image_id, original_shape in SHAPES.items():
+        image, cached_original_shape = cache.get(image_id)
+        assert cached_original_shape == original_shape
+        assert min(image.shape[:2]) <= MIN_SIZE and max(image.shape[:2]) <= MAX_SIZE
+        assert image.shape[2] == 3 and image.dtype == np.uint8
+        assert not image.flags.writeable
+        original = cv2.imread(str(data_dir / f"{image_id}.jpg"))
+        resized = cv2.resize(original, image.shape[1::-1], interpolation=cv2.INTER_AREA)
+        assert np.abs(resized.astype(int) - image).mean() < 8
+    # Downscaled with the aspect ratio kept, small images are not upscaled
+    assert cache.get(1)[0].shape[:2] == (128, 171)
+    assert cache.get(2)[0].shape[:2] == (50, 224)
+    assert cache.get(3)[0].shape[:2] == (90, 120)
+    # DataLoader workers map the data file themselves
+    assert pickle.loads(pickle.dumps(cache))._data is None
+
+
+def test_cache_is_rebuilt_when_sizes_or_annotations_change(dataset):
+    data_dir, annotations_file = dataset
+    cache_dir = str(data_dir / "cache")
+    assert not cache_matches(cache_dir, annotations_file, MIN_SIZE, MAX_SIZE)
+    build_image_cache(annotations_file, str(data_dir), cache_dir, MIN_SIZE, MAX_SIZE)
+
+    assert cache_matches(cache_dir, annotations_file, MIN_SIZE, MAX_SIZE)
+    assert not cache_matches(cache_dir, annotations_file, 64, MAX_SIZE)
+    assert not cache_matches(cache_dir, annotations_file, MIN_SIZE, 1333)
+
+    annotations = json.loads(Path(annotations_file).read_text())
+    annotations["images"] = annotations["images"][:2]
+    Path(annotations_file).write_text(json.dumps(annotations))
+    assert not cache_matches(cache_dir, annotations_file, MIN_SIZE, MAX_SIZE)
+
+    build_image_cache(annotations_file, str(data_dir), cache_dir, 64, MAX_SIZE)
+    assert cache_matches(cache_dir, annotations_file, 64, MAX_SIZE)
+    cache = ImageCache(cache_dir)
+    assert len(cache) == 2 and min(cache.get(1)[0].shape[:2]) == 64
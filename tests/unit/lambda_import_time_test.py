@@ -0,0 +1,36 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lambda"))
+from import_time_report import HANDLERS, import_time_report, parse_importtime  # noqa: E402
+
+# Generous by default so that the test is stable on shared CI runners, lower it to track regressions
+IMPORT_BUDGET_MS = float(os.environ.get("LAMBDA_IMPORT_BUDGET_MS", 3000))
+# Only needed to render the annotated image, geometry-only requests must not pay for them
+RENDERING_MODULES = {"PIL.ImageDraw", "PIL.ImageFont"}
+
+
+def test_parse_importtime():
+    stderr = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       120 |        120 |   _io\n"
+        "import time:        30 |         30 |     math\n"
+        "import time:       500 |        530 |   numpy\n"
+        "import time:        10 |        660 | app\n"
+    )
+    assert parse_importtime(stderr) == [
+        ("_io", 120, 120, 1), ("math", 30, 30, 2), ("numpy", 500, 530, 1), ("app", 10, 660, 0),
+    ]
+
+
+@pytest.mark.parametrize("handler", sorted(HANDLERS))
+def test_handler_import_within_budget(handler):
+    report = import_time_report(handler)
+
+    assert not RENDERING_MODULES & set(report["modules"])
+    assert report["init_duration_ms"] < IMPORT_BUDGET_MS, report["packages_ms"]
@@ -0,0 +1,169 @@
+import base64
+import importlib.util
+import json
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+LAMBDA_DIR = Path(__file__).resolve().parents[2] / "lambda"
+sys.path.insert(0, str(LAMBDA_DIR / "common"))
+import metrics  # noqa: E402
+
+
+def _emitted(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+
+
+def test_emf_document(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "_cold_start", True)
+    invocation = metrics.InvocationMetrics("rekognition", namespace="Test")
+    with invocation.stage("detect"):
+        pass
+    invocation.put("image_bytes", 1024, metrics.BYTES)
+    invocation.set_property("render", False)
+    invocation.flush()
+
+    [document] = _emitted(capsys)
+    directive = document["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["Service"]]
+    units = {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+    assert units == {"ColdStart": "Count", "detect_ms": "Milliseconds", "image_bytes": "Bytes", "total_ms": "Milliseconds"}
+    # Every metric needs a value at the root of the document
+    assert all(name in document for name in units)
+    assert document["Service"] == "rekognition" and document["render"] is False and document["ColdStart"] == 1
+
+
+def test_cold_start_is_always_emitted_and_warm_invocations_sampled(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "_cold_start", True)
+    cold = metrics.InvocationMetrics("detectron", sample_rate=0.0)
+    warm = metrics.InvocationMetrics("detectron", sample_rate=0.0)
+    cold.flush()
+    warm.flush()
+    assert [document["ColdStart"] for document in _emitted(capsys)] == [1]
+
+    metrics.InvocationMetrics("detectron", sample_rate=1.0).flush()
+    assert [document["ColdStart"] for document in _emitted(capsys)] == [0]
+
+
+def test_values_added_per_item_are_summed(monkeypatch):
+    monkeypatch.setattr(metrics, "_cold_start", False)
+    invocation = metrics.InvocationMetrics("detectron")
+    for _ in range(3):
+        with invocation.stage("endpoint", accumulate=True):
+            pass
+        invocation.add("endpoint_response_bytes", 100, metrics.BYTES)
+    invocation.put("boxes", 2)
+    invocation.put("boxes", 5)
+    assert invocation.values["endpoint_response_bytes"] == 300
+    assert invocation.units["endpoint_response_bytes"] == metrics.BYTES
+    assert invocation.values["endpoint_ms"] >= 0
+    assert invocation.values["boxes"] == 5
+
+
+def _detectron_app(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("ENDPOINT_NAME", "detectron-endpoint")
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "detectron_car_angle_detection"))
+    spec = importlib.util.spec_from_file_location("detectron_app", LAMBDA_DIR / "detectron_car_angle_detection" / "app.py")
+    app = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, "detectron_app", app)
+    spec.loader.exec_module(app)
+    return app
+
+
+def _jpeg_and_prediction(np, Image):
+    image = BytesIO()
+    Image.new("RGB", (64, 48)).save(image, format="JPEG")
+    prediction = BytesIO()
+    np.savez(
+        prediction,
+        meta=np.frombuffer(json.dumps({"image_width": 64, "image_height": 48}).encode("utf-8"), dtype=np.uint8),
+        pred_boxes=np.array([[10, 30, 16, 36], [44, 28, 50, 34]], dtype=np.float32),
+        pred_classes=np.array([18, 18], dtype=np.int32),
+    )
+    return image.getvalue(), prediction.getvalue()
+
+
+def test_detectron_handler_emits_stage_timings(monkeypatch, capsys):
+    np = pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    app = _detectron_app(monkeypatch)
+    image, prediction = _jpeg_and_prediction(np, Image)
+    event = {
+        "body": json.dumps({"image": "data:image/jpeg;base64," + base64.b64encode(image).decode("utf-8"), "render": False}),
+        "headers": {"origin": "*"},
+    }
+
+    with Stubber(app.runtime) as runtime_stub:
+        runtime_stub.add_response("invoke_endpoint", {"Body": StreamingBody(BytesIO(prediction), len(prediction))})
+        app.lambda_handler(event, None)
+
+    [document] = _emitted(capsys)
+    assert document["Service"] == "detectron"
+    for stage in ("read_image", "downscale", "endpoint", "decode", "angle", "geometry", "total"):
+        assert document[f"{stage}_ms"] >= 0
+    assert document["boxes"] == 2 and document["wheels"] == 2
+    assert document["endpoint_response_bytes"] == len(prediction) and document["endpoint_calls"] == 1
+
+
+def test_endpoint_metrics_of_video_frames_are_summed(monkeypatch):
+    np = pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    app = _detectron_app(monkeypatch)
+    image, prediction = _jpeg_and_prediction(np, Image)
+    invocation = metrics.InvocationMetrics("detectron")
+    with Stubber(app.runtime) as runtime_stub:
+        for _ in range(3):
+            runtime_stub.add_response("invoke_endpoint", {"Body": StreamingBody(BytesIO(prediction), len(prediction))})
+        for _ in range(3):
+            app.predict_boxes(image, invocation)
+
+    assert invocation.values["endpoint_calls"] == 3
+    assert invocation.values["boxes"] == 6
+    assert invocation.values["endpoint_request_bytes"] == 3 * len(image)
+    assert invocation.values["endpoint_response_bytes"] == 3 * len(prediction)
+
+
+def test_video_frames_are_sent_in_one_batch_request(monkeypatch):
+    np = pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    from botocore.response import StreamingBody
+    from botocore.stub import ANY, Stubber
+
+    app = _detectron_app(monkeypatch)
+    frames = [np.full((48, 64, 3), value, dtype=np.uint8) for value in (0, 128, 255)]
+    prediction = BytesIO()
+    arrays = {"batch_size": np.array(len(frames))}
+    for index in range(len(frames)):
+        arrays[f"{index}/meta"] = np.frombuffer(json.dumps({"image_width": 64, "image_height": 48}).encode("utf-8"), dtype=np.uint8)
+        arrays[f"{index}/pred_boxes"] = np.array([[10, 30, 16, 36]] * (index + 1), dtype=np.float32)
+        arrays[f"{index}/pred_classes"] = np.array([18] * (index + 1), dtype=np.int32)
+    np.savez(prediction, **arrays)
+    prediction = prediction.getvalue()
+
+    invocation = metrics.InvocationMetrics("detectron")
+    with Stubber(app.runtime) as runtime_stub:
+        runtime_stub.add_response("invoke_endpoint", {"Body": StreamingBody(BytesIO(prediction), len(prediction))}, {
+            "EndpointName": "detectron-endpoint", "ContentType": app.ENDPOINT_BATCH_CONTENT_TYPE,
+            "Accept": ANY, "Body": ANY})
+        results = app.predict_frames(frames, invocation)
+
+    assert [len(result["pred_classes"]) for result in results] == [1, 2, 3]
+    assert invocation.values["endpoint_calls"] == 1 and invocation.values["boxes"] == 6
+
+
+def test_video_request_without_a_key_is_rejected(monkeypatch, capsys):
+    app = _detectron_app(monkeypatch)
+    response = app.lambda_handler({"body": json.dumps({"video": True}), "headers": {"origin": "*"}}, None)
+    assert response["statusCode"] == 400
+    assert "s3_key" in json.loads(response["body"])["message"]
+    assert response["headers"]["Access-Control-Allow-Origin"] == "*"
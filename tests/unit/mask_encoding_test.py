@@ -0,0 +1,47 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("pycocotools")
+pytest.importorskip("PIL")
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "car-angle-detection-ml-repo" / "src"))
+sys.path.insert(0, str(ROOT / "lambda" / "detectron_car_angle_detection"))
+from mask_encoding import MASK_FORMATS, encode_mask  # noqa: E402
+from prediction_decoding import decode_mask  # noqa: E402
+
+
+def _car_mask(height=61, width=83):
+    # Odd sizes so that the bitpack buffer does not end on a byte boundary
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (40, 30), (30, 18), 15, 0, 360, 1, -1)
+    cv2.rectangle(mask, (5, 50), (20, 58), 1, -1)
+    return mask.astype(bool)
+
+
+@pytest.mark.parametrize("mask_format", ["rle", "bitpack"])
+def test_lossless_formats_round_trip(mask_format):
+    mask = _car_mask()
+    # Through JSON, like the endpoint response
+    decoded = decode_mask(json.loads(json.dumps(encode_mask(mask, mask_format))))
+    assert decoded.dtype == bool and decoded.shape == mask.shape
+    np.testing.assert_array_equal(decoded, mask)
+
+
+def test_polygon_round_trip_keeps_the_shape():
+    mask = _car_mask()
+    decoded = decode_mask(json.loads(json.dumps(encode_mask(mask, "polygon"))))
+    assert decoded.shape == mask.shape
+    iou = np.logical_and(decoded, mask).sum() / np.logical_or(decoded, mask).sum()
+    assert iou > 0.95
+
+
+@pytest.mark.parametrize("mask_format", MASK_FORMATS)
+def test_empty_and_missing_masks(mask_format):
+    empty = np.zeros((7, 9), dtype=bool)
+    np.testing.assert_array_equal(decode_mask(encode_mask(empty, mask_format)), empty)
+    assert encode_mask(None, mask_format) is None and decode_mask(None) is None
@@ -0,0 +1,156 @@
+import json
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+from botocore.response import StreamingBody
+from botocore.stub import ANY, Stubber
+
+LAMBDA_DIR = Path(__file__).resolve().parents[2] / "lambda"
+BUCKET = "test-bucket"
+LABELS = {"Labels": [
+    {"Name": "Car", "Instances": [{"BoundingBox": {"Left": 0.1, "Top": 0.1, "Width": 0.8, "Height": 0.6}}]},
+    {"Name": "Wheel", "Instances": [
+        {"BoundingBox": {"Left": 0.15, "Top": 0.6, "Width": 0.1, "Height": 0.1}},
+        {"BoundingBox": {"Left": 0.7, "Top": 0.55, "Width": 0.1, "Height": 0.1}},
+    ]},
+]}
+
+
+@pytest.fixture
+def bulk(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("BUCKET", BUCKET)
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "common"))
+    monkeypatch.syspath_prepend(str(LAMBDA_DIR / "rekognition_car_angle_detection"))
+    for module in ("app", "bulk"):
+        monkeypatch.delitem(sys.modules, module, raising=False)
+    import bulk
+    monkeypatch.setattr(bulk, "BULK_MAX_WORKERS", 1)
+    yield bulk
+    for module in ("app", "bulk"):
+        sys.modules.pop(module, None)
+
+
+def _jpeg(width=64, height=48):
+    buffered = BytesIO()
+    Image.new("RGB", (width, height)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def test_bulk_handler_writes_one_line_per_image(bulk):
+    img_bytes = _jpeg()
+    keys = ["uploads/a.jpg", "uploads/b.jpg"]
+    uploaded = {}
+
+    with Stubber(bulk.s3) as s3_stub, Stubber(bulk.rek) as rek_stub:
+        s3_stub.add_response("list_objects_v2", {"Contents": [{"Key": key} for key in keys] + [{"Key": "uploads/"}]},
+                             {"Bucket": BUCKET, "Prefix": "uploads/"})
+        for key in keys:
+            s3_stub.add_response("get_object", {"Body": StreamingBody(BytesIO(img_bytes), len(img_bytes))},
+                                 {"Bucket": BUCKET, "Key": key, "Range": ANY})
+            rek_stub.add_response("detect_labels", LABELS,
+                                  {"Image": {"S3Object": {"Bucket": BUCKET, "Name": key}}, "MinConfidence": 80})
+
+        def put_object(Bucket, Key, Body):
+            uploaded[(Bucket, Key)] = Body.decode("utf-8")
+        bulk.s3.put_object = put_object
+
+        summary = bulk.lambda_handler({"s3_prefix": "uploads/", "output_key": "out.jsonl"}, None)
+
+    assert summary["count"] == 2 and summary["errors"] == 0 and summary["continuation"] is None
+    records = [json.loads(line) for line in uploaded[(BUCKET, "out.jsonl")].splitlines()]
+    assert sorted(record["s3_key"] for record in records) == keys
+    assert all(record["angle"] == pytest.approx(3.9005, abs=1e-4) for record in records)
+    # Pixel boxes of the 64x48 image, like the geometry of `"render": false` requests
+    assert records[0]["car_boxes"] == [pytest.approx([6.4, 4.8, 57.6, 33.6])]
+    assert records[0]["wheel_boxes"][0] == pytest.approx([9.6, 28.8, 16.0, 33.6])
+    assert (records[0]["image_width"], records[0]["image_height"]) == (64, 48)
+
+
+def test_bulk_handler_records_failed_images(bulk):
+    uploaded = {}
+    with Stubber(bulk.s3) as s3_stub:
+        s3_stub.add_client_error("get_object", "NoSuchKey")
+
+        def put_object(Bucket, Key, Body):
+            uploaded[Key] = Body.decode("utf-8")
+        bulk.s3.put_object = put_object
+
+        summary = bulk.lambda_handler({"s3_keys": ["missing.jpg"], "output_key": "out.jsonl"}, None)
+
+    assert summary["errors"] == 1
+    assert "NoSuchKey" in json.loads(uploaded["out.jsonl"])["error"]
+
+
+def _fake_detect(bucket, key):
+    return {"s3_key": key, "angle": 1.0}
+
+
+def test_bulk_output_is_uploaded_in_parts_as_results_come(bulk, monkeypatch):
+    monkeypatch.setattr(bulk, "detect_car_angle", _fake_detect)
+    monkeypatch.setattr(bulk, "BULK_PART_BYTES", 64)
+    keys = [f"uploads/{i}.jpg" for i in range(5)]
+    lines = [(json.dumps(_fake_detect(BUCKET, key)) + "\n").encode("utf-8") for key in keys]
+    # Each part is uploaded once it holds 64 bytes: 2 lines each, the last one with the rest
+    parts = [lines[0] + lines[1], lines[2] + lines[3], lines[4]]
+
+    with Stubber(bulk.s3) as s3_stub:
+        s3_stub.add_response("create_multipart_upload", {"UploadId": "upload"}, {"Bucket": BUCKET, "Key": "out.jsonl"})
+        for number, part in enumerate(parts, start=1):
+            s3_stub.add_response("upload_part", {"ETag": f"etag{number}"}, {
+                "Bucket": BUCKET, "Key": "out.jsonl", "UploadId": "upload", "PartNumber": number, "Body": part})
+        s3_stub.add_response("complete_multipart_upload", {}, {
+            "Bucket": BUCKET, "Key": "out.jsonl", "UploadId": "upload",
+            "MultipartUpload": {"Parts": [{"ETag": f"etag{number}", "PartNumber": number} for number in (1, 2, 3)]}})
+
+        summary = bulk.lambda_handler({"s3_keys": keys, "output_key": "out.jsonl"}, None)
+        s3_stub.assert_no_pending_responses()
+    assert summary["count"] == 5
+
+
+class _Context:
+    aws_request_id = "request"
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = iter(remaining_ms)
+
+    def get_remaining_time_in_millis(self):
+        return next(self.remaining_ms)
+
+
+def test_bulk_handler_stops_before_the_timeout_and_returns_a_continuation(bulk, monkeypatch):
+    monkeypatch.setattr(bulk, "detect_car_angle", _fake_detect)
+    keys = [f"uploads/{i}.jpg" for i in range(5)]
+    uploaded = {}
+
+    def put_object(Bucket, Key, Body):
+        uploaded[Key] = Body.decode("utf-8")
+    monkeypatch.setattr(bulk.s3, "put_object", put_object)
+
+    # Enough time for 2 images, then within the stop margin
+    context = _Context([10 * 60 * 1000] * 2 + [bulk.BULK_STOP_MARGIN_MS - 1] * 10)
+    summary = bulk.lambda_handler({"s3_keys": keys, "output_key": "out.jsonl"}, context)
+
+    assert summary["count"] == 2
+    assert [json.loads(line)["s3_key"] for line in uploaded["out.jsonl"].splitlines()] == keys[:2]
+    assert summary["continuation"] == {"s3_keys": keys[2:]}
+
+
+def test_bulk_continuation_of_a_prefix_starts_after_the_last_key(bulk, monkeypatch):
+    monkeypatch.setattr(bulk, "detect_car_angle", _fake_detect)
+    monkeypatch.setattr(bulk.s3, "put_object", lambda **kwargs: None)
+    keys = [f"uploads/{i}.jpg" for i in range(3)]
+
+    with Stubber(bulk.s3) as s3_stub:
+        s3_stub.add_response("list_objects_v2", {"Contents": [{"Key": key} for key in keys[1:]]},
+                             {"Bucket": BUCKET, "Prefix": "uploads/", "StartAfter": keys[0]})
+        context = _Context([10 * 60 * 1000] + [0] * 10)
+        summary = bulk.lambda_handler({"s3_prefix": "uploads/", "start_after": keys[0]}, context)
+
+    assert summary["count"] == 1
+    assert summary["continuation"] == {"s3_prefix": "uploads/", "start_after": keys[1]}
@@ -0,0 +1,90 @@
+import json
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lambda"))
+import reprocess_predictions  # noqa: E402
+from position_detection import car_angle_from_bbs  # noqa: E402
+
+SIDE_VIEW = {"pred_boxes": [[10, 30, 16, 36], [44, 28, 50, 34]], "pred_classes": [18, 18]}
+FRONT_VIEW = {"pred_boxes": [[10, 30, 16, 36], [44, 28, 50, 34], [0, 0, 60, 20]], "pred_classes": [18, 18, 7]}
+ONE_WHEEL = {"pred_boxes": [[10, 30, 16, 36]], "pred_classes": [18]}
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    with open(tmp_path / "a.jsonl", "w") as file:
+        for index in range(25):
+            prediction = [SIDE_VIEW, FRONT_VIEW, ONE_WHEEL][index % 3]
+            file.write(json.dumps({**prediction, "s3_key": f"uploads/{index}.jpg"}) + "\n")
+        file.write("not json\n")
+    (tmp_path / "nested").mkdir()
+    with open(tmp_path / "nested" / "b.json", "w") as file:
+        json.dump([SIDE_VIEW, FRONT_VIEW], file)
+    npz = BytesIO()
+    np.savez(npz, meta=np.frombuffer(json.dumps({"image_width": 64, "image_height": 48}).encode("utf-8"), dtype=np.uint8),
+             pred_boxes=np.array(SIDE_VIEW["pred_boxes"], dtype=np.float32),
+             pred_classes=np.array(SIDE_VIEW["pred_classes"], dtype=np.int32))
+    (tmp_path / "nested" / "c.npz").write_bytes(npz.getvalue())
+    return tmp_path
+
+
+def test_reprocess_to_jsonl_keeps_input_order(inputs, tmp_path):
+    output = tmp_path / "out.jsonl"
+    summary = reprocess_predictions.reprocess([str(inputs)], str(output), workers=2, chunk_size=4)
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert summary["records"] == len(records) == 29
+    assert summary["errors"] == 1
+    assert [record["source"].rsplit("/", 1)[-1] for record in records[:2]] == ["a.jsonl:1", "a.jsonl:2"]
+    assert records[25]["error"] is not None
+    assert [record["source"].rsplit("/", 1)[-1] for record in records[26:]] == ["b.json[0]", "b.json[1]", "c.npz"]
+
+    for record, prediction in zip(records[:25], [SIDE_VIEW, FRONT_VIEW, ONE_WHEEL] * 9):
+        view, angle, _ = car_angle_from_bbs(prediction)
+        assert record["view"] == (None if view is None else view.value)
+        assert record["angle"] == (None if angle is None else float(angle))
+    assert records[0]["id"] == "uploads/0.jpg"
+    assert records[2]["message"].startswith("Nr. of detected wheels")
+    # NPZ boxes are float32
+    assert records[28]["angle"] == pytest.approx(records[0]["angle"], rel=1e-6)
+
+
+def test_reprocess_to_parquet(inputs, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    output = tmp_path / "out.parquet"
+    reprocess_predictions.reprocess([str(inputs / "a.jsonl")], str(output), workers=1, chunk_size=10)
+
+    table = pq.read_table(output)
+    assert table.num_rows == 26
+    assert table.column("view").to_pylist()[:3] == [2, 1, None]
+
+
+def test_reprocess_s3_jsonl_keeps_long_records_whole(monkeypatch, tmp_path):
+    boto3 = pytest.importorskip("boto3")
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # Longer than the 1 KiB chunks of StreamingBody
+    padding = "x" * 3000
+    body = "".join(json.dumps({**SIDE_VIEW, "s3_key": f"uploads/{index}.jpg", "padding": padding}) + "\n" for index in range(3)).encode()
+    s3 = boto3.client("s3")
+    monkeypatch.setattr(boto3, "client", lambda service: s3)
+
+    output = tmp_path / "out.jsonl"
+    with Stubber(s3) as stub:
+        stub.add_response("list_objects_v2", {"Contents": [{"Key": "predictions/a.jsonl"}]},
+                          {"Bucket": "bucket", "Prefix": "predictions/"})
+        stub.add_response("get_object", {"Body": StreamingBody(BytesIO(body), len(body))},
+                          {"Bucket": "bucket", "Key": "predictions/a.jsonl"})
+        summary = reprocess_predictions.reprocess(["s3://bucket/predictions/"], str(output), workers=1)
+
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert summary["errors"] == 0
+    assert [record["source"] for record in records] == [f"s3://bucket/predictions/a.jsonl:{number}" for number in (1, 2, 3)]
+    assert [record["id"] for record in records] == [f"uploads/{index}.jpg" for index in range(3)]
@@ -0,0 +1,74 @@
+import json
+import os
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("boto3")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lambda" / "rekognition_car_angle_detection"))
+from result_cache import ResultCache, cache_key  # noqa: E402
+
+# 10 bytes once serialized
+VALUE = {"a": "12"}
+
+
+def test_cache_key_depends_on_image_and_settings():
+    assert cache_key(b"image", 80) == cache_key(b"image", 80)
+    assert cache_key(b"image", 80) != cache_key(b"image", 90)
+    assert cache_key(b"image", 80) != cache_key(b"other", 80)
+
+
+def test_memory_tier_evicts_least_recently_used_beyond_max_bytes():
+    cache = ResultCache(max_bytes=25)
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    assert cache.get("a") == VALUE
+    cache.put("c", VALUE)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == VALUE and cache.get("c") == VALUE
+    assert cache.stats["evictions"] == 1 and cache.stats["misses"] == 1 and cache.stats["memory_hits"] == 3
+
+
+def test_dir_tier_survives_a_new_process_and_evicts_oldest_files(tmp_path):
+    cache = ResultCache(max_bytes=0, cache_dir=str(tmp_path), max_dir_bytes=25)
+    cache.put("a", VALUE)
+    cache.put("b", VALUE)
+    os.utime(tmp_path / "a", ns=(1, 1))
+    os.utime(tmp_path / "b", ns=(2, 2))
+
+    # A cold start reads the directory written by the previous execution environment
+    cache = ResultCache(max_bytes=0, cache_dir=str(tmp_path), max_dir_bytes=25)
+    # Reading refreshes the mtime, so "b" becomes the least recently used file
+    assert cache.get("a") == VALUE and cache.stats["dir_hits"] == 1
+    cache.put("c", VALUE)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a", "c"]
+    assert cache.stats["dir_evictions"] == 1
+    assert cache.get("b") is None
+
+
+def test_s3_tier(monkeypatch):
+    import boto3
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    cache = ResultCache(max_bytes=0, s3_bucket="bucket", s3_prefix="results/")
+    cache._s3 = boto3.client("s3", aws_access_key_id="test", aws_secret_access_key="test")
+    data = json.dumps(VALUE).encode("utf-8")
+
+    with Stubber(cache._s3) as s3_stub:
+        s3_stub.add_client_error("get_object", service_error_code="NoSuchKey", http_status_code=404,
+                                 expected_params={"Bucket": "bucket", "Key": "results/key"})
+        s3_stub.add_response("put_object", {}, {"Bucket": "bucket", "Key": "results/key", "Body": data})
+        s3_stub.add_response("get_object", {"Body": StreamingBody(BytesIO(data), len(data))},
+                             {"Bucket": "bucket", "Key": "results/key"})
+
+        assert cache.get("key") is None
+        cache.put("key", VALUE)
+        assert cache.get("key") == VALUE
+        s3_stub.assert_no_pending_responses()
+    assert cache.stats["s3_hits"] == 1 and cache.stats["misses"] == 1
@@ -0,0 +1,46 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("detectron2")
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "car-angle-detection-ml-repo" / "src"))
+import train  # noqa: E402
+
+
+def _write_dataset(data_dir, num_images=4):
+    rng = np.random.default_rng(0)
+    images, annotations = [], []
+    for image_id in range(1, num_images + 1):
+        file_name = f"{image_id}.jpg"
+        cv2.imwrite(str(data_dir / file_name), rng.integers(0, 255, (120, 160, 3), dtype=np.uint8))
+        images.append({"id": image_id, "file_name": file_name, "height": 120, "width": 160})
+        for i, (x, y) in enumerate([(20, 70), (110, 70)]):
+            annotations.append({
+                "id": image_id * 10 + i, "image_id": image_id, "category_id": 18, "iscrowd": 0,
+                "bbox": [x, y, 30, 30], "area": 900,
+                "segmentation": [[x, y, x + 30, y, x + 30, y + 30, x, y + 30]],
+            })
+    with open(data_dir / "annotations.json", "w") as file:
+        json.dump({"images": images, "annotations": annotations, "categories": [{"id": 18, "name": "wheel"}]}, file)
+
+
+def test_tiny_training_runs_on_cpu_into_temporary_directories(tmp_path, monkeypatch):
+    monkeypatch.delenv("SM_MODEL_DIR", raising=False)
+    monkeypatch.setattr(train.tempfile, "tempdir", str(tmp_path))
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    _write_dataset(data_dir)
+
+    args = train.parse_args(["--tiny", "--train-data-dir", str(data_dir), "--val-data-dir", str(data_dir)])
+    assert args.output_dir.startswith(str(tmp_path)) and args.image_cache_dir.startswith(str(tmp_path))
+    train.train(args)
+
+    output_dir = Path(args.output_dir)
+    for file_name in ("model_final.pth", "config.yaml", "throughput.json"):
+        assert (output_dir / file_name).exists()
+    with open(output_dir / "throughput.json") as file:
+        assert len(json.load(file)["per_iteration"]) == train.TINY_MAX_ITER
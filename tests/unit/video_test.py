@@ -0,0 +1,84 @@
+import math
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+LAMBDA_DIR = Path(__file__).resolve().parents[2] / "lambda"
+sys.path.insert(0, str(LAMBDA_DIR / "common"))
+sys.path.insert(0, str(LAMBDA_DIR / "detectron_car_angle_detection"))
+import video  # noqa: E402
+
+FPS = 30
+WIDTH, HEIGHT = 320, 240
+WHEEL_DISTANCE = 160
+
+
+def _angles():
+    """Angle of the car in each frame: still for 1 s, turning from 0 to 20 degrees in 1 s, still for 1 s"""
+    return [0.0] * FPS + list(np.linspace(0, 20, FPS)) + [20.0] * FPS
+
+
+def _write_video(path):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), FPS, (WIDTH, HEIGHT))
+    for angle in _angles():
+        frame = np.full((HEIGHT, WIDTH, 3), 255, dtype=np.uint8)
+        dx = WHEEL_DISTANCE / 2 * math.cos(math.radians(angle))
+        dy = WHEEL_DISTANCE / 2 * math.sin(math.radians(angle))
+        for sign in (-1, 1):
+            center = (int(round(WIDTH / 2 + sign * dx)), int(round(HEIGHT / 2 + sign * dy)))
+            cv2.circle(frame, center, 15, (0, 0, 0), -1)
+        writer.write(frame)
+    writer.release()
+
+
+@pytest.fixture(scope="module")
+def video_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("video") / "walkaround.avi"
+    _write_video(path)
+    return path
+
+
+def test_iter_frames_streams_and_subsamples(video_path):
+    frames = video.iter_frames(video_path, max_fps=10, max_side=160)
+    index, timestamp, frame = next(frames)
+    assert (index, timestamp, frame.shape) == (0, 0.0, (120, 160, 3))
+    assert [index for index, _, _ in frames][:3] == [3, 6, 9]
+
+
+def test_angle_track_drops_still_frames_and_follows_the_turn(video_path):
+    result = video.car_angle_track(video_path, video.stub_wheel_detector)
+
+    # Most frames of the two still seconds are dropped, the turning frames are kept
+    assert result["kept_frames"] + result["dropped_frames"] == len(_angles())
+    assert result["dropped_frames"] >= FPS
+    track = result["track"]
+    assert track[0]["angle"] == pytest.approx(0, abs=1)
+    assert track[-1]["angle"] == pytest.approx(20, abs=1)
+    # The smoothed track lags behind but stays within the range of the raw angles
+    smoothed = [entry["smoothed_angle"] for entry in track]
+    assert all(-1 <= angle <= 21 for angle in smoothed)
+    assert smoothed[len(smoothed) // 2] <= track[len(track) // 2]["angle"] + 1
+    assert result["duration_s"] == pytest.approx(len(_angles()) / FPS)
+    assert result["realtime_factor"] > 2
+
+
+def test_batched_detector_gets_the_same_track(video_path):
+    batches = []
+
+    def detect(frames):
+        batches.append(len(frames))
+        return [video.stub_wheel_detector(frame) for frame in frames]
+
+    batched = video.car_angle_track(video_path, detect, batch_size=4)
+    single = video.car_angle_track(video_path, video.stub_wheel_detector)
+    assert sum(batches) == single["kept_frames"] and max(batches) == 4
+    assert [entry["angle"] for entry in batched["track"]] == [entry["angle"] for entry in single["track"]]
+
+def test_smooth_angles_holds_through_frames_without_angle():
+    track = [{"time_s": 0.0, "angle": 10.0}, {"time_s": 0.1, "angle": None}, {"time_s": 0.2, "angle": 20.0}]
+    smoothed = [entry["smoothed_angle"] for entry in video.smooth_angles(track, smoothing_s=0.2)]
+    assert smoothed[:2] == [10.0, 10.0]
+    assert smoothed[2] == pytest.approx(10 + 10 * (1 - math.exp(-1)))
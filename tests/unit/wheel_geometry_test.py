@@ -0,0 +1,88 @@
+import math
+import sys
+from itertools import combinations
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "lambda" / "common"))
+import wheel_geometry  # noqa: E402
+
+
+def _reference_angle(wheel_points):
+    """Per-image computation of car_angle_from_wheels / car_angle_wheel_bbs before the batch engine"""
+    n_wheels = len(wheel_points)
+    wheel_centers = [points.mean(axis=0) for points in wheel_points]
+    wheel_center_comb = list(combinations(wheel_centers, 2))
+    vecs = [(k, pair[0] - pair[1]) for k, pair in enumerate(wheel_center_comb)]
+    vecs = sorted(vecs, key=lambda vec: np.linalg.norm(vec[1]))
+    vec_rel = vecs[1] if n_wheels == 3 else vecs[0]
+    angle = math.degrees(math.atan(vec_rel[1][1]/vec_rel[1][0]))
+    wheel_centers_rel = [tuple(wheel.tolist()) for wheel in wheel_center_comb[vec_rel[0]]]
+    return np.abs(angle), wheel_centers_rel
+
+
+def _reference_rekognition_points(box, image_size):
+    width, height = image_size
+    left, top = width * box[0], height * box[1]
+    box_width, box_height = width * box[2], height * box[3]
+    return np.array([
+        (left, top), (left + box_width, top), (left + box_width, top + box_height), (left, top + box_height), (left, top)
+    ])
+
+
+def _reference_xyxy_points(bb):
+    return np.array([[bb[0], bb[1]], [bb[2], bb[1]], [bb[0], bb[3]], [bb[2], bb[3]]])
+
+
+def _random_batch(rng, num_images, dtype):
+    counts = rng.integers(0, 6, num_images)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    corner = rng.uniform(0, 0.8, (offsets[-1], 2))
+    boxes = np.concatenate([corner, rng.uniform(0.01, 0.2, (offsets[-1], 2))], axis=1).astype(dtype)
+    return boxes, offsets
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_batch_matches_per_image_computation_for_detectron_boxes(dtype):
+    rng = np.random.default_rng(0)
+    boxes, offsets = _random_batch(rng, 2000, dtype)
+    xyxy = boxes.copy()
+    xyxy[:, 2:] = (boxes[:, :2] + boxes[:, 2:]) * 1000
+    xyxy[:, :2] *= 1000
+
+    angles, pairs, centers = wheel_geometry.wheel_angles(wheel_geometry.xyxy_box_points(xyxy), offsets)
+
+    for image, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if end - start < 2:
+            assert np.isnan(angles[image]) and tuple(pairs[image]) == (-1, -1)
+            continue
+        angle, wheel_centers_rel = _reference_angle([_reference_xyxy_points(bb) for bb in xyxy[start:end]])
+        assert angles[image] == angle
+        assert wheel_geometry.wheel_angle(wheel_geometry.xyxy_box_points(xyxy[start:end])) == (angle, wheel_centers_rel)
+        assert [tuple(centers[start + index].tolist()) for index in pairs[image]] == wheel_centers_rel
+
+
+def test_batch_matches_per_image_computation_for_rekognition_boxes():
+    rng = np.random.default_rng(1)
+    boxes, offsets = _random_batch(rng, 2000, np.float64)
+    image_sizes = np.repeat(rng.integers(100, 4000, (len(offsets) - 1, 2)), np.diff(offsets), axis=0)
+
+    angles, pairs, centers = wheel_geometry.wheel_angles(wheel_geometry.rekognition_box_points(boxes, image_sizes), offsets)
+
+    for image, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if end - start < 2:
+            continue
+        size = tuple(int(value) for value in image_sizes[start])
+        angle, wheel_centers_rel = _reference_angle([
+            _reference_rekognition_points(box.tolist(), size) for box in boxes[start:end]
+        ])
+        assert angles[image] == angle
+        assert wheel_geometry.wheel_angle(wheel_geometry.rekognition_box_points(boxes[start:end], size)) == (angle, wheel_centers_rel)
+        assert [tuple(centers[start + index].tolist()) for index in pairs[image]] == wheel_centers_rel
+
+
+def test_wheel_angle_of_one_image():
+    points = wheel_geometry.xyxy_box_points([[10, 30, 16, 36], [44, 28, 50, 34], [60, 40, 66, 46]])
+    assert wheel_geometry.wheel_angle(points) == _reference_angle(list(points))